@@ -0,0 +1,114 @@
+'''
+Micro-benchmark for position bins in interval queries (see
+www.api.query_builder.ESQueryBuilder._interval_bins()), on a synthetic
+chromosome held in memory: variants at random positions, doc IDs in random
+order (as in an index), postings (sorted doc IDs) per bin, as a terms filter
+reads them.
+
+From src folder:
+    python benchmarks/interval_bins_bench.py [chromosome length in Mb] [variants per bp]
+
+For each region size, compares:
+  * range: docs matching start <= region end and end >= region start, over
+    the whole chromosome, as the range filters alone do
+  * bins: union of the bins postings (terms filter), then range checked on
+    these candidates only. 1kb bins, 64kb bins if over MAX_INTERVAL_BINS
+
+and reports number of terms, candidates and time per query. Then times the
+terms filter alone for a growing number of bins of each level. Needs
+biothings installed, as the web API.
+'''
+import sys, os, time, random, bisect
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from utils.hgvs import get_pos_bins
+from www.api.query_builder import ESQueryBuilder
+
+REGIONS = [1000, 10000, 100000, 128000, 500000, 1000000, 4000000, 8000000]
+
+
+def build_index(length, density):
+    num = int(length * density)
+    positions = sorted(random.randrange(1, length) for _ in range(num))
+    doc_ids = list(range(num))
+    random.shuffle(doc_ids)
+    starts = array('l', [0] * num)
+    ends = array('l', [0] * num)
+    postings = {}
+    for (pos, doc_id) in zip(positions, doc_ids):
+        # mostly SNPs, some short indels
+        end = pos + (random.randrange(1, 20) if random.random() < 0.1 else 0)
+        starts[doc_id] = pos
+        ends[doc_id] = end
+        for b in get_pos_bins(pos, end) + get_pos_bins(pos, end, coarse=True):
+            postings.setdefault(b, array('l')).append(doc_id)
+    for b in postings:
+        postings[b] = array('l', sorted(postings[b]))
+    # doc IDs sorted by start and by end, as numeric terms are
+    by_start = sorted(range(num), key=starts.__getitem__)
+    by_end = sorted(range(num), key=ends.__getitem__)
+    return {"starts": starts, "ends": ends, "postings": postings, "num": num,
+            "by_start": (array('l', [starts[i] for i in by_start]), by_start),
+            "by_end": (array('l', [ends[i] for i in by_end]), by_end)}
+
+
+def range_filter(index, start, end):
+    values, docs = index["by_start"]
+    lte_end = set(docs[:bisect.bisect_right(values, end)])
+    values, docs = index["by_end"]
+    gte_start = docs[bisect.bisect_left(values, start):]
+    return [d for d in gte_start if d in lte_end]
+
+
+def terms_filter(index, bins):
+    candidates = set()
+    postings = index["postings"]
+    for b in bins:
+        candidates.update(postings.get(b, ()))
+    return candidates
+
+
+def bins_filter(index, bins, start, end):
+    starts, ends = index["starts"], index["ends"]
+    candidates = terms_filter(index, bins)
+    return [d for d in candidates if starts[d] <= end and ends[d] >= start], len(candidates)
+
+
+def timed(func, *args, repeat=3):
+    t0 = time.time()
+    for _ in range(repeat):
+        res = func(*args)
+    return res, (time.time() - t0) / repeat * 1000
+
+
+if __name__ == "__main__":
+    length = int(float(sys.argv[1]) * 1000000) if len(sys.argv) > 1 else 20000000
+    density = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    random.seed(42)
+    t0 = time.time()
+    index = build_index(length, density)
+    print("%d variants over %dMb, built in %.1fs" % (index["num"], length // 1000000, time.time() - t0))
+    print("%10s %8s %10s %10s %10s %10s" % ("region", "terms", "candidates", "hits", "range ms", "bins ms"))
+    for size in REGIONS:
+        start = length // 2
+        end = start + size - 1
+        hits, range_ms = timed(range_filter, index, start, end)
+        bins = None
+        for coarse in (False, True):
+            bins = get_pos_bins(start, end, coarse=coarse)
+            if len(bins) <= ESQueryBuilder.MAX_INTERVAL_BINS:
+                break
+        (bin_hits, candidates), bins_ms = timed(bins_filter, index, bins, start, end)
+        assert sorted(bin_hits) == sorted(hits)
+        print("%10d %8d %10d %10d %10.1f %10.1f" % (size, len(bins), candidates, len(hits), range_ms, bins_ms))
+    print("\nterms filter alone, per number of bins")
+    print("%8s %12s %12s" % ("bins", "1kb ms", "64kb ms"))
+    for num in [16, 32, 64, 128, 256, 512]:
+        fine = list(range(length // 2000, length // 2000 + num))
+        fine_ms = timed(terms_filter, index, fine)[1]
+        start = get_pos_bins(length // 2, length // 2, coarse=True)[0]
+        coarse = list(range(start, start + num))
+        coarse_ms = timed(terms_filter, index, coarse)[1] if num * 64000 <= length else float("nan")
+        print("%8d %12.1f %12.1f" % (num, fine_ms, coarse_ms))
@@ -0,0 +1,65 @@
+'''
+Micro-benchmark for snpEff output parsing, over a recorded snpEff output
+(tests/data/snpeff_output.vcf, lines carry the "# hgvs:" comment added by
+SnpeffAnnotator).
+
+From src folder:
+    python benchmarks/snpeff_bench.py [number of times fixture is repeated]
+
+Reports parse_line() throughput, and throughput and peak memory when
+streaming the repeated fixture through SnpeffAnnotator.annotate() ("cat"
+used as a fake snpEff command). Needs a config.py, as the hub.
+'''
+import sys, os, time, tempfile, tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from dataload.sources.snpeff.snpeff_parser import SnpeffAnnotator
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                       "tests", "data", "snpeff_output.vcf")
+
+
+def bench_parse_line(annotator, lines, repeat):
+    t0 = time.time()
+    cnt = 0
+    for _ in range(repeat):
+        for line in lines:
+            if annotator.parse_line(line):
+                cnt += 1
+    return cnt, time.time() - t0
+
+
+def bench_annotate(lines, repeat):
+    header = [l for l in lines if l.startswith("#")]
+    records = [l for l in lines if not l.startswith("#")]
+    with tempfile.NamedTemporaryFile("w", suffix=".vcf") as out:
+        out.write("\n".join(header) + "\n")
+        for i in range(repeat):
+            for line in records:
+                # unique IDs, so it looks like a real batch
+                out.write(line.replace("# hgvs:", "# hgvs:%d_" % i) + "\n")
+        out.flush()
+        annotator = SnpeffAnnotator(["cat", out.name])
+        # input is ignored by "cat <file>", but needs something to send
+        vcfs = {"chr1:g.1A>G": {"vcf": {"chrom": "1", "position": 1, "ref": "A", "alt": "G"}}}
+        t0 = time.time()
+        cnt = sum(1 for _ in annotator.annotate(vcfs))
+        took = time.time() - t0
+        # tracing slows everything down, measure memory in a second run
+        tracemalloc.start()
+        for _ in annotator.annotate(vcfs):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return cnt, took, peak
+
+
+if __name__ == "__main__":
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    lines = open(FIXTURE).read().splitlines()
+    cnt, took = bench_parse_line(SnpeffAnnotator("cat"), lines, repeat)
+    print("parse_line: %d docs in %.2fs (%.0f docs/s)" % (cnt, took, cnt / took))
+    cnt, took, peak = bench_annotate(lines, repeat)
+    print("annotate:   %d docs in %.2fs (%.0f docs/s), peak memory %.1fMB" % \
+            (cnt, took, cnt / took, peak / 1024 / 1024))
@@ -0,0 +1,69 @@
+'''
+Micro-benchmark for POST responses transformation (www.api.transform), over
+a batch of 1000 hits: recorded snpEff annotations (tests/data/snpeff_output.json)
+plus synthetic dbsnp/cadd/dbnsfp-like sources, with license URLs in source
+metadata for all of them.
+
+From src folder:
+    python benchmarks/transform_bench.py [number of batches]
+
+Reports time per batch for the default transformation (biothings
+ESResultTransformer, hit after hit) and the batch one, and checks both give
+the same output. Needs biothings installed, as the web API.
+'''
+import sys, os, time, json, copy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from biothings.utils.common import dotdict
+from biothings.www.api.es.transform import ESResultTransformer as BaseTransformer
+from www.api.transform import ESResultTransformer
+
+FIXTURE = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                       "tests", "data", "snpeff_output.json")
+SOURCES = ["snpeff", "dbsnp", "cadd", "dbnsfp", "clinvar", "exac", "gnomad_genome", "wellderly"]
+
+
+class DefaultTransformer(ESResultTransformer):
+    # previous per hit transformation, license map kept
+    _sort_and_annotate_doc = BaseTransformer._sort_and_annotate_doc
+    _clean_common_POST_response = BaseTransformer._clean_common_POST_response
+
+
+def build_batch(size=1000):
+    docs = [json.loads(line) for line in open(FIXTURE)]
+    hits = []
+    for i in range(size):
+        doc = copy.deepcopy(docs[i % len(docs)])
+        _id = doc.pop("_id")
+        doc["hg19"] = {"start": i, "end": i}
+        doc["dbsnp"] = {"rsid": "rs%d" % i, "vartype": "snp", "alleles": [{"allele": "A", "freq": 0.9},
+                                                                        {"allele": "G", "freq": 0.1}]}
+        doc["cadd"] = dict([("score_%d" % j, j * 0.1) for j in range(40)])
+        doc["dbnsfp"] = {"genename": "TP53", "polyphen2": {"hdiv": {"score": 0.9, "pred": "D"}},
+                         "sift": {"score": [0.01, 0.02], "pred": ["D", "D"]}}
+        hits.append({"_id": _id, "_score": 1.0, "_source": doc})
+    return {"responses": [{"hits": {"total": 1, "hits": [hit]}} for hit in hits]}
+
+
+def bench(cls, res, num):
+    metadata = {"hg19": dict([(s, {"license_url_short": "http://bit.ly/%s" % s}) for s in SOURCES])}
+    options = dotdict({"assembly": "hg19", "_sorted": True})
+    took = 0
+    for _ in range(num):
+        batch = copy.deepcopy(res)
+        t0 = time.time()
+        out = cls(options, "localhost", source_metadata=metadata).clean_annotation_POST_response(
+                [str(i) for i in range(len(batch["responses"]))], batch)
+        took += time.time() - t0
+    return out, took / num * 1000
+
+
+if __name__ == "__main__":
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    res = build_batch()
+    default, default_ms = bench(DefaultTransformer, res, num)
+    batch, batch_ms = bench(ESResultTransformer, res, num)
+    assert json.dumps(default) == json.dumps(batch)
+    print("default: %.1fms per 1000 hits" % default_ms)
+    print("batch:   %.1fms per 1000 hits" % batch_ms)
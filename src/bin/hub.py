@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import asyncio, asyncssh, sys
+import asyncio, asyncssh, sys, os
 import concurrent.futures
 from functools import partial
 
@@ -31,7 +31,9 @@ import biothings.databuild.syncer as syncer
 import biothings.dataindex.indexer as indexer
 from databuild.builder import MyVariantDataBuilder
 from databuild.mapper import TagObserved
-from dataindex.indexer import VariantIndexer
+from dataindex.indexer import VariantIndexer, build_target_id_lookup
+from utils.diffstream import diff_collections_file, DIFF_EXT
+from utils.genome import build_genome_store, GENOME_STORE_EXT
 
 # will check every 10 seconds for sources to upload
 upload_manager = uploader.UploaderManager(poll_schedule = '* * * * * */10', job_manager=job_manager)
@@ -59,7 +61,7 @@ index_manager = indexer.IndexerManager(pindexer=pindexer,
 index_manager.configure()
 
 import biothings.utils.mongo as mongo
-def snpeff(build_name=None,sources=[], force_use_cache=True):
+def snpeff(build_name=None,sources=[], force_use_cache=True, parallel=False):
     """
     Shortcut to run snpeff on all sources given a build_name
     or a list of source names will process sources one by one
@@ -69,6 +71,9 @@ def snpeff(build_name=None,sources=[], force_use_cache=True):
     speed up, while source is actually being postprocessed. We're assuming
     data hasn't changed and there's no new _ids since the last time source
     was processed.
+
+    parallel=True shards each source's IDs per chromosome and process shards
+    in hub process workers (see SnpeffPostUpdateUploader.do_snpeff_parallel)
     """
     if build_name:
         sources = mongo.get_source_fullnames(build_manager.list_sources(build_name))
@@ -81,11 +86,73 @@ def snpeff(build_name=None,sources=[], force_use_cache=True):
     def do(srcs):
         for src in srcs:
             config.logger.info("Running snpeff on '%s'" % src)
-            job = upload_manager.upload_src(src,steps="post",force_use_cache=force_use_cache)
+            job = upload_manager.upload_src(src,steps="post",force_use_cache=force_use_cache,parallel=parallel)
             yield from asyncio.wait(job)
     task = asyncio.ensure_future(do(sources))
     return task
 
+def incremental_merge(build_name, sources, previous_target=None, target_name=None, ids=None, **kwargs):
+    """
+    Build a new target for build_name from previous_target (default: latest build),
+    only re-merging documents which changed in given sources since their previous
+    upload (or given ids), see MyVariantDataBuilder.incremental_merge()
+    """
+    bdr = build_manager[build_name]
+    return bdr.incremental_merge(sources, previous_target=previous_target, target_name=target_name,
+                                 ids=ids, job_manager=job_manager, **kwargs)
+
+def id_lookup(build_name=None, target_name=None, upload=False):
+    """
+    Build secondary ID lookup file for target_name, or the latest target of
+    build_name (see dataindex.indexer.build_target_id_lookup()), and send
+    it to s3 if upload is True
+    """
+    target_name = target_name or mongo.get_latest_build(build_name)
+    if not target_name:
+        raise Exception("No target found")
+    pinfo = {"category" : "indexer",
+            "source" : target_name,
+            "step" : "id_lookup",
+            "description" : ""}
+    return job_manager.defer_to_thread(pinfo, partial(build_target_id_lookup,target_name,upload=upload))
+
+def diff_file(old_db_col_names, new_db_col_names, batch_size=10000, exclude=[]):
+    """
+    Compare old vs. new collections and write one streamable diff file
+    (see utils.diffstream), in the diff folder used by "diff" command.
+    Diff files can be applied with es_sync/mongo_sync without loading them
+    in memory
+    """
+    from biothings.utils.diff import generate_diff_folder
+    diff_folder = generate_diff_folder(old_db_col_names,new_db_col_names)
+    if not os.path.exists(diff_folder):
+        os.makedirs(diff_folder)
+    filename = os.path.join(diff_folder,"diff" + DIFF_EXT)
+    pinfo = {"category" : "diff",
+            "source" : "%s vs %s" % (old_db_col_names,new_db_col_names),
+            "step" : "diff_file",
+            "description" : filename}
+    return job_manager.defer_to_thread(pinfo, partial(diff_collections_file,old_db_col_names,new_db_col_names,
+                                                      filename,batch_size=batch_size,exclude=exclude))
+
+def genome_store(assembly, chr_fa_folder, outfile=None):
+    """
+    Pack chr*.fa.gz files from chr_fa_folder into a genome store (see
+    utils.genome) for assembly (hg19/hg38). Default output file is next to
+    snpEff's pickled genome (snpeff "data_folder"/../data), where snpEff
+    post-processing picks it up in place of the pickled one
+    """
+    if not outfile:
+        snpeff_doc = mongo.get_src_dump().find_one({"_id" : "snpeff"})
+        if not snpeff_doc:
+            raise Exception("No snpeff information found, has it been dumped & uploaded ?")
+        outfile = os.path.join(snpeff_doc["data_folder"],"..","data","%s_genome%s" % (assembly,GENOME_STORE_EXT))
+    pinfo = {"category" : "genome",
+            "source" : assembly,
+            "step" : "genome_store",
+            "description" : outfile}
+    return job_manager.defer_to_process(pinfo, partial(build_genome_store,chr_fa_folder,outfile))
+
 def rebuild_cache(build_name=None,sources=None,target=None,force_build=False):
     """Rebuild cache files for all sources involved in build_name, as well as 
     the latest merged collection found for that build"""
@@ -142,9 +209,11 @@ COMMANDS = {
         "upload_all": upload_manager.upload_all,
         "snpeff": snpeff,
         "rebuild_cache": rebuild_cache,
+        "genome_store": genome_store,
         # building/merging
         "bm" : build_manager,
         "merge" : build_manager.merge,
+        "incremental_merge" : incremental_merge,
         "mongo_sync" : partial(syncer_manager.sync,"mongo"),
         "es_sync" : partial(syncer_manager.sync,"es"),
         "es_sync_hg19_test" : partial(syncer_manager.sync,"es",target_backend=config.ES_TEST_HG19),
@@ -157,11 +226,13 @@ COMMANDS = {
         # diff
         "dim" : differ_manager,
         "diff" : partial(differ_manager.diff,"jsondiff"),
+        "diff_file" : diff_file,
         "report": differ_manager.diff_report,
         # indexing commands
         "im" : index_manager,
         "index" : index_manager.index,
         "snapshot" : index_manager.snapshot,
+        "id_lookup" : id_lookup,
         # admin/advanced
         "loop" : loop,
         "pqueue" : process_queue,
@@ -73,6 +73,18 @@ URL_BASE = 'http://myvariant.info'
 
 STATUS_CHECK_ID = 'chr1:g.218631822G>A'
 
+# interval queries first filter on position bins ("<assembly>.bin", 1kb and
+# 64kb bins). Only enable once served indices were built with both levels of
+# bins on all documents
+INTERVAL_BINS = False
+
+# in-process cache of /variant GET responses (per web process): max number
+# of responses (0 to disable), max total size of cached responses in bytes,
+# and seconds before an entry expires
+VARIANT_CACHE_SIZE = 0
+VARIANT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+VARIANT_CACHE_TTL = 300
+
 # hipchat message color for this app
 HIPCHAT_MESSAGE_COLOR = 'green'
 
@@ -81,6 +93,12 @@ ANNOTATION_ID_REGEX_LIST = [(re.compile(r'rs[0-9]+', re.I), 'dbsnp.rsid'),
                             (re.compile(r'rcv[0-9\.]+', re.I), 'clinvar.rcv.accession'),
                             (re.compile(r'var_[0-9]+', re.I), 'uniprot.humsavar.ftid')]
 
+# assembly => secondary ID lookup file, built on the hub for a target with
+# the "id_lookup" command (<CACHE_FOLDER>/<target>.idlookup, optionally
+# uploaded to s3, see utils.idlookup) and copied to web hosts. If set, /variant
+# lookups by the IDs above get docs by _id instead of searching
+ID_LOOKUP_FILES = {}
+
 # typedef for assembly parameter
 ASSEMBLY_TYPEDEF = {'assembly': {'type': str, 'default': 'hg19'}}
 ANNOTATION_GET_ESQB_KWARGS.update(ASSEMBLY_TYPEDEF)
@@ -93,6 +111,13 @@ ANNOTATION_GET_TRANSFORM_KWARGS.update(ASSEMBLY_TYPEDEF)
 ANNOTATION_POST_TRANSFORM_KWARGS.update(ASSEMBLY_TYPEDEF)
 QUERY_GET_TRANSFORM_KWARGS.update(ASSEMBLY_TYPEDEF)
 QUERY_POST_TRANSFORM_KWARGS.update(ASSEMBLY_TYPEDEF)
+# POST /query: "size" and "from" apply to each query term. With fetch_all,
+# all hits of interval terms (chrN:start-end) are fetched, page after page,
+# as long as the request stays under a total number of hits
+# (see www.api.query.ESQuery.MAX_POST_HITS)
+QUERY_POST_ES_KWARGS.update({'from': {'default': None, 'type': int, 'alias': 'skip'},
+                             'size': {'default': None, 'type': int, 'alias': 'limit'}})
+QUERY_POST_ESQB_KWARGS.update({'fetch_all': {'default': False, 'type': bool}})
 
 JSONLD_CONTEXT_PATH = 'www/context/context.json'
 
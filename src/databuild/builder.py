@@ -1,16 +1,22 @@
 import math
 import asyncio
 from functools import partial
-import datetime, pickle
+import datetime
 
 from biothings.utils.common import iter_n
-from biothings.utils.mongo import id_feeder
+from biothings.utils.mongo import id_feeder, doc_feeder
 import biothings.utils.mongo as mongo
 import biothings.databuild.builder as builder
+from utils.hgvs import get_pos_bins
+from utils.aggregation import ROOT_KEYS
 import config
 
 class MyVariantDataBuilder(builder.DataBuilder):
 
+    # set by incremental_merge() while its merge runs:
+    # {"ids" : [touched _ids], "base_stats" : {root key stats}}
+    incremental = None
+
     def merge(self, sources=None, target_name=None, batch_size=50000, job_manager=None, **kwargs):
         # just override default batch_size or it consumes too much mem
         return super(MyVariantDataBuilder,self).merge(
@@ -20,6 +26,102 @@ class MyVariantDataBuilder(builder.DataBuilder):
                 batch_size=batch_size,
                 **kwargs)
 
+    def get_archived_collection(self, src_name):
+        """Return latest archived collection name for source collection src_name
+        (previous upload), or None if none can be found"""
+        prefix = "%s_archive_" % src_name
+        archives = sorted([c for c in mongo.get_src_db().collection_names() if c.startswith(prefix)])
+        return archives and archives[-1] or None
+
+    def incremental_merge(self, sources, previous_target=None, target_name=None, ids=None,
+                          batch_size=50000, job_manager=None, **kwargs):
+        """
+        Build a new target from a copy of previous_target (default: latest build),
+        re-merging only documents which changed in given sources. Changed _ids can be
+        given with "ids", otherwise each source is compared with its latest archived
+        collection, the previous upload, assumed to be the one used in previous_target.
+        Data from documents removed from a source is removed from the new target,
+        and these documents are re-merged so keys shared with other sources
+        (vcf, hg19, ...) are rebuilt.
+        All given sources are merged for the whole set of changed _ids (so snpeff,
+        which isn't archived, can be given to get annotations for new clinvar _ids),
+        and set_chrom() and mappers (TagObserved) only process them.
+        """
+        assert job_manager
+        self.prepare()
+        previous_target = previous_target or mongo.get_latest_build(self.build_name)
+        if not previous_target:
+            raise builder.BuilderException("No previous build found for '%s'" % self.build_name)
+        if isinstance(sources,str):
+            sources = [sources]
+        src_names = self.resolve_sources(sources)
+        target_name = target_name or self.target_backend.target_name
+        self.logger.info("Incremental merge of %s from '%s' into '%s'" % (src_names,previous_target,target_name))
+
+        @asyncio.coroutine
+        def do():
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "incremental (copy)"
+            pinfo["description"] = previous_target
+            job = yield from job_manager.defer_to_thread(pinfo,
+                    partial(copy_target,previous_target,target_name))
+            yield from job
+            changed = set(ids or [])
+            deleted = set()
+            if not ids:
+                for src_name in src_names:
+                    archive = self.get_archived_collection(src_name)
+                    if not archive:
+                        self.logger.warning("No archived collection for '%s', it'll only be merged for " % src_name + \
+                                "_ids changed in other sources")
+                        continue
+                    pinfo["step"] = "incremental (diff)"
+                    pinfo["description"] = "%s vs %s" % (src_name,archive)
+                    job = yield from job_manager.defer_to_process(pinfo,
+                            partial(changed_ids_worker,src_name,archive))
+                    res = yield from job
+                    self.logger.info("Source '%s': %d changed/new documents, %d removed" % \
+                            (src_name,len(res["changed"]),len(res["deleted"])))
+                    changed.update(res["changed"])
+                    if res["deleted"]:
+                        deleted.update(res["deleted"])
+                        pinfo["step"] = "incremental (remove)"
+                        job = yield from job_manager.defer_to_thread(pinfo,
+                                partial(remove_keys,target_name,res["deleted"],res["deleted_keys"]))
+                        yield from job
+            touched = sorted(changed.union(deleted))
+            if not touched:
+                self.logger.info("Nothing changed in %s, dropping '%s'" % (src_names,target_name))
+                mongo.get_target_db()[target_name].drop()
+                return
+            # stats for documents left untouched: previous ones minus the one
+            # from touched documents (as they were before being re-merged)
+            build = self.source_backend.build.find_one({"_id" : previous_target}) or {}
+            prev_stats = build.get("_meta",{}).get("stats")
+            base_stats = None
+            if prev_stats:
+                pinfo["step"] = "incremental (stats)"
+                job = yield from job_manager.defer_to_thread(pinfo,
+                        partial(count_root_keys,previous_target,touched))
+                old_stats = yield from job
+                old_stats["total"] = old_stats.pop("_id",0)
+                base_stats = merge_root_keys(prev_stats,old_stats,sign=-1)
+            self.incremental = {"ids" : touched, "base_stats" : base_stats}
+            try:
+                # removed documents are re-merged too, as data shared with other
+                # sources was left untouched (remove_keys() deleted documents
+                # left without any source data, they're not merged back)
+                job = self.merge(sources=sources, target_name=target_name, ids=touched,
+                        steps=["merge","post","metadata"], batch_size=batch_size,
+                        job_manager=job_manager, **kwargs)
+                res = yield from job
+            finally:
+                # only for this merge, next ones on this builder are full merges
+                self.incremental = None
+            return res
+
+        return asyncio.ensure_future(do())
+
     def validate_merge(self):
         # MyVariant merging either insert or updates. So we can't just count
         # the number of inserted/updated data from single colleciton and compare with
@@ -34,73 +136,113 @@ class MyVariantDataBuilder(builder.DataBuilder):
         else:
             self.logger.warning("Total count of documents {} is greater than what was inserted/updated... {}]".format(target_cnt, total))
 
-    def set_chrom(self, batch_size, job_manager):
+    def set_chrom(self, batch_size, job_manager, ids=None, base_stats=None):
+        """
+        Set "chrom" field (and "<assembly>.bin" position bins, see
+        utils.hgvs.get_pos_bins()) on all documents or, if given, on ids only. In that
+        case, root key stats are computed on ids only and added to
+        base_stats (stats of all other documents) to store build's stats.
+        """
         # divide & conquer... build batches
-        jobs = []
-        total = self.target_backend.count()
+        total = ids and len(ids) or self.target_backend.count()
         btotal = math.ceil(total/batch_size) 
         bnum = 1
         cnt = 0
-        results = {"missing" : [], "disagreed" : []}
+        # discrepancies can be millions of IDs, they're streamed to a file
+        # as batches are done, one "missing|disagreed<tab>_id" per line
+        fn = "chrom_%s_%s.txt" % (self.target_backend.target_name,datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
+        results = {"missing" : 0, "disagreed" : 0, "file" : None}
         root_keys = {}
+        pending = set()
+        errors = []
+        # backpressure: don't submit more jobs than what can be processed
+        # plus MAX_QUEUED_JOBS waiting, next one is submitted as soon as
+        # a slot is free
+        num_workers = job_manager.process_queue._max_workers
+        slots = asyncio.Semaphore(num_workers + config.MAX_QUEUED_JOBS)
         # grab ids only, so we can get more and fill queue for each step
         # each round, fill the queue to make sure every cpu slots are always working
-        id_batch_size = batch_size * job_manager.process_queue._max_workers * 2
+        id_batch_size = batch_size * num_workers * 2
         self.logger.info("Fetch _ids from '%s' with batch_size=%d, and create post-merger job with batch_size=%d" % \
                 (self.target_backend.target_collection.name, id_batch_size, batch_size))
-        for big_doc_ids in id_feeder(self.target_backend.target_collection, batch_size=id_batch_size, logger=self.logger):
+
+        def processed(f, batch_num):
+            pending.discard(f)
+            slots.release()
+            try:
+                fres = f.result()
+                if fres["missing"] or fres["disagreed"]:
+                    if results["file"] is None:
+                        self.logger.info("Writing 'chrom' discrepancies into %s" % fn)
+                        results["file"] = fn
+                    with open(fn,"a") as out:
+                        for reason in ["missing","disagreed"]:
+                            results[reason] += len(fres[reason])
+                            out.writelines(["%s\t%s\n" % (reason,_id) for _id in fres[reason]])
+                # merge root key counts
+                rk = fres["root_keys"]
+                for k in rk:
+                    root_keys.setdefault(k,0)
+                    root_keys[k] += rk[k]
+                self.logger.info("chrom batch #%d, done" % batch_num)
+            except Exception as e:
+                import traceback
+                self.logger.error("chrom batch #%d, error in processed (set_chrom): %s:\n%s" % \
+                        (batch_num, e, traceback.format_exc()))
+                errors.append(e)
+
+        id_provider = ids and [ids] or id_feeder(self.target_backend.target_collection,
+                                                 batch_size=id_batch_size,logger=self.logger)
+        for big_doc_ids in id_provider:
             for doc_ids in iter_n(big_doc_ids,batch_size):
-                yield from asyncio.sleep(0.1)
+                yield from slots.acquire()
                 cnt += len(doc_ids)
                 pinfo = self.get_pinfo()
                 pinfo["step"] = "post-merge (chrom)"
                 pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100.))
                 self.logger.info("Creating post-merge job #%d/%d to process chrom %d/%d (%.1f%%)" % \
                         (bnum,btotal,cnt,total,(cnt/total*100.)))
-                job = yield from job_manager.defer_to_process(pinfo,
-                        partial(chrom_worker, self.target_backend.target_name, doc_ids))
-                def processed(f,results, batch_num):
-                    try:
-                        fres = f.result()
-                        results["missing"].extend(fres["missing"])
-                        results["disagreed"].extend(fres["disagreed"])
-                        # merge root key counts
-                        rk = fres["root_keys"]
-                        for k in rk:
-                            root_keys.setdefault(k,0)
-                            root_keys[k] += rk[k]
-                        self.logger.info("chrom batch #%d, done" % batch_num)
-                    except Exception as e:
-                        import traceback
-                        self.logger.error("chrom batch #%d, error in processed (set_chrom): %s:\n%s" % \
-                                (batch_num, e, traceback.format_exc()))
-                        raise
-                job.add_done_callback(partial(processed, results=results, batch_num=bnum))
-                jobs.append(job)
+                try:
+                    job = yield from job_manager.defer_to_process(pinfo,
+                            partial(chrom_worker, self.target_backend.target_name, doc_ids))
+                except:
+                    slots.release()
+                    raise
+                pending.add(job)
+                job.add_done_callback(partial(processed, batch_num=bnum))
                 bnum += 1
-        self.logger.info("%d jobs created for merging step" % len(jobs))
-        if jobs:
-            yield from asyncio.gather(*jobs)
-            self.logger.info("Found %d missing 'chrom' and %d where resources disagreed" % (len(results["missing"]), len(results["disagreed"])))
-            if results["missing"] or results["disagreed"]:
-                fn = "chrom_%s_%s.pickle" % (self.target_backend.target_name,datetime.datetime.now().strftime("%Y%m%d_%H%M%S"))
-                self.logger.info("Pickling 'chrom' discrepancies into %s" % fn)
-                pickle.dump(results,open(fn,"wb"))
+        self.logger.info("%d jobs created for merging step" % (bnum - 1))
+        if pending:
+            yield from asyncio.wait(list(pending))
+        if errors:
+            raise Exception("%d post-merge (chrom) job(s) failed, first error: %s" % (len(errors),errors[0]))
+        if bnum > 1:
+            self.logger.info("Found %d missing 'chrom' and %d where resources disagreed" % (results["missing"], results["disagreed"]))
             # now store metadata
-            root_keys["total"] = root_keys.pop("_id")
+            root_keys["total"] = root_keys.pop("_id",0)
+            if ids:
+                if base_stats is None:
+                    self.logger.warning("No base stats for other documents, can't store root keys stats")
+                    return results
+                root_keys = merge_root_keys(base_stats,root_keys)
             self.logger.info("Root keys: %s" % root_keys)
             src_build = self.source_backend.build
             src_build.update({'_id': self.target_backend.target_name},{"$set":{"_meta.stats":root_keys}})
 
-
         return results
 
     def post_merge(self, source_names, batch_size, job_manager):
-        self.validate_merge()
+        # merge stats only cover re-merged documents in incremental mode
+        if not self.incremental:
+            self.validate_merge()
         # we're in a new thread (see biothings.databuild.builder, post_merge
         # is called in defer_to_thread)
         asyncio.set_event_loop(job_manager.loop)
-        job = self.set_chrom(batch_size, job_manager)
+        if self.incremental:
+            job = self.set_chrom(batch_size, job_manager, ids=self.incremental["ids"],
+                                 base_stats=self.incremental["base_stats"])
+        else:
+            job = self.set_chrom(batch_size, job_manager)
         task = asyncio.ensure_future(job)
         return task
 
@@ -127,29 +269,148 @@ def get_chrom(doc):
     return this_chrom
 
 
+# root keys which aren't coming from a source
+NON_SOURCE_KEYS = set(["_id","chrom","observed"])
+# root keys which several sources provide (snpeff annotates _ids from all
+# other sources, it doesn't come on its own)
+SHARED_KEYS = NON_SOURCE_KEYS.union(["vcf","snpeff"] + config.SUPPORTED_ASSEMBLIES)
+
+
+def chrom_projection():
+    """
+    Aggregation stage returning only what's needed to set "chrom": chrom
+    subfields from CHROM_FIELDS sources, start/end positions (to set position
+    bins) plus the list of root key names (in "_root_keys") for stats. Merged
+    documents can be huge, there's no need to send them in full over the wire.
+    """
+    proj = {"%s.%s" % (src,field) : 1 for src,field in config.CHROM_FIELDS.items()}
+    for assembly in config.SUPPORTED_ASSEMBLIES:
+        proj["%s.start" % assembly] = 1
+        proj["%s.end" % assembly] = 1
+    proj["_root_keys"] = ROOT_KEYS
+    return {"$project" : proj}
+
+
+def merge_root_keys(stats, other, sign=1):
+    """Return root key stats from stats, plus (or minus) other's. Keys
+    with a null count are removed"""
+    merged = dict(stats)
+    for k in other:
+        merged[k] = merged.get(k,0) + sign * other[k]
+        if merged[k] <= 0:
+            merged.pop(k)
+    return merged
+
+
+def count_root_keys(col_name, ids, batch_size=10000):
+    """Count root keys in target collection col_name, for documents ids only
+    (server-side)"""
+    col = mongo.get_target_db()[col_name]
+    root_keys = {}
+    for doc_ids in iter_n(ids,batch_size):
+        cur = col.aggregate([{"$match" : {"_id" : {"$in" : doc_ids}}},
+                             {"$project" : {"_root_keys" : ROOT_KEYS}},
+                             {"$unwind" : "$_root_keys"},
+                             {"$group" : {"_id" : "$_root_keys", "count" : {"$sum" : 1}}}])
+        for res in cur:
+            root_keys.setdefault(res["_id"],0)
+            root_keys[res["_id"]] += res["count"]
+    return root_keys
+
+
+def copy_target(col_name, dest_name):
+    """Copy target collection col_name to dest_name, server-side"""
+    tgt = mongo.get_target_db()
+    tgt[col_name].aggregate([{"$match" : {}}, {"$out" : dest_name}], allowDiskUse=True)
+
+
+def changed_ids_worker(src_name, archive_name, batch_size=10000):
+    """
+    Compare source collection src_name with its archived version archive_name.
+    Return new or changed _ids, removed _ids and the source's own root keys
+    found in removed documents (not SHARED_KEYS, other sources may provide
+    them for the same _ids).
+    """
+    src = mongo.get_src_db()
+    col = src[src_name]
+    archive = src[archive_name]
+    changed = []
+    deleted = []
+    deleted_keys = set()
+    for docs in doc_feeder(col, step=batch_size, inbatch=True):
+        olds = {d["_id"] : d for d in archive.find({"_id" : {"$in" : [d["_id"] for d in docs]}})}
+        changed.extend([d["_id"] for d in docs if olds.get(d["_id"]) != d])
+    for ids in id_feeder(archive, batch_size=batch_size, build_cache=False):
+        found = set([d["_id"] for d in col.find({"_id" : {"$in" : ids}},{"_id" : 1})])
+        gone = [_id for _id in ids if not _id in found]
+        if gone:
+            deleted.extend(gone)
+            for d in archive.aggregate([{"$match" : {"_id" : {"$in" : gone}}},
+                                        {"$project" : {"_root_keys" : ROOT_KEYS}}]):
+                deleted_keys.update(d["_root_keys"])
+    deleted_keys.difference_update(SHARED_KEYS)
+    return {"changed" : changed, "deleted" : deleted, "deleted_keys" : sorted(deleted_keys)}
+
+
+def remove_keys(col_name, ids, keys, batch_size=10000):
+    """Unset root keys from documents ids in target collection col_name,
+    documents left without any source data (only SHARED_KEYS) are deleted"""
+    col = mongo.get_target_db()[col_name]
+    for doc_ids in iter_n(ids,batch_size):
+        col.update_many({"_id" : {"$in" : doc_ids}},{"$unset" : {k : "" for k in keys}})
+        empty = [d["_id"] for d in col.aggregate([{"$match" : {"_id" : {"$in" : doc_ids}}},
+                                                   {"$project" : {"_root_keys" : ROOT_KEYS}}]) \
+                 if SHARED_KEYS.issuperset(d["_root_keys"])]
+        empty and col.delete_many({"_id" : {"$in" : empty}})
+
+
+def get_doc_bins(pos):
+    """Return position bins (both levels) for an assembly field value pos, a
+    dict or a list of dicts (sources not agreeing on positions), with start/end
+    as int or numeric strings. None if no position can be found"""
+    bins = set()
+    for p in (pos if type(pos) == list else [pos]):
+        if type(p) != dict:
+            continue
+        try:
+            start, end = int(p["start"]), int(p["end"])
+            bins.update(get_pos_bins(start,end))
+            bins.update(get_pos_bins(start,end,coarse=True))
+        except (KeyError, TypeError, ValueError):
+            continue
+    return bins and sorted(bins) or None
+
+
 def chrom_worker(col_name, ids):
     tgt = mongo.get_target_db()
     col = tgt[col_name]
-    cur = col.find({'_id': {'$in': ids}})
+    cur = col.aggregate([{"$match" : {'_id': {'$in': ids}}}, chrom_projection()])
     bob = col.initialize_unordered_bulk_op()
     disagreed = []
     missing = []
     root_keys = {}
     at_least_one = False
     for doc in cur:
+        # count root keys for later metadata
+        for k in doc.pop("_root_keys"):
+            root_keys.setdefault(k,0)
+            root_keys[k] += 1
         dchrom = get_chrom(doc)
         if dchrom["chrom"] is None:
             missing.append(doc["_id"])
         elif dchrom["agreed"] == False:
             disagreed.append(doc["_id"])
         chrom = dchrom["chrom"]
+        upd = {}
         if chrom:
-            bob.find({"_id": doc["_id"]}).update({"$set": {"chrom" : chrom}})
+            upd["chrom"] = chrom
+        for assembly in config.SUPPORTED_ASSEMBLIES:
+            bins = get_doc_bins(doc.get(assembly))
+            if bins:
+                upd["%s.bin" % assembly] = bins
+        if upd:
+            bob.find({"_id": doc["_id"]}).update({"$set": upd})
             at_least_one = True
-        # count root keys for later metadata
-        for k in doc:
-            root_keys.setdefault(k,0)
-            root_keys[k] += 1
 
     at_least_one and bob.execute()
 
@@ -1,71 +1,220 @@
 from __future__ import print_function
 import glob
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+from threading import BoundedSemaphore
 from biothings.utils.common import iter_n
 from time import sleep, time
 import os.path
 import jsonpatch
 import config
-from elasticsearch.helpers import bulk
-from utils.es import ESIndexer, get_es
+from elasticsearch.helpers import bulk, BulkIndexError
+from elasticsearch.exceptions import TransportError, ConnectionError as ESConnectionError
+from biothings.utils.es import ESIndexer, get_es
 from biothings.utils.mongo import get_src_db
-from utils.diff_update import apply_patch, diff_collections, get_backend
-from biothings.utils.common import loadobj, get_random_string, timesofar
+from biothings.utils.diff import diff_collections
+from biothings.utils.common import get_random_string, timesofar
+from utils.diffstream import load_diff, DIFF_EXT
 from dataload import load_source
 
+# first chunk of IDs for add(), chunks then grow up to ESSyncer.step
+ADD_MIN_CHUNK = 100
+# mexists() searches for a chunk of IDs at once, ES can't return more hits
+MAX_SEARCH_SIZE = 10000
+# keys which don't make a document on their own, without any source data
+BASE_KEYS = ['snpeff', 'vcf', 'hg19', 'hg38', 'chrom']
+# scripts for scripted updates, for ES 2.x (inline groovy scripting must be
+# enabled). Plain Java-like syntax only, no groovy-specific methods
+SCRIPT_LANG = 'groovy'
+DELETE_SCRIPT = 'if (ctx._source.containsKey(field)) { ctx._source.remove(field); ctx._source.remove("_id"); ' + \
+                'boolean empty = true; for (String key : ctx._source.keySet()) { ' + \
+                'if (!base_keys.contains(key)) { empty = false; break } } ' + \
+                'if (empty) { ctx.op = "delete" } } else { ctx.op = "none" }'
+UPDATE_SCRIPT = 'ctx._source[field] = value; ctx._source.remove("_id")'
+# bulk items rejected with these statuses (ES busy) are retried
+RETRY_STATUSES = (429, 503)
+# bulk items failing with these statuses are expected and only counted, per
+# phase: docs created meanwhile (add), docs already gone (scripted modes)
+IGNORED_STATUSES = {'add': (409,), 'delete': (404,), 'update': (404,)}
+
 
 class ESSyncer():
-    def __init__(self, index=None, doc_type=None, es_host=None, step=5000):
+    def __init__(self, index=None, doc_type=None, es_host=None, step=5000, thread_count=4,
+                 executor=None, slots=None, max_retries=5, initial_backoff=2):
+        '''
+        Bulk requests are sent by thread_count threads, or by executor if given
+        (to share a limited number of concurrent requests between syncers).
+        slots is a semaphore bounding the number of chunks queued or being
+        sent (thread_count * 2 by default), to share with executor so memory
+        is bounded whatever the number of syncers.
+        Rejected bulk items are retried up to max_retries times, waiting
+        initial_backoff seconds, then twice as long each time.
+        '''
         self._es = get_es(es_host)
         self._index = index or config.ES_INDEX_NAME
         self._doc_type = doc_type or config.ES_DOC_TYPE
-        self._esi = ESIndexer(es_host=es_host)
-        self._esi._index = self._index
+        self._esi = ESIndexer(index=self._index, doc_type=self._doc_type, es_host=es_host)
         self._src = get_src_db()
         self.step = step
+        self.thread_count = thread_count
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(thread_count)
+        self._slots = slots or BoundedSemaphore(thread_count * 2)
+
+    def close(self):
+        if self._own_executor:
+            self._executor.shutdown()
+
+    def _bulk_chunk(self, chunk, label='', ignore_statuses=()):
+        '''send a chunk of actions, retrying rejected ones with backoff. Returns
+           (number of successful actions, number of actions failing with one
+           of ignore_statuses, list of errors)'''
+        t0 = time()
+        size = len(chunk)
+        cnt = 0
+        skipped = 0
+        failed = []
+        backoff = self.initial_backoff
+        for attempt in range(self.max_retries + 1):
+            retry = []
+            try:
+                ok, errors = bulk(self._es, chunk, chunk_size=len(chunk), raise_on_error=False)
+                cnt += ok
+                rejected = set()
+                for err in errors:
+                    info = list(err.values())[0]
+                    if info.get('status') in RETRY_STATUSES:
+                        rejected.add(info.get('_id'))
+                    elif info.get('status') in ignore_statuses:
+                        skipped += 1
+                    else:
+                        failed.append(err)
+                retry = [action for action in chunk if action['_id'] in rejected]
+            except TransportError as e:
+                # whole request failed, retry if it's worth it
+                if not isinstance(e, ESConnectionError) and e.status_code not in RETRY_STATUSES:
+                    raise
+                retry = chunk
+            if not retry:
+                break
+            if attempt == self.max_retries:
+                failed.extend([{action.get('_op_type', 'index'): {'_id': action['_id'], 'error': 'too many retries'}}
+                               for action in retry])
+                break
+            print('{} {} bulk actions rejected, retrying in {}s'.format(label, len(retry), backoff))
+            sleep(backoff)
+            backoff *= 2
+            chunk = retry
+        took = time() - t0
+        print('{} chunk of {} actions: {} ok, {} skipped, {} failed [{:.1f}s, {:.0f} actions/s]'.format(
+            label, size, cnt, skipped, len(failed), took, size / took if took else 0))
+        return cnt, skipped, failed
+
+    def bulk(self, actions, raise_on_error=True, label='', ignore_statuses=()):
+        '''send actions to ES in chunks of step actions, concurrently (see
+           __init__). Returns (number of successful actions, number of actions
+           failing with one of ignore_statuses). Other failed actions raise a
+           BulkIndexError (once pending chunks are done), or are only reported
+           if raise_on_error is False'''
+        cnt = 0
+        skipped = 0
+        failed = []
+        pending = set()
+
+        def collect(done):
+            nonlocal cnt, skipped
+            for f in done:
+                ok, ign, errors = f.result()
+                cnt += ok
+                skipped += ign
+                failed.extend(errors)
+
+        for chunk in iter_n(actions, self.step):
+            # waits for a chunk, from any syncer sharing slots, to be sent
+            self._slots.acquire()
+            try:
+                done = set([f for f in pending if f.done()])
+                pending -= done
+                collect(done)
+            except Exception:
+                self._slots.release()
+                raise
+            if failed and raise_on_error:
+                self._slots.release()
+                break
+            f = self._executor.submit(self._bulk_chunk, chunk, label, ignore_statuses)
+            f.add_done_callback(lambda _: self._slots.release())
+            pending.add(f)
+        collect(wait_futures(pending).done)
+        if skipped:
+            print(label, 'bulk actions skipped (status {}): {}'.format(ignore_statuses, skipped))
+        if failed:
+            for err in failed[:10]:
+                print(label, 'bulk action failed:', err)
+            print(label, 'bulk actions failed: ', len(failed))
+            if raise_on_error:
+                raise BulkIndexError('%i document(s) failed to index.' % len(failed), failed)
+        return cnt, skipped
 
     def add(self, collection, ids):
-        # compare id_list with current index, get list of ids with true/false indicator
+        # ids are processed by chunks, starting small so bulk requests start
+        # quickly, then growing up to the bulk size. Each chunk needs one ES
+        # search (mexists) and one mongo query to get source documents
         cnt_update = 0
         cnt_create = 0
-		for ids_chunk in iter_n(ids, 100):
-		    id_list_all = self._esi.mexists(ids_chunk, verbose=False)
-		    for _id, _exists in id_list_all:
-			_doc = self._src[collection].find_one({'_id': _id})
-			_doc.pop('_id')
-			# case one: this id exists in current index, then just update
-			if _exists:
-			    es_info = {
-				'_op_type': 'update',
-				'_index': self._index,
-				'_type': self._doc_type,
-				'_id': _id,
-				'doc': _doc
-			    }
-			    cnt_update += 1
-			# case two: this id not exists in current index, then create a new one
-			else:
-			    es_info = {
-				'_op_type': 'create',
-				'_index': self._index,
-				'_type': self._doc_type,
-				"_id": _id,
-				'_source': _doc
-			    }
-			    cnt_create += 1
-			yield es_info
-		print('items updated: ', cnt_update)
-		print('items newly created: ', cnt_create)
+        ids = iter(ids)
+        chunk_size = min(ADD_MIN_CHUNK, self.step)
+        while True:
+            ids_chunk = list(islice(ids, chunk_size))
+            if not ids_chunk:
+                break
+            docs = {}
+            for doc in self._src[collection].find({'_id': {'$in': ids_chunk}}):
+                docs[doc.pop('_id')] = doc
+            # compare id_list with current index, get list of ids with true/false indicator
+            id_list_all = self._esi.mexists(ids_chunk)
+            for _id, _exists in id_list_all:
+                _doc = docs.get(_id)
+                if _doc is None:
+                    print('id does not exist in mongodb collection:', _id)
+                    continue
+                # case one: this id exists in current index, then just update
+                if _exists:
+                    es_info = {
+                        '_op_type': 'update',
+                        '_index': self._index,
+                        '_type': self._doc_type,
+                        '_id': _id,
+                        'doc': _doc
+                    }
+                    cnt_update += 1
+                # case two: this id not exists in current index, then create a new one
+                else:
+                    es_info = {
+                        '_op_type': 'create',
+                        '_index': self._index,
+                        '_type': self._doc_type,
+                        "_id": _id,
+                        '_source': _doc
+                    }
+                    cnt_create += 1
+                yield es_info
+            chunk_size = min(chunk_size * 2, self.step, MAX_SEARCH_SIZE)
+        print('items updated: ', cnt_update)
+        print('items newly created: ', cnt_create)
 
-	    def delete(self, field, ids):
-		cnt_update = 0
-		cnt_delete = 0
-		for _id in ids:
-		    # get doc from index based on id
-		    if self._esi.exists(_id):
-			doc = self._esi.get_variant(_id)['_source']
-                        doc.pop('_id', None)
+    def delete(self, field, ids):
+        cnt_update = 0
+        cnt_delete = 0
+        for _id in ids:
+            # get doc from index based on id
+            if self._esi.exists(_id):
+                doc = self._esi.get_biothing(_id)['_source']
+                doc.pop('_id', None)
                 # case one: only exist target field, or target field/snpeff/vcf, then we need to delete this item
-                if len(set(doc) - set([field, 'snpeff', 'vcf', 'hg19', 'hg38', 'chrom'])) == 0:
+                if len(set(doc) - set([field] + BASE_KEYS)) == 0:
                     es_info = {
                         '_op_type': 'delete',
                         '_index': self._index,
@@ -94,7 +243,7 @@ class ESSyncer():
 
     '''
     def _update_one(self, _id, _patch):
-        doc = self._esi.get_variant(_id)['_source']
+        doc = self._esi.get_biothing(_id)['_source']
         try:
             doc = apply_patch(doc, _patch)
         except jsonpatch.JsonPatchConflict as e:
@@ -110,7 +259,7 @@ class ESSyncer():
     '''
 
     def _update_one(self, _id, _patch, collection, source_collection):
-        doc_es = self._esi.get_variant(_id)['_source']
+        doc_es = self._esi.get_biothing(_id)['_source']
         doc_mongo = self._src[source_collection].find_one(_id)
         doc_es[collection] = doc_mongo[collection]
         doc_es.pop('_id', None)
@@ -137,9 +286,10 @@ class ESSyncer():
         from utils import backend
 
         _es = backend.GeneDocESBackend(self._esi)
-        _db = backend.GeneDocMongoDBBackend(source_collection)
+        _db = backend.GeneDocMongoDBBackend(self._src[source_collection])
 
-        for _id_chunk in iter_n(id_patchs, 100):
+        for _id_patch_chunk in iter_n(id_patchs, 100):
+            _id_chunk = [_id_patch['_id'] for _id_patch in _id_patch_chunk]
             es_docs = _es.mget_from_ids(_id_chunk, step=100)
             db_docs = _db.mget_from_ids(_id_chunk)
             es_docs = dict([(doc['_id'], doc) for doc in es_docs])
@@ -161,15 +311,64 @@ class ESSyncer():
                 }
                 yield es_info
 
-def sync_from_one_diff(index, collection, diff_filepath, validate=False, wait=60, dryrun=False, returncnt=False, save2file=None):
-    sync = ESSyncer(index=index)
+    def delete_scripted(self, field, ids):
+        # same as delete() but decided server-side, without getting docs:
+        # doc is deleted if only base keys are left once field is removed
+        for _id in ids:
+            yield {
+                '_op_type': 'update',
+                '_index': self._index,
+                '_type': self._doc_type,
+                '_id': _id,
+                'script': {'inline': DELETE_SCRIPT, 'lang': SCRIPT_LANG,
+                           'params': {'field': field, 'base_keys': BASE_KEYS}}
+            }
+
+    def update_scripted(self, id_patchs, collection, source_collection):
+        # same as update2() but only source collection's part is sent, and
+        # set server-side. A script replaces the whole field, where a partial
+        # "doc" update would merge objects and keep removed sub-fields
+        for _id_patch_chunk in iter_n(id_patchs, self.step):
+            _id_chunk = [_id_patch['_id'] for _id_patch in _id_patch_chunk]
+            db_docs = self._src[source_collection].find({'_id': {'$in': _id_chunk}}, projection=[collection])
+            db_docs = dict([(doc['_id'], doc) for doc in db_docs])
+            for _id in _id_chunk:
+                doc_mongo = db_docs.get(_id, None)
+                if not doc_mongo or collection not in doc_mongo:
+                    print('id does not exist in mongodb collection:', _id)
+                    continue
+                yield {
+                    '_op_type': 'update',
+                    '_index': self._index,
+                    '_type': self._doc_type,
+                    '_id': _id,
+                    'script': {'inline': UPDATE_SCRIPT, 'lang': SCRIPT_LANG,
+                               'params': {'field': collection, 'value': doc_mongo[collection]}}
+                }
+
+def sync_from_one_diff(index, collection, diff_filepath, validate=False, wait=60, dryrun=False, returncnt=False, save2file=None, thread_count=4, scripted=False, executor=None, slots=None):
+    '''
+    Apply diff file to index: add, delete and update phases run concurrently
+    (they're about different IDs), their bulk requests are sent by
+    thread_count threads, or executor and slots if given (see ESSyncer). If
+    scripted is True, deletes and updates are sent as scripts applied
+    server-side, without reading documents first. Failed bulk actions raise
+    BulkIndexError, once all phases are done. With returncnt, number of
+    actions per phase are returned (successful ones, plus "<phase>_skipped",
+    see IGNORED_STATUSES, unless dryrun)
+    '''
+    sync = ESSyncer(index=index, thread_count=thread_count, executor=executor, slots=slots)
     #sync._index = index
     #sync._esi._index = index
-    diff = loadobj(diff_filepath)
+    diff = load_diff(diff_filepath)
     source_collection = diff['source']
     add_iter = sync.add(source_collection, diff['add'])
-    delete_iter = sync.delete(collection, diff['delete'])
-    update_iter = sync.update2(diff['update'], collection, source_collection)
+    if scripted:
+        delete_iter = sync.delete_scripted(collection, diff['delete'])
+        update_iter = sync.update_scripted(diff['update'], collection, source_collection)
+    else:
+        delete_iter = sync.delete(collection, diff['delete'])
+        update_iter = sync.update2(diff['update'], collection, source_collection)
     t00 = time()
     if save2file:
         from itertools import chain
@@ -178,28 +377,41 @@ def sync_from_one_diff(index, collection, diff_filepath, validate=False, wait=60
             json.dump(op, save2file)
         print("="*20)
         print("Finished! [{}]".format(timesofar(t00)))
+        sync.close()
         return
 
-    print('Adding new {} docs...'.format(len(diff['add'])))
-    t0 = time()
+    print('Adding new {} docs, deleting {} docs, updating {} docs...'.format(
+          len(diff['add']), len(diff['delete']), len(diff['update'])))
+    cnt = {
+        'add': len(diff['add']),
+        'delete': len(diff['delete']),
+        'update': len(diff['update'])
+    }
     if not dryrun:
+        name = os.path.basename(diff_filepath)
+        # docs created meanwhile (add) and already gone (scripted mode) are
+        # expected and only counted, see IGNORED_STATUSES
+        phases = [('add', add_iter, IGNORED_STATUSES['add']),
+                  ('delete', delete_iter, scripted and IGNORED_STATUSES['delete'] or ()),
+                  ('update', update_iter, scripted and IGNORED_STATUSES['update'] or ())]
+        errors = []
         try:
-            bulk(sync._es, add_iter)
-        except:
-            pass
-    print("Done. [{}]".format(timesofar(t0)))
-
-    print('Deleting {} docs'.format(len(diff['delete'])))
-    t0 = time()
-    if not dryrun:
-        bulk(sync._es, delete_iter)
-    print("Done. [{}]".format(timesofar(t0)))
-
-    print('Updating {} docs'.format(len(diff['update'])))
-    t0 = time()
-    if not dryrun:
-        bulk(sync._es, update_iter)
-    print("Done. [{}]".format(timesofar(t0)))
+            with ThreadPoolExecutor(len(phases)) as phase_executor:
+                jobs = [(phase, phase_executor.submit(sync.bulk, actions, ignore_statuses=ignore_statuses,
+                                                      label='[{} {}]'.format(name, phase)))
+                        for (phase, actions, ignore_statuses) in phases]
+                for (phase, job) in jobs:
+                    try:
+                        cnt[phase], cnt[phase + '_skipped'] = job.result()
+                    except BulkIndexError as e:
+                        errors.extend(e.errors)
+                        continue
+                    print("{} done: {} docs, {} skipped [{}]".format(phase, cnt[phase], cnt[phase + '_skipped'],
+                                                                    timesofar(t00)))
+        finally:
+            sync.close()
+        if errors:
+            raise BulkIndexError('{}: {} document(s) failed'.format(name, len(errors)), errors)
 
     # add flush and refresh
     try:
@@ -214,11 +426,6 @@ def sync_from_one_diff(index, collection, diff_filepath, validate=False, wait=60
     print("Finished! [{}]".format(timesofar(t00)))
 
     if returncnt:
-        cnt = {
-            'add': len(diff['add']),
-            'delete': len(diff['delete']),
-            'update': len(diff['update'])
-        }
         return cnt
 
     if validate:
@@ -242,28 +449,56 @@ def sync_from_one_diff(index, collection, diff_filepath, validate=False, wait=60
         temp_collection = collection + '_temp_' + get_random_string()
         sync._src[temp_collection].drop()
         load_source(temp_collection, src_data=data)
-        c1 = get_backend(source_collection, 'mongodb')
-        c2 = get_backend(temp_collection, 'mongodb')
+        from utils.backend import GeneDocMongoDBBackend
+        c1 = GeneDocMongoDBBackend(sync._src[source_collection])
+        c2 = GeneDocMongoDBBackend(sync._src[temp_collection])
         diff_result = diff_collections(c1, c2, use_parallel=False)
         sync._src[temp_collection].drop()
         print("Done. [{}]".format(t0))
         return diff_result
 
-def sync_from_folder(index, collection, diff_folder, validate=False, wait=60, save2file=None):
+def sync_from_folder(index, collection, diff_folder, validate=False, wait=60, save2file=None, thread_count=4, scripted=False, max_files=2):
+    '''
+    Apply all diff files from diff_folder to index, max_files files at a time.
+    Diff files are expected to be about different IDs (like batches written
+    by diff_collections_batches()). thread_count is the max number of
+    concurrent bulk requests, whatever the number of files being applied,
+    and at most thread_count * 2 chunks of actions are pending at a time.
+    '''
     cnt_add = 0
     cnt_delete = 0
     cnt_update = 0
     if save2file:
         dump_f = open(save2file, 'w')
+        # one dump file, written one diff file after the other
+        max_files = 1
     else:
         dump_f = None
-    for input_file in sorted(glob.glob(os.path.join(diff_folder, '*.pyobj'))):
-        print("*"*50)
-        print("Start processing {} from {}".format(input_file, diff_folder))
-        cnt = sync_from_one_diff(index, collection, input_file, validate=validate, wait=wait, returncnt=True, save2file=dump_f)
-        if cnt:
-            cnt_add += cnt['add']
-            cnt_delete += cnt['delete']
-            cnt_update += cnt['update']
+    failed = []
+    # shared by all files and phases, so memory doesn't grow with max_files
+    bulk_slots = BoundedSemaphore(thread_count * 2)
+    with ThreadPoolExecutor(thread_count) as bulk_executor, ThreadPoolExecutor(max_files) as file_executor:
+        jobs = []
+        input_files = glob.glob(os.path.join(diff_folder, '*.pyobj')) + \
+                      glob.glob(os.path.join(diff_folder, '*' + DIFF_EXT))
+        for input_file in sorted(input_files):
+            print("Queuing {} from {}".format(input_file, diff_folder))
+            jobs.append((input_file, file_executor.submit(sync_from_one_diff, index, collection, input_file,
+                validate=validate, wait=wait, returncnt=True, save2file=dump_f, thread_count=thread_count,
+                scripted=scripted, executor=bulk_executor, slots=bulk_slots)))
+        for (input_file, job) in jobs:
+            try:
+                cnt = job.result()
+            except Exception as e:
+                print("Error processing {}: {}".format(input_file, e))
+                failed.append(input_file)
+                continue
+            if cnt:
+                cnt_add += cnt['add']
+                cnt_delete += cnt['delete']
+                cnt_update += cnt['update']
     if dump_f:
         dump_f.close()
+    print("Diff files applied: {} added, {} deleted, {} updated".format(cnt_add, cnt_delete, cnt_update))
+    if failed:
+        raise Exception("Failed to apply diff files: {}".format(failed))
@@ -4,7 +4,10 @@ from boto import connect_s3
 
 import config
 import biothings.dataindex.indexer as indexer
+import biothings.utils.mongo as mongo
+from biothings.utils.mongo import doc_feeder
 from biothings.utils.aws import send_s3_file
+from utils.idlookup import build_id_lookup, ID_LOOKUP_EXT
 
 
 class VariantIndexer(indexer.Indexer):
@@ -19,6 +22,13 @@ class VariantIndexer(indexer.Indexer):
         mapping["properties"]["observed"] = {
             "type": "boolean",
             'include_in_all': False}
+        # position bins (see utils.hgvs.get_pos_bins()), set at post-merge,
+        # used by interval queries before checking actual start/end
+        for assembly in config.SUPPORTED_ASSEMBLIES:
+            props = mapping["properties"].setdefault(assembly,{}).setdefault("properties",{})
+            props["bin"] = {
+                "type": "integer",
+                'include_in_all': False}
 
         return mapping
 
@@ -54,3 +64,25 @@ class VariantIndexer(indexer.Indexer):
             self.logger.error("Failed to upload cache file '%s' to s3: %s" % (cache_file,e), extra={"notify":True})
             raise
 
+
+def build_target_id_lookup(target_name, batch_size=10000, upload=False, logger=config.logger):
+    """
+    Build secondary ID (rsid, RCV accession, ...) to _id lookup file for
+    target_name, in CACHE_FOLDER. Web processes can use it (see ID_LOOKUP_FILES
+    in web config) to get docs by _id for these IDs. If upload is True, file
+    is also sent to s3 (public), for web hosts to fetch it.
+    Not part of indexing (full scan of target), run it as a separate step.
+    """
+    fields = [scope for (_, scope) in config.ANNOTATION_ID_REGEX_LIST]
+    lookup_file = os.path.join(config.CACHE_FOLDER,target_name + ID_LOOKUP_EXT)
+    logger.info("Building ID lookup file '%s' for fields %s" % (lookup_file,fields))
+    col = mongo.get_target_db()[target_name]
+    query = {"$or" : [{field : {"$exists" : True}} for field in fields]}
+    docs = doc_feeder(col, step=batch_size, inbatch=False, query=query, fields=fields, logger=logger)
+    nkeys = build_id_lookup(docs, fields, lookup_file)
+    logger.info("ID lookup file '%s' built, %d keys" % (lookup_file,nkeys))
+    if upload:
+        s3path = os.path.basename(lookup_file)
+        send_s3_file(lookup_file, s3path, overwrite=True, permissions="public-read")
+        logger.info("ID lookup file '%s' uploaded to s3" % lookup_file)
+    return lookup_file
@@ -1,14 +1,47 @@
 import re, os, sys, pickle, datetime
-import subprocess
+import subprocess, threading, queue
 
 from biothings.utils.dataload import unlist, dict_sweep
-from utils.validate import bit_to_nuc
+from utils.validate import bits_to_seq, VALID_REF_NUCS
+from utils.genome import GenomeStore, is_genome_store
 from biothings.utils.common import loadobj
-from utils.hgvs import get_hgvs_from_vcf, trim_delseq_from_hgvs
+from utils.hgvs import get_hgvs_from_vcf, trim_delseq_from_hgvs, parse_many
 
 from biothings import config
 logging = config.logger
 
+VCF_HEADER = '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO'
+# record sent to pooled snpEff workers after each batch, "%s" being
+# END_OF_BATCH_ID followed by the batch number
+END_OF_BATCH_ID = "__end_of_batch_"
+END_OF_BATCH_LINE = '1\t10000\t.\tA\tG\t.\t.\t.\t# hgvs:%s'
+
+
+def clean_stderr(stderr):
+    # they print some news message on stderr, bad idea when we use it to detect errors.
+    # try to get rid of it
+    if "NEW VERSION!" in stderr:
+        stderr = stderr.splitlines()
+        start = stderr.index("NEW VERSION!")
+        # message is 5 lines long (hopefully..)
+        end = start + 5
+        stderr = stderr[:start] + stderr[end:]
+        # rebuild and clean any empty lines
+        stderr = "\n".join(stderr).strip()
+    return stderr
+
+
+def parse_lof_nmd(info):
+    """Parse LOF or NMD INFO field, like 'LOF=(PTEN|PTEN|1|1.00)'"""
+    info = info[info.index('(')+1:info.index(')')]
+    (gene_id, genename, nt, pt) = info.split('|')
+    return {
+        "gene_id": gene_id,
+        "genename": genename,
+        "number_of_transcripts_in_gene": nt,
+        "percent_of_transcripts_affected": pt
+    }
+
 
 class VCFConstruct(object):
 
@@ -20,180 +53,143 @@ class VCFConstruct(object):
     def load_chr_data(self):
         self.logger.info("\tLoading chromosome data from '%s'..." % self.genome)
         try:
-            self._chr_data = loadobj(self.genome)
+            if is_genome_store(self.genome):
+                # mmap'ed, nothing actually loaded in memory
+                self._chr_data = GenomeStore(self.genome)
+            else:
+                self._chr_data = loadobj(self.genome)
         except Exception as e:
             self.logger.info(e)
             raise
         self.logger.info("Done.")
 
-    def snp_hgvs_id_parser(self, id):
-        '''get chr, pos, ref, alt from hgvs_id'''
-        pat = 'chr(\w+):g\.(\d+)(\w)\>(\w)'
-        mat = re.match(pat, id)
-        if mat:
-            r = mat.groups()
-            return r
-
-    def del_hgvs_id_parser_interval(self, id):
-        pat = 'chr(\w+):g\.(\d+)\_(\d+)del'
-        mat = re.match(pat, id)
-        if mat:
-            r = mat.groups()
-            return r
-
-    def del_hgvs_id_parser(self, id):
-        pat = 'chr(\w+):g\.(\d+)del'
-        mat = re.match(pat, id)
-        if mat:
-            r = mat.groups()
-            return r
-
-    def ins_hgvs_id_parser(self, id):
-        pat = 'chr(\w+):g\.(\d+)\_(\d+)ins(\w+)'
-        mat = re.match(pat, id)
-        if mat:
-            r = mat.groups()
-            return r
-
-    def delins_hgvs_id_parser(self, id):
-        pat = 'chr(\w+):g\.(\d+)\_(\d+)delins(\w+)'
-        mat = re.match(pat, id)
-        if mat:
-            r = mat.groups()
-            return r
+    def ref_fetcher(self, chrom):
+        '''return a function fetching reference sequence from start to end
+           (1-based, inclusive) on chromosome chrom. Chromosome data is looked
+           up once, the returned function can be used to resolve many ranges.
+           KeyError is raised if there's no data for chrom, ValueError when
+           the sequence can't be decoded.'''
+        if self._chr_data is None:
+            self.load_chr_data()
+        if isinstance(self._chr_data, GenomeStore):
+            store = self._chr_data
+            if not chrom in store:
+                raise KeyError(chrom)
+            def fetch(start, end):
+                ref = store.get_seq(chrom, start, end)
+                invalid = set(ref).difference(VALID_REF_NUCS)
+                if invalid:
+                    raise ValueError("Cannot decode nucleotide(s): %s" % repr(sorted(invalid)))
+                return ref
+        else:
+            chr_bit = self._chr_data[chrom]
+            def fetch(start, end):
+                return bits_to_seq(chr_bit, start, end)
+        return fetch
+
+    def get_ref(self, chrom, start, end):
+        '''return reference sequence from start to end (1-based, inclusive)'''
+        return self.ref_fetcher(chrom)(start, end)
 
     def snp_vcf_constructor(self, hgvs):
         '''construct a VCF file based on chr, pos, ref, alt information'''
-        chrom = hgvs[0]
+        chrom = hgvs.chrom
         if chrom == 'MT':
             chrom = 'M'
-        pos = hgvs[1]
-        ref = hgvs[2]
-        alt = hgvs[3]
-        vcf = {"chrom": str(chrom), "position": str(pos), "ref": ref, "alt": alt}
+        vcf = {"chrom": str(chrom), "position": str(hgvs.start), "ref": hgvs.ref, "alt": hgvs.alt}
         return vcf
 
-    def del_vcf_constructor(self, hgvs):
-        if self._chr_data is None:
-            self.load_chr_data()
-        chrom = hgvs[0]
-        pos = int(hgvs[1]) - 1
-        # len=2 was a single del, len=3 was internval del
-        if len(hgvs) == 2:
-            end = int(hgvs[1])
-        else:
-            end = int(hgvs[2])
-        chr_bit = self._chr_data[str(chrom)]
-        ref = ''
-        for i in range(pos, end+1):
-            try:
-                nuc_chr_bit = chr_bit[i*4-4:i*4]
-                nuc_chr = bit_to_nuc(nuc_chr_bit)
-                ref += nuc_chr
-            except Exception as e:
-                self.logger.warning("Couldn't extract nucleotide from bits with HGVS %s: %s" % (repr(hgvs),e))
-                return None
+    def del_vcf_constructor(self, hgvs, fetch=None):
+        chrom = hgvs.chrom
+        pos = hgvs.start - 1
+        # no end for single del
+        end = hgvs.end or hgvs.start
+        fetch = fetch or self.ref_fetcher(str(chrom))
+        try:
+            ref = fetch(pos, end)
+        except ValueError as e:
+            self.logger.warning("Couldn't extract nucleotide from bits with HGVS %s: %s" % (repr(hgvs),e))
+            return None
         alt = ref[0]
         if chrom == 'MT':
             chrom = 'M'
         vcf = {"chrom": str(chrom), "position": str(pos), "ref": ref, "alt": alt}
         return vcf
 
-    def ins_vcf_constructor(self, hgvs):
-        if self._chr_data is None:
-            self.load_chr_data()
-        chrom = hgvs[0]
-        pos = int(hgvs[1])
-        chr_bit = self._chr_data[str(chrom)]
-        nuc_chr_bit = chr_bit[pos*4-4:pos*4]
+    def ins_vcf_constructor(self, hgvs, fetch=None):
+        chrom = hgvs.chrom
+        pos = hgvs.start
+        fetch = fetch or self.ref_fetcher(str(chrom))
         try:
-            ref = bit_to_nuc(nuc_chr_bit)
-        except Exception as e:
+            ref = fetch(pos, pos)
+        except ValueError as e:
             self.logger.warning("Couldn't extract nucleotide from bits with HGVS %s: %s" % (repr(hgvs),e))
             return None
-        alt = hgvs[3]
-        alt = ref + alt
+        alt = ref + hgvs.alt
         if chrom == 'MT':
             chrom = 'M'
         vcf = {"chrom": str(chrom), "position": str(pos), "ref": ref, "alt": alt}
         return vcf
 
-    def delins_vcf_constructor(self, hgvs):
-        if self._chr_data is None:
-            self.load_chr_data()
-        chrom = hgvs[0]
-        pos = int(hgvs[1])
-        end = int(hgvs[2])
-        chr_bit = self._chr_data[str(chrom)]
-        ref = ''
-        for i in range(pos, end+1):
-            try:
-                nuc_chr_bit = chr_bit[i*4-4:i*4]
-                nuc_chr = bit_to_nuc(nuc_chr_bit)
-                ref += nuc_chr
-            except Exception as e:
-                self.logger.warning("Couldn't extract nucleotide from bits with HGVS %s: %s" % (repr(hgvs),e))
-                return None
-        alt = hgvs[3]
+    def delins_vcf_constructor(self, hgvs, fetch=None):
+        chrom = hgvs.chrom
+        pos = hgvs.start
+        end = hgvs.end
+        fetch = fetch or self.ref_fetcher(str(chrom))
+        try:
+            ref = fetch(pos, end)
+        except ValueError as e:
+            self.logger.warning("Couldn't extract nucleotide from bits with HGVS %s: %s" % (repr(hgvs),e))
+            return None
+        alt = hgvs.alt
         if chrom == 'MT':
             chrom = 'M'
         vcf = {"chrom": str(chrom), "position": str(pos), "ref": ref, "alt": alt}
         return vcf
 
+    def get_constructor(self, hgvs):
+        '''return VCF constructor for a HgvsInfo record, None if
+        that kind of variant isn't supported'''
+        if hgvs.kind == "snp":
+            return self.snp_vcf_constructor
+        # deleted sequence isn't expected in ID
+        elif hgvs.kind == "del" and not hgvs.ref:
+            return self.del_vcf_constructor
+        elif hgvs.kind == "ins" and hgvs.end and hgvs.alt:
+            return self.ins_vcf_constructor
+        elif hgvs.kind == "delins" and hgvs.end and hgvs.alt:
+            return self.delins_vcf_constructor
+
     def build_vcfs(self, hgvs_ids):
         '''load data'''
         # extract each hgvs_id from list, transform into vcf format
         hgvs_vcfs = {}
-        for hgvs_id in hgvs_ids:
-            if '>' in hgvs_id:
-                hgvs_info = self.snp_hgvs_id_parser(hgvs_id)
-                if not hgvs_info:
-                    continue
-                vcf = self.snp_vcf_constructor(hgvs_info)
-                if not vcf:
-                    continue
-                hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : vcf}
-
-            elif hgvs_id.endswith('del') and '_' in hgvs_id:
-                hgvs_info = self.del_hgvs_id_parser_interval(hgvs_id)
-                if not hgvs_info:
-                    continue
-                vcf = self.del_vcf_constructor(hgvs_info)
-                if not vcf:
-                    continue
-                hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : vcf}
-
-            elif hgvs_id.endswith('del') and '_' not in hgvs_id:
-                hgvs_info = self.del_hgvs_id_parser(hgvs_id)
-                if not hgvs_info:
-                    continue
-                vcf = self.del_vcf_constructor(hgvs_info)
-                if not vcf:
-                    continue
-                hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : vcf}
-
-            elif 'ins' in hgvs_id and 'del' not in hgvs_id:
-                hgvs_info = self.ins_hgvs_id_parser(hgvs_id)
-                if not hgvs_info:
-                    continue
-                vcf = self.ins_vcf_constructor(hgvs_info)
-                if not vcf:
-                    continue
-                hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : vcf}
+        # indels need reference sequence, group them per chromosome
+        # so all refs are resolved in one pass per chromosome
+        indels = {}
+        hgvs_ids = list(hgvs_ids)
+        for hgvs_id,hgvs_info in zip(hgvs_ids,parse_many(hgvs_ids)):
+            constructor = hgvs_info and self.get_constructor(hgvs_info)
+            if not constructor:
+                self.logger.info('%s: beyond current capacity, skip it' % hgvs_id)
+                continue
+            if hgvs_info.kind == "snp":
+                hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : constructor(hgvs_info)}
+            else:
+                indels.setdefault(str(hgvs_info.chrom),[]).append((hgvs_id,hgvs_info,constructor))
 
-            elif 'delins' in hgvs_id:
-                hgvs_info = self.delins_hgvs_id_parser(hgvs_id)
-                if not hgvs_info:
-                    continue
-                vcf = self.delins_vcf_constructor(hgvs_info)
+        for chrom in indels:
+            try:
+                fetch = self.ref_fetcher(chrom)
+            except KeyError:
+                self.logger.warning("No reference data for chromosome '%s', skip %d HGVS IDs" % (chrom,len(indels[chrom])))
+                continue
+            for hgvs_id,hgvs_info,constructor in indels[chrom]:
+                vcf = constructor(hgvs_info,fetch=fetch)
                 if not vcf:
                     continue
                 hgvs_vcfs[hgvs_id] = {"_id" : hgvs_id, "vcf" : vcf}
 
-            else:
-                self.logger.info('%s: beyond current capacity, skip it' % hgvs_id)
-                continue
-
         return hgvs_vcfs
 
 
@@ -213,11 +209,9 @@ class SnpeffAnnotator(object):
         if not hgvs_info["chrom"] in [str(i) for i in range(1,23)] + ["X","Y","M"]:
             raise ValueError("Invalid chromosome in HGVS info: %s" % repr(hgvs_info))
 
-    def annotate(self,hgvs_vcfs):
-        """hgvs_vcfs: list of {"vcf": {}, "_id": ""}"""
-
-        # title of vcf
-        vcf_stdin = ['#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+    def build_vcf_lines(self, hgvs_vcfs):
+        """Return a list of (hgvs_id, vcf_line) to send to snpEff"""
+        lines = []
         for hgvs_id in hgvs_vcfs:
             vcf = hgvs_vcfs[hgvs_id]["vcf"]
             try:
@@ -228,25 +222,57 @@ class SnpeffAnnotator(object):
             # add hgvs ID at the end so we can match for sure which annotations correspond to which ID 
             # instead of rebuild it from VCF info (they can be different)
             # this comment will be at the first position in the result line
-            vcf_stdin.append(str(vcf["chrom"]) + '\t' + str(vcf["position"]) + '\t' + '.' + '\t' + vcf["ref"] + '\t' + vcf["alt"] + '\t.\t.\t.' + "\t# hgvs:" + hgvs_id)
+            lines.append((hgvs_id,str(vcf["chrom"]) + '\t' + str(vcf["position"]) + '\t' + '.' + '\t' + vcf["ref"] + '\t' + vcf["alt"] + '\t.\t.\t.' + "\t# hgvs:" + hgvs_id))
+        return lines
+
+    def close(self):
+        # one snpEff process per batch, nothing to release
+        pass
+
+    def annotate(self,hgvs_vcfs):
+        """hgvs_vcfs: list of {"vcf": {}, "_id": ""}"""
+
+        # title of vcf
+        vcf_stdin = [VCF_HEADER] + [line for _,line in self.build_vcf_lines(hgvs_vcfs)]
 
         if (len(vcf_stdin) - 1) == 0:
             self.logger.info("No HGVS ID as input (previously filtered out)")
             return
         self.logger.info("Running '%s' on %d HGVS IDs" % (self.snpeff_cmd,len(vcf_stdin)-1)) # -1: header
-        proc = subprocess.Popen(self.snpeff_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        (stdout, stderr) = proc.communicate("\n".join(vcf_stdin).encode())
-        stderr = stderr.decode()
-        # they print some news message on stderr, bad idea when we use it to detect errors.
-        # try to get rid of it
-        if "NEW VERSION!" in stderr:
-            stderr = stderr.splitlines()
-            start = stderr.index("NEW VERSION!")
-            # message is 5 lines long (hopefully..)
-            end = start + 5
-            stderr = stderr[:start] + stderr[end:]
-            # rebuild and clean any empty lines
-            stderr = "\n".join(stderr).strip()
+        proc = subprocess.Popen(self.snpeff_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+        # output is parsed as it comes, line by line, instead of decoding
+        # and splitting the whole batch at once. stdin and stderr are
+        # handled by threads so none of the pipes can fill up and stall snpEff
+        stderr = []
+        def feed():
+            try:
+                for line in vcf_stdin:
+                    proc.stdin.write(line + "\n")
+                proc.stdin.close()
+            except BrokenPipeError:
+                # snpEff died, reported from stderr below
+                pass
+        def drain():
+            stderr.extend(proc.stderr)
+        threads = [threading.Thread(target=feed,daemon=True),
+                   threading.Thread(target=drain,daemon=True)]
+        for t in threads:
+            t.start()
+        try:
+            for vcf_line in proc.stdout:
+                doc = self.parse_line(vcf_line.rstrip("\n"))
+                if doc:
+                    yield doc
+            proc.wait()
+            for t in threads:
+                t.join()
+        finally:
+            # consumer stopped early or parsing failed
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        stderr = clean_stderr("".join(stderr))
         if stderr != '':
             fn = "snpeff_err_%s.pickle" % datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
             pickle.dump({"input" : hgvs_vcfs,
@@ -254,131 +280,235 @@ class SnpeffAnnotator(object):
                          "stderr" : stderr},open(fn,"wb"))
             raise Exception("Something went wrong while generating snpeff annotation (see dump %s for more):\n%s" % (fn,stderr))
 
-        strout = stdout.decode()
-        vcf_stdout_raw = strout.splitlines()
-        for vcf_line in vcf_stdout_raw:
-            if vcf_line.startswith('#'):
-                continue
-            elif vcf_line == '':
-                continue
-            else:
-                fromi = vcf_line.index("#")
-                str_id = vcf_line[fromi:]
-                hgvs_info = str_id.replace("#","").strip().split(":")
-                # extract HGVS
-                assert hgvs_info[0] == "hgvs", "Can't find HGVS ID in VCF line '%s'" % repr(vcf_line)
-                hgvs_id = ":".join(hgvs_info[1:])
-                # -1: remove the tab char also, before #
-                vcf_line = vcf_line[:fromi-1]
-                # assume the following item is 'ANN'
-                ann_info = vcf_line.split(';')[0]
-                ann = []
-                # Multiple annotations per VCF line
-                for item in ann_info.split(','):
-                    if len(item.split('|')) > 1:
-                        (effect, putative_impact, gene_name, gene_id, feature_type, feature_id) = item.split('|')[1:7]
-                        (transcript_biotype, exon, hgvs_coding, hgvs_protein, cdna, cds, protein, distance_to_feature) = item.split('|')[7:15]
-                        if cdna:
-                            (cdna_position, cdna_len) = cdna.split('/')
-                        else:
-                            cdna_position = None
-                            cdna_len = None
-                        if cds:
-                            (cds_position, cds_len) = cds.split('/')
-                        else:
-                            cds_position = None
-                            cds_len = None
-                        if protein:
-                            (protein_position, protein_len) = protein.split('/')
-                        else:
-                            protein_position = None
-                            protein_len = None
-                        if exon:
-                            (rank, total) = exon.split('/')
-                        else:
-                            rank = None
-                            total = None
-                        ann.append({
-                            "effect": effect,
-                            "putative_impact": putative_impact,
-                            "genename": gene_name,
-                            "gene_id": gene_id,
-                            "feature_type": feature_type,
-                            "feature_id": feature_id,
-                            "transcript_biotype": transcript_biotype,
-                            "rank": rank,
-                            "total": total,
-                            "hgvs_c": trim_delseq_from_hgvs(hgvs_coding), # trim long sequence
-                            "hgvs_p": hgvs_protein,
-                            "cdna": {
-                                "position": cdna_position,
-                                "length": cdna_len
-                            },
-                            "cds": {
-                                "position": cds_position,
-                                "length": cds_len
-                            },
-                            "protein": {
-                                "position": protein_position,
-                                "length": protein_len
-                            },
-                            "distance_to_feature": distance_to_feature
-                        })
-                # not all annotations include lof & nmd information. Set them to 'None' as default
-                lof = None
-                nmd = None
-                # the case that annotation include 'ann' & 'lof' & 'nmd'
-                if len(vcf_line.split(';')) == 3:
-                    (lof_info, nmd_info) = vcf_line.split(';')[1:3]
-                    # assume the second item is 'lof'
-                    assert lof_info.startswith('LOF')
-                    # the information to be parsed is like this: 'LOF=(PTEN|PTEN|1|1.00)'
-                    lof_info = lof_info.split('(')[1].split(')')[0]
-                    nmd_info = nmd_info.split('(')[1].split(')')[0]
-                    (id_lof, name_lof, nt_lof, pt_lof) = lof_info.split('|')
-                    (id_nmd, name_nmd, nt_nmd, pt_nmd) = nmd_info.split('|')
-                    lof = {
-                        "gene_id": id_lof,
-                        "genename": name_lof,
-                        "number_of_transcripts_in_gene": nt_lof,
-                        "percent_of_transcripts_affected": pt_lof
-                    }
-                    nmd = {
-                        "gene_id": id_nmd,
-                        "genename": name_nmd,
-                        "number_of_transcripts_in_gene": nt_nmd,
-                        "percent_of_transcripts_affected": pt_nmd
-                    }
-                # the case that annotation include 'ann' & 'lof or nmd'
-                elif len(vcf_line.split(';')) == 2:
-                    (ann_info, idk_info) = vcf_line.split(';')
-                    if idk_info.startswith('LOF'):
-                        lof_info = idk_info.split('(')[1].split(')')[0]
-                        (id_lof, name_lof, nt_lof, pt_lof) = lof_info.split('|')
-                        lof = {
-                            "gene_id": id_lof,
-                            "genename": name_lof,
-                            "number_of_transcripts_in_gene": nt_lof,
-                            "percent_of_transcripts_affected": pt_lof
-                        }
-                    else:
-                        nmd_info = idk_info.split('(')[1].split(')')[0]
-                        (id_nmd, name_nmd, nt_nmd, pt_nmd) = nmd_info.split('|')
-                        nmd = {
-                            "gene_id": id_nmd,
-                            "genename": name_nmd,
-                            "number_of_transcripts_in_gene": nt_nmd,
-                            "percent_of_transcripts_affected": pt_nmd
-                        }
-                (chrom, pos, _id, ref, alt) = ann_info.split('\t')[0:5]
-                one_snp_json = {
-                    "_id": hgvs_id,
-                    "snpeff": {
-                        "ann": ann,
-                        "lof": lof,
-                        "nmd": nmd,
+    def parse_line(self, vcf_line):
+        """Parse one line of snpEff output, return None if the line
+        doesn't hold any annotation (header, empty line). Each field is
+        split only once: INFO on ';' (ANN, then LOF and/or NMD), ANN on ','
+        and each annotation on '|'."""
+        if vcf_line.startswith('#') or vcf_line == '':
+            return None
+        vcf_line, _, str_id = vcf_line.partition("#")
+        hgvs_info = str_id.strip().split(":",1)
+        # extract HGVS
+        assert hgvs_info[0] == "hgvs", "Can't find HGVS ID in VCF line '%s'" % repr(vcf_line)
+        hgvs_id = hgvs_info[1]
+        # -1: remove the tab char also, before #
+        info = vcf_line[:-1].rsplit('\t',1)[-1].split(';')
+        # assume the first item is 'ANN'
+        ann = []
+        # Multiple annotations per VCF line
+        for item in info[0].split(','):
+            fields = item.split('|')
+            if len(fields) > 1:
+                (effect, putative_impact, gene_name, gene_id, feature_type, feature_id,
+                 transcript_biotype, exon, hgvs_coding, hgvs_protein, cdna, cds, protein,
+                 distance_to_feature) = fields[1:15]
+                (cdna_position, cdna_len) = cdna.split('/') if cdna else (None, None)
+                (cds_position, cds_len) = cds.split('/') if cds else (None, None)
+                (protein_position, protein_len) = protein.split('/') if protein else (None, None)
+                (rank, total) = exon.split('/') if exon else (None, None)
+                ann.append({
+                    "effect": effect,
+                    "putative_impact": putative_impact,
+                    "genename": gene_name,
+                    "gene_id": gene_id,
+                    "feature_type": feature_type,
+                    "feature_id": feature_id,
+                    "transcript_biotype": transcript_biotype,
+                    "rank": rank,
+                    "total": total,
+                    "hgvs_c": trim_delseq_from_hgvs(hgvs_coding), # trim long sequence
+                    "hgvs_p": hgvs_protein,
+                    "cdna": {
+                        "position": cdna_position,
+                        "length": cdna_len
                     },
-                }
-                snpeff_json = dict_sweep(unlist(one_snp_json), vals=['', None])
+                    "cds": {
+                        "position": cds_position,
+                        "length": cds_len
+                    },
+                    "protein": {
+                        "position": protein_position,
+                        "length": protein_len
+                    },
+                    "distance_to_feature": distance_to_feature
+                })
+        # not all annotations include lof & nmd information. Set them to 'None' as default
+        lof = None
+        nmd = None
+        # annotation can include 'lof' and/or 'nmd', in that order
+        if len(info) <= 3:
+            for idk_info in info[1:]:
+                if idk_info.startswith('LOF'):
+                    lof = parse_lof_nmd(idk_info)
+                else:
+                    nmd = parse_lof_nmd(idk_info)
+        one_snp_json = {
+            "_id": hgvs_id,
+            "snpeff": {
+                "ann": ann,
+                "lof": lof,
+                "nmd": nmd,
+            },
+        }
+        snpeff_json = dict_sweep(unlist(one_snp_json), vals=['', None])
+
+        return snpeff_json
+
+
+class SnpeffWorker(object):
+    """
+    Long-lived snpEff process. VCF lines are streamed to its stdin, and
+    annotated lines are read back from stdout by a reader thread and
+    pushed to "outq" as (worker,line). When the process exits, (worker,None)
+    is sent so the consumer can detect it.
+    """
+
+    def __init__(self, cmd, outq, num=0, logger=logging):
+        self.snpeff_cmd = cmd
+        self.outq = outq
+        self.num = num
+        self.logger = logger
+        self.proc = None
+        self.stderr = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.logger.info("Starting snpEff worker #%d: '%s'" % (self.num,self.snpeff_cmd))
+        self.proc = subprocess.Popen(self.snpeff_cmd, stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        threading.Thread(target=self._read_stdout,daemon=True).start()
+        threading.Thread(target=self._read_stderr,daemon=True).start()
+        self.write([VCF_HEADER])
+
+    def is_alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _read_stdout(self):
+        for line in self.proc.stdout:
+            self.outq.put((self,line.decode().rstrip("\n")))
+        self.outq.put((self,None))
+
+    def _read_stderr(self):
+        for line in self.proc.stderr:
+            self.stderr.append(line.decode().rstrip("\n"))
+
+    def get_stderr(self):
+        return clean_stderr("\n".join(self.stderr))
+
+    def write(self, lines):
+        # stdin/stdout are both pipes, writing must not block the consumer
+        # (or snpEff would stall on a full stdout pipe), so callers should
+        # run this from a thread
+        with self.lock:
+            try:
+                for line in lines:
+                    self.proc.stdin.write((line + "\n").encode())
+                self.proc.stdin.flush()
+            except BrokenPipeError:
+                # reader thread will report process termination
+                pass
+
+    def stop(self):
+        if self.proc is None:
+            return
+        self.logger.info("Stopping snpEff worker #%d" % self.num)
+        try:
+            self.proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+
+class SnpeffAnnotatorPool(SnpeffAnnotator):
+    """
+    Same as SnpeffAnnotator but keeps "size" snpEff processes running between
+    batches, so JVM startup and genome database loading only happen once.
+    VCF lines are dispatched across workers and results are matched back to
+    their HGVS IDs using the "# hgvs:" comment, as they come. Each worker's
+    chunk ends with an end-of-batch record: once it's returned, all lines sent
+    before it have been processed (snpEff must not run with "-t", which
+    buffers and can reorder records).
+    """
 
-                yield snpeff_json
+    # seconds to wait for any output from workers before giving up
+    TIMEOUT = 600
+
+    def __init__(self, cmd, size, timeout=TIMEOUT, logger=logging):
+        super(SnpeffAnnotatorPool,self).__init__(cmd,logger=logger)
+        self.size = size
+        self.timeout = timeout
+        self.outq = queue.Queue()
+        self.workers = []
+        self.batch_num = 0
+
+    def start(self):
+        self.workers = [SnpeffWorker(self.snpeff_cmd,self.outq,num=i,logger=self.logger) \
+                for i in range(self.size)]
+        for worker in self.workers:
+            worker.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+    def abort(self, hgvs_vcfs, pending, stderr, msg):
+        fn = "snpeff_err_%s.pickle" % datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        pickle.dump({"input" : hgvs_vcfs,
+                     "pending" : set().union(*pending.values()),
+                     "stderr" : stderr},open(fn,"wb"))
+        # workers are killed, not stopped: they may never read stdin again
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.proc.kill()
+        self.close()
+        raise Exception("%s (see dump %s for more):\n%s" % (msg,fn,stderr))
+
+    def annotate(self,hgvs_vcfs):
+        """hgvs_vcfs: list of {"vcf": {}, "_id": ""}"""
+        lines = self.build_vcf_lines(hgvs_vcfs)
+        if not lines:
+            self.logger.info("No HGVS ID as input (previously filtered out)")
+            return
+        if not self.workers or not all([w.is_alive() for w in self.workers]):
+            self.close()
+            self.start()
+        self.logger.info("Streaming %d HGVS IDs to %d snpEff workers" % (len(lines),len(self.workers)))
+        self.batch_num += 1
+        end_id = "%s%d" % (END_OF_BATCH_ID,self.batch_num)
+        # per worker, IDs sent and not returned yet
+        pending = {}
+        for i,worker in enumerate(self.workers):
+            chunk = lines[i::len(self.workers)]
+            if not chunk:
+                continue
+            pending[worker] = set([hgvs_id for hgvs_id,_ in chunk])
+            chunk = [line for _,line in chunk] + [END_OF_BATCH_LINE % end_id]
+            threading.Thread(target=worker.write,args=(chunk,),daemon=True).start()
+        while pending:
+            try:
+                worker,vcf_line = self.outq.get(timeout=self.timeout)
+            except queue.Empty:
+                self.abort(hgvs_vcfs,pending,"\n".join([w.get_stderr() for w in pending]),
+                        "No output from snpEff workers for %ss while generating snpeff annotation" % self.timeout)
+            if not worker in pending:
+                # results left over from a previous, interrupted batch, or
+                # worker exiting after it's done with this one: restarted
+                # on next batch if needed
+                continue
+            if vcf_line is None:
+                self.abort(hgvs_vcfs,pending,worker.get_stderr(),
+                        "snpEff worker #%d terminated while generating snpeff annotation" % worker.num)
+            doc = self.parse_line(vcf_line)
+            if not doc:
+                continue
+            if doc["_id"] == end_id:
+                missing = pending.pop(worker)
+                if missing:
+                    self.logger.warning("snpEff worker #%d returned no annotation for %d HGVS IDs, skip them: %s" % \
+                            (worker.num,len(missing),sorted(missing)[:10]))
+            elif doc["_id"] in pending[worker]:
+                pending[worker].remove(doc["_id"])
+                yield doc
@@ -1,30 +1,80 @@
+from pymongo import UpdateOne, DeleteOne
+
 from biothings.utils.mongo import get_src_db
-from biothings.utils.common import loadobj
+from biothings.utils.common import iter_n
+from utils.diffstream import load_diff
+from utils.aggregation import ROOT_KEYS
 
 
 class MongoSync():
-    def __init__(self):
+    def __init__(self, batch_size=10000):
         self._src = get_src_db()
+        # number of IDs fetched with one $in query, and of operations sent
+        # in one (unordered) bulk_write
+        self.batch_size = batch_size
 
     def add_update(self, source, merge_collection, ids):
-        for _id in ids:
-            doc = self._src[source].get_from_id(_id)
-            self._src[merge_collection].update({'_id': _id}, {'$set': doc}, upsert=True)
+        cnt = 0
+        cnt_missing = 0
+        for ids_chunk in iter_n(ids, self.batch_size):
+            ops = []
+            found = set()
+            for doc in self._src[source].find({'_id': {'$in': ids_chunk}}):
+                _id = doc.pop('_id')
+                found.add(_id)
+                # nothing to $set (an empty $set fails the whole bulk_write)
+                if not doc:
+                    print('id has no data in source collection:', _id)
+                    continue
+                ops.append(UpdateOne({'_id': _id}, {'$set': doc}, upsert=True))
+            for _id in ids_chunk:
+                if _id not in found:
+                    print('id does not exist in source collection:', _id)
+                    cnt_missing += 1
+            if ops:
+                self._src[merge_collection].bulk_write(ops, ordered=False)
+                cnt += len(ops)
+        print('items added/updated: ', cnt)
+        if cnt_missing:
+            print('items missing from source collection: ', cnt_missing)
+        return cnt
 
     def delete(self, merge_collection, field, ids):
-        for _id in ids:
-            doc = self._src[merge_collection].get_from_id(_id)
-            if set(doc) == set(['_id', field]) or set(doc) == set(['_id', field, 'snpeff', 'vcf']):
-                self._src[merge_collection].remove(_id)
-            else:
-                self._src[merge_collection].update({'_id': _id}, {'$unset': {field: 1}})
+        cnt = 0
+        cnt_missing = 0
+        for ids_chunk in iter_n(ids, self.batch_size):
+            # only key names are needed to decide, not whole documents
+            cur = self._src[merge_collection].aggregate([
+                {"$match": {'_id': {'$in': ids_chunk}}},
+                {"$project": {"_root_keys": ROOT_KEYS}}])
+            ops = []
+            found = set()
+            for doc in cur:
+                found.add(doc['_id'])
+                keys = set(doc["_root_keys"])
+                if keys == set(['_id', field]) or keys == set(['_id', field, 'snpeff', 'vcf']):
+                    ops.append(DeleteOne({'_id': doc['_id']}))
+                else:
+                    ops.append(UpdateOne({'_id': doc['_id']}, {'$unset': {field: 1}}))
+            for _id in ids_chunk:
+                if _id not in found:
+                    print('id does not exist in merged collection:', _id)
+                    cnt_missing += 1
+            if ops:
+                self._src[merge_collection].bulk_write(ops, ordered=False)
+                cnt += len(ops)
+        print('items deleted/updated: ', cnt)
+        if cnt_missing:
+            print('items missing from merged collection: ', cnt_missing)
+        return cnt
 
     def main(self, diff_filepath, merge_collection, field):
-        diff = loadobj(diff_filepath)
+        # pickled diffs are fully loaded, diff files are streamed
+        diff = load_diff(diff_filepath)
         source_collection = diff['source']
         add_ids = diff['add']
         delete_ids = diff['delete']
-        update_ids = [_doc['_id'] for _doc in diff['update']]
+        update_ids = (_doc['_id'] for _doc in diff['update'])
         self.add_update(source_collection, merge_collection, add_ids)
         self.add_update(source_collection, merge_collection, update_ids)
         self.delete(merge_collection, field, delete_ids)
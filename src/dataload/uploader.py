@@ -1,4 +1,6 @@
-import glob, os, math, asyncio
+import glob, os, math, asyncio, json
+import concurrent.futures
+import multiprocessing.util
 from functools import partial
 
 import biothings.dataload.uploader as uploader
@@ -12,6 +14,9 @@ import dataload.sources.snpeff.snpeff_upload as snpeff_upload
 import dataload.sources.snpeff.snpeff_parser as snpeff_parser
 
 from utils.hgvs import get_pos_start_end
+from utils.genome import GENOME_STORE_EXT
+from utils.bloom import BloomFilter
+import config
 from config import MAX_REF_ALT_LEN
 
 class SnpeffPostUpdateUploader(uploader.BaseSourceUploader):
@@ -19,16 +24,33 @@ class SnpeffPostUpdateUploader(uploader.BaseSourceUploader):
     keep_archive = 1
 
     SNPEFF_BATCH_SIZE = 1000000
+    # number of long-lived snpEff processes to annotate batches with.
+    # 0 means a new snpEff process is started for each batch
+    SNPEFF_POOL_SIZE = 0
+    # max heap for each snpEff JVM, in GiB
+    SNPEFF_JVM_MEM = 4
+    # parallel mode: IDs are sharded per chromosome and each shard
+    # is processed in a hub process worker
+    SNPEFF_PARALLEL = False
+    SNPEFF_SHARD_SIZE = 100000
+    # keep a persistent index of IDs already annotated, and checkpoints so
+    # an interrupted run can resume (both stored in CACHE_FOLDER/snpeff)
+    SNPEFF_INDEX = True
 
     def get_pinfo(self):
         pinfo = super(SnpeffPostUpdateUploader,self).get_pinfo()
         # mem depends in the batch size and doc size, but snpeff consumes a lot
         # (here, asumming 1 doc will weigh 1kB)
-        pinfo.setdefault("__reqs__",{})["mem"] = (self.__class__.SNPEFF_BATCH_SIZE/100000.) * (1024**3)
+        mem = (self.__class__.SNPEFF_BATCH_SIZE/100000.) * (1024**3)
+        # plus snpEff JVMs kept alive in pool mode
+        mem += self.__class__.SNPEFF_POOL_SIZE * self.__class__.SNPEFF_JVM_MEM * (1024**3)
+        pinfo.setdefault("__reqs__",{})["mem"] = mem
         return pinfo
 
-    def do_snpeff(self, batch_size=SNPEFF_BATCH_SIZE, force=False, force_use_cache=False):
-        self.logger.info("Updating snpeff information from source '%s' (collection:%s)" % (self.fullname,self.collection_name))
+    def get_snpeff_env(self, multithread=True):
+        """Return snpeff uploader class, snpEff command and genome file
+        to use for this source's assembly. multithread=False: snpEff
+        processes records one by one, in order (required in pool mode)"""
         # select Snpeff uploader to get collection name and src_dump _id
         version = self.__class__.__metadata__["assembly"]
         snpeff_class = getattr(snpeff_upload,"Snpeff%sUploader" % version.capitalize())
@@ -37,73 +59,382 @@ class SnpeffPostUpdateUploader(uploader.BaseSourceUploader):
         assert snpeff_doc, "No snpeff information found, has it been dumped & uploaded ?"
         snpeff_dir = snpeff_doc["data_folder"]
         # -q: when there's an update, there's a message on stderr....
-        cmd = "java -Xmx4g -jar %s/snpEff/snpEff.jar -t -noStats -noExpandIUB %s" % (snpeff_dir,version)
+        cmd = "java -Xmx%dg -jar %s/snpEff/snpEff.jar %s-noStats -noExpandIUB %s" % \
+                (self.__class__.SNPEFF_JVM_MEM,snpeff_dir,multithread and "-t " or "",version)
         # genome files are in "data_folder"/../data
         genomes = glob.glob(os.path.join(snpeff_dir,"..","data","%s_genome.*" % version))
+        # packed genome store (mmap'ed, shared between processes) is
+        # preferred over pickled bitarrays when both are available
+        genomes = [g for g in genomes if g.endswith(GENOME_STORE_EXT)] or genomes
         assert len(genomes) == 1, "Expected only one genome files for '%s', got: %s" % (version,genomes)
         genome = genomes[0]
-        annotator = snpeff_parser.SnpeffAnnotator(cmd,logger=self.logger)
+        return snpeff_class, cmd, genome
+
+    def get_checkpoint_file(self):
+        return os.path.join(get_snpeff_folder(),"%s.checkpoint" % self.collection_name)
+
+    def load_checkpoint(self, batch_size):
+        """Return first IDs of id_feeder batches fully processed by a previous,
+        interrupted run (if it used the same batch_size)"""
+        try:
+            checkpoint = json.load(open(self.get_checkpoint_file()))
+        except FileNotFoundError:
+            return []
+        if checkpoint["batch_size"] != batch_size:
+            self.logger.info("Checkpoint found but batch_size differs (%s != %s), can't resume from it" % \
+                    (checkpoint["batch_size"],batch_size))
+            return []
+        self.logger.info("Resuming from checkpoint, %d batches already processed" % len(checkpoint["first_ids"]))
+        return checkpoint["first_ids"]
+
+    def save_checkpoint(self, batch_size, first_ids):
+        fn = self.get_checkpoint_file()
+        json.dump({"batch_size" : batch_size, "first_ids" : first_ids},open(fn + ".tmp","w"))
+        # atomic, a crash while saving won't corrupt previous checkpoint
+        os.replace(fn + ".tmp",fn)
+
+    def clear_checkpoint(self):
+        try:
+            os.remove(self.get_checkpoint_file())
+        except FileNotFoundError:
+            pass
+
+    def do_snpeff(self, batch_size=SNPEFF_BATCH_SIZE, force=False, force_use_cache=False, pool_size=None):
+        self.logger.info("Updating snpeff information from source '%s' (collection:%s)" % (self.fullname,self.collection_name))
+        version = self.__class__.__metadata__["assembly"]
+        if pool_size is None:
+            pool_size = self.__class__.SNPEFF_POOL_SIZE
+        snpeff_class, cmd, genome = self.get_snpeff_env(multithread=not pool_size)
+        if pool_size:
+            annotator = snpeff_parser.SnpeffAnnotatorPool(cmd,pool_size,logger=self.logger)
+        else:
+            annotator = snpeff_parser.SnpeffAnnotator(cmd,logger=self.logger)
         vcf_builder = snpeff_parser.VCFConstruct(genome,logger=self.logger)
         storage = UpsertStorage(None,snpeff_class.name,self.logger)
         col = self.db[self.collection_name]
         total = math.ceil(col.count()/batch_size)
         cnt = 0
         to_process = []
+        index = None
+        # first IDs of batches fully processed (committed), from previous run and this one
+        done_ids = []
+        # first IDs of batches being processed
+        pending_ids = []
+        use_index = not force and self.__class__.SNPEFF_INDEX and getattr(config,"CACHE_FOLDER",None)
+        if use_index:
+            index = get_snpeff_index(snpeff_class.name, storage, self.logger, extra=col.count())
+            done_ids = self.load_checkpoint(batch_size)
+        else:
+            # annotations stored here won't be in the index
+            invalidate_snpeff_index(snpeff_class.name, self.logger)
+        resume_ids = list(done_ids)
 
         def process(ids):
-            self.logger.info("%d documents to annotate" % len(ids))
-            hgvs_vcfs = vcf_builder.build_vcfs(ids)
-            # merge "vcf" and snpeff annotations keys when possible
-            # (it no snpeff data, we keep 'vcf' data)
-            for annot in annotator.annotate(hgvs_vcfs):
-                hgvs_vcfs[annot["_id"]].update(annot)
-            # trim if sequence is to big
-            for _id in hgvs_vcfs:
-                vcf = hgvs_vcfs[_id]
-                for k in ["alt","ref"]:
-                    if len(vcf["vcf"][k]) > MAX_REF_ALT_LEN:
-                        msg = "...(trimmed)"
-                        vcf["vcf"][k] = vcf["vcf"][k][:MAX_REF_ALT_LEN - len(msg)] + msg
-                hgvs_vcfs[_id] = vcf
-
-            data = annotate_start_end(hgvs_vcfs,version)
-            howmany = storage.process(data, batch_size)
+            howmany = annotate_batch(ids, vcf_builder, annotator, storage, version, batch_size, self.logger, index=index)
             if howmany:
                 # we need to update some metadata info about snpeff b/c data has changed
                 # so cache could be invalid
                 self.logger.debug("Invalidating cache for '%s'" % snpeff_class.name)
                 mongo.invalidate_cache(snpeff_class.name)
 
-        for ids in id_feeder(col, batch_size=batch_size, logger=self.logger, force_use=force_use_cache):
-            cnt += 1
-            self.logger.debug("Processing batch %s/%s [%.1f]" % (cnt,total,(cnt/total*100)))
-            # don't re-compute annotations if already there
-            if not force:
-                for subids in iter_n(ids,10000):
-                    cur = storage.temp_collection.find({'_id' : {'$in' : subids}},{'_id':1})
-                    already_ids = [d["_id"] for d in list(cur)]
-                    newids = list(set(subids).difference(set(already_ids)))
-                    if len(subids) != len(newids):
-                        self.logger.debug("%d documents already have snpeff annotations, skip them" % \
-                                (len(subids) - len(newids)))
-                    to_process.extend(newids)
-                    self.logger.debug("Batch filled %d out of %d" % (len(to_process),batch_size))
-                    if not (len(to_process) >= batch_size):
-                        # can fill more...
+        try:
+            for ids in id_feeder(col, batch_size=batch_size, logger=self.logger, force_use=force_use_cache):
+                cnt += 1
+                if resume_ids:
+                    if ids[0] == resume_ids.pop(0):
+                        self.logger.debug("Batch %s/%s already processed, skip it" % (cnt,total))
                         continue
-                    process(to_process)
-                    to_process = []
-            else:
-                to_process = ids
-        # for potential remainings
-        if to_process:
-            process(to_process)
+                    self.logger.warning("IDs differ from checkpoint at batch %s, can't resume further" % cnt)
+                    resume_ids = []
+                    done_ids = done_ids[:cnt-1]
+                self.logger.debug("Processing batch %s/%s [%.1f]" % (cnt,total,(cnt/total*100)))
+                # don't re-compute annotations if already there
+                if not force:
+                    pending_ids.append(ids[0])
+                    for subids in iter_n(ids,10000):
+                        newids = filter_annotated(storage, subids, self.logger, index=index)
+                        to_process.extend(newids)
+                        self.logger.debug("Batch filled %d out of %d" % (len(to_process),batch_size))
+                        if not (len(to_process) >= batch_size):
+                            # can fill more...
+                            continue
+                        process(to_process)
+                        to_process = []
+                        # previous batches are now fully stored, not the current one
+                        if use_index and len(pending_ids) > 1:
+                            done_ids.extend(pending_ids[:-1])
+                            pending_ids = pending_ids[-1:]
+                            index.flush()
+                            self.save_checkpoint(batch_size,done_ids)
+                    if use_index and not to_process:
+                        done_ids.extend(pending_ids)
+                        pending_ids = []
+                        index.flush()
+                        self.save_checkpoint(batch_size,done_ids)
+                else:
+                    to_process = ids
+            # for potential remainings
+            if to_process:
+                process(to_process)
+            if use_index:
+                # all done, next run starts from scratch
+                self.clear_checkpoint()
+        finally:
+            if index is not None:
+                index.close()
+            annotator.close()
+
+    @asyncio.coroutine
+    def do_snpeff_parallel(self, job_manager, shard_size=SNPEFF_SHARD_SIZE, force=False, force_use_cache=False):
+        """
+        Same as do_snpeff() but IDs are partitioned by chromosome into shards
+        of shard_size IDs, each shard being annotated and stored in a process
+        worker. Each worker process keeps its own snpEff process running
+        between shards (see snpeff_worker()).
+        """
+        self.logger.info("Updating snpeff information from source '%s' (collection:%s), in parallel" % \
+                (self.fullname,self.collection_name))
+        version = self.__class__.__metadata__["assembly"]
+        # workers already run in parallel, and "-t" can't be used with
+        # long-lived snpEff processes
+        snpeff_class, cmd, genome = self.get_snpeff_env(multithread=False)
+        col = self.db[self.collection_name]
+        total = col.count()
+        btotal = math.ceil(total/shard_size)
+        jobs = []
+        shards = {}
+        state = {"cnt" : 0, "bnum" : 1, "updated" : 0}
+        # process workers only read the index of annotated IDs, it's
+        # maintained here as shards are done, by one thread (outside the loop)
+        index = None
+        if self.__class__.SNPEFF_INDEX and getattr(config,"CACHE_FOLDER",None):
+            storage = UpsertStorage(None,snpeff_class.name,self.logger)
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "post-update (snpeff index)"
+            # memory is about the mmap'ed index, not snpEff
+            pinfo.pop("__reqs__",None)
+            job = yield from job_manager.defer_to_thread(pinfo,
+                    partial(get_snpeff_index, snpeff_class.name, storage, self.logger, extra=total))
+            index = yield from job
+            index_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            index_jobs = []
+        else:
+            invalidate_snpeff_index(snpeff_class.name, self.logger)
+
+        def add_to_index(ids):
+            index.update(ids)
+            index.flush()
+
+        def processed(f, batch_num, ids):
+            if index is not None:
+                # even if shard failed, some of its IDs may have been stored
+                index_jobs.append(asyncio.wrap_future(index_executor.submit(add_to_index, ids)))
+            try:
+                state["updated"] += f.result()
+                self.logger.info("snpeff shard #%d, done" % batch_num)
+            except Exception as e:
+                import traceback
+                self.logger.error("snpeff shard #%d, error in processed (do_snpeff_parallel): %s:\n%s" % \
+                        (batch_num, e, traceback.format_exc()))
+                raise
+
+        @asyncio.coroutine
+        def submit(chrom, ids):
+            state["cnt"] += len(ids)
+            pinfo = self.get_pinfo()
+            pinfo["step"] = "post-update (snpeff)"
+            pinfo["description"] = "#%d/%d %s (%.1f%%)" % (state["bnum"],btotal,chrom,(state["cnt"]/total*100.))
+            # mem for this shard (1 doc ~ 1kB, see get_pinfo()) and the worker's snpEff JVM
+            pinfo["__reqs__"]["mem"] = (len(ids)/100000.) * (1024**3) + \
+                    self.__class__.SNPEFF_JVM_MEM * (1024**3)
+            self.logger.info("Creating snpeff job #%d/%d to process %d IDs from %s (%.1f%%)" % \
+                    (state["bnum"],btotal,len(ids),chrom,(state["cnt"]/total*100.)))
+            job = yield from job_manager.defer_to_process(pinfo,
+                    partial(snpeff_worker, snpeff_class.name, version, cmd, genome, ids, force,
+                            index_file=index and index.filename))
+            job.add_done_callback(partial(processed, batch_num=state["bnum"], ids=ids))
+            jobs.append(job)
+            state["bnum"] += 1
+
+        try:
+            for ids in id_feeder(col, batch_size=shard_size, logger=self.logger, force_use=force_use_cache):
+                for _id in ids:
+                    chrom = _id.split(":")[0]
+                    shards.setdefault(chrom,[]).append(_id)
+                    if len(shards[chrom]) >= shard_size:
+                        yield from submit(chrom, shards.pop(chrom))
+            # for potential remainings
+            for chrom in list(shards):
+                yield from submit(chrom, shards.pop(chrom))
+            self.logger.info("%d jobs created for snpeff step" % len(jobs))
+            if jobs:
+                yield from asyncio.gather(*jobs)
+        finally:
+            if index is not None:
+                # wait for all shards so none is left out of the index
+                if jobs:
+                    yield from asyncio.wait(jobs)
+                if index_jobs:
+                    yield from asyncio.wait(index_jobs)
+                index_executor.shutdown()
+                index.close()
+        if state["updated"]:
+            self.logger.debug("Invalidating cache for '%s'" % snpeff_class.name)
+            mongo.invalidate_cache(snpeff_class.name)
 
     def post_update_data(self, steps, force, batch_size, job_manager, **kwargs):
-        # this one will run in current thread, snpeff java prg will
-        # multiprocess itself, no need to do more
         force_use_cache = kwargs.get("force_use_cache",False)
-        self.do_snpeff(force=force,force_use_cache=force_use_cache)
+        if kwargs.get("parallel",self.__class__.SNPEFF_PARALLEL):
+            # we're in a thread, run the coroutine in the hub loop and wait for it
+            # so the post-update step is over only when all shards are processed
+            fut = asyncio.run_coroutine_threadsafe(
+                    self.do_snpeff_parallel(job_manager,force=force,force_use_cache=force_use_cache),
+                    job_manager.loop)
+            fut.result()
+        else:
+            # this one will run in current thread, snpeff java prg will
+            # multiprocess itself, no need to do more
+            self.do_snpeff(force=force,force_use_cache=force_use_cache)
+
+
+# index of annotated IDs is sized for IDs already annotated plus IDs
+# from the source being processed, with some headroom for next ones
+SNPEFF_INDEX_HEADROOM = 1.2
+SNPEFF_INDEX_MIN_CAPACITY = 10**6
+
+def get_snpeff_folder():
+    folder = os.path.join(config.CACHE_FOLDER,"snpeff")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    return folder
+
+
+def get_snpeff_index(storage_name, storage, logger, extra=0):
+    """Return a Bloom filter of IDs stored in snpeff storage. It's sized for
+    IDs in storage plus "extra" IDs about to be added, and (re)built from
+    storage collection if not complete (new, or invalidated)"""
+    fn = os.path.join(get_snpeff_folder(),"%s.bloom" % storage_name)
+    needed = storage.temp_collection.count() + extra
+    index = None
+    if os.path.exists(fn):
+        try:
+            index = BloomFilter(fn)
+        except ValueError as e:
+            logger.info("Can't use index of annotated IDs for '%s', creating a new one: %s" % (storage_name,e))
+            os.remove(fn)
+        else:
+            if index.capacity < needed:
+                logger.info("Index of annotated IDs for '%s' is too small (capacity: %d, needed: %d), " % \
+                        (storage_name,index.capacity,needed) + "creating a bigger one")
+                index.close()
+                os.remove(fn)
+                index = None
+    if index is None:
+        index = BloomFilter(fn, capacity=max(int(needed * SNPEFF_INDEX_HEADROOM), SNPEFF_INDEX_MIN_CAPACITY))
+    if not index.complete:
+        logger.info("Building index of IDs already annotated in '%s'" % storage_name)
+        index.clear()
+        for ids in id_feeder(storage.temp_collection, batch_size=100000, logger=logger):
+            index.update(ids)
+        index.complete = True
+        logger.info("Index of annotated IDs built (%d IDs)" % index.count)
+    return index
+
+
+def invalidate_snpeff_index(storage_name, logger):
+    fn = os.path.join(get_snpeff_folder(),"%s.bloom" % storage_name)
+    if getattr(config,"CACHE_FOLDER",None) and os.path.exists(fn):
+        logger.info("Invalidating index of annotated IDs for '%s'" % storage_name)
+        try:
+            index = BloomFilter(fn)
+        except ValueError:
+            # unusable anyway
+            os.remove(fn)
+            return
+        index.complete = False
+        index.close()
+
+
+def filter_annotated(storage, ids, logger, index=None):
+    """Return IDs from ids without snpeff annotations yet in storage.
+    If index (Bloom filter) is given, only IDs possibly in storage are
+    checked from there"""
+    if index is not None:
+        maybe_ids = [_id for _id in ids if _id in index]
+    else:
+        maybe_ids = ids
+    if maybe_ids:
+        cur = storage.temp_collection.find({'_id' : {'$in' : maybe_ids}},{'_id':1})
+        already_ids = [d["_id"] for d in list(cur)]
+    else:
+        already_ids = []
+    newids = list(set(ids).difference(set(already_ids)))
+    if len(ids) != len(newids):
+        logger.debug("%d documents already have snpeff annotations, skip them" % \
+                (len(ids) - len(newids)))
+    return newids
+
+
+def annotate_batch(ids, vcf_builder, annotator, storage, assembly, batch_size, logger, index=None):
+    """Build VCFs for ids, annotate them with snpEff and store results
+    (and register them in index, if any). Returns the number of stored documents"""
+    logger.info("%d documents to annotate" % len(ids))
+    hgvs_vcfs = vcf_builder.build_vcfs(ids)
+    # merge "vcf" and snpeff annotations keys when possible
+    # (it no snpeff data, we keep 'vcf' data)
+    for annot in annotator.annotate(hgvs_vcfs):
+        hgvs_vcfs[annot["_id"]].update(annot)
+    # trim if sequence is to big
+    for _id in hgvs_vcfs:
+        vcf = hgvs_vcfs[_id]
+        for k in ["alt","ref"]:
+            if len(vcf["vcf"][k]) > MAX_REF_ALT_LEN:
+                msg = "...(trimmed)"
+                vcf["vcf"][k] = vcf["vcf"][k][:MAX_REF_ALT_LEN - len(msg)] + msg
+        hgvs_vcfs[_id] = vcf
+
+    data = annotate_start_end(hgvs_vcfs,assembly)
+    howmany = storage.process(data, batch_size)
+    if index is not None:
+        index.update(hgvs_vcfs)
+    return howmany
+
+
+# VCF builders and snpEff annotators are kept between jobs running in the
+# same worker process, so genome data is loaded and snpEff (JVM, genome
+# database) is started once per process
+_vcf_builders = {}
+_annotators = {}
+
+def close_annotators():
+    for annotator in _annotators.values():
+        annotator.close()
+    _annotators.clear()
+
+def snpeff_worker(storage_name, assembly, cmd, genome, ids, force=False, index_file=None):
+    logger = snpeff_parser.logging
+    if not force:
+        storage = UpsertStorage(None,storage_name,logger)
+        # index is maintained by the parent process, only read here
+        index = index_file and BloomFilter(index_file, readonly=True) or None
+        try:
+            ids = [_id for subids in iter_n(ids,10000) for _id in filter_annotated(storage,subids,logger,index=index)]
+        finally:
+            if index is not None:
+                index.close()
+    if not ids:
+        return 0
+    if not genome in _vcf_builders:
+        _vcf_builders[genome] = snpeff_parser.VCFConstruct(genome,logger=logger)
+    if not cmd in _annotators:
+        if not _annotators:
+            # worker processes don't run atexit handlers, multiprocessing's
+            # finalizers are called when they exit (registered from the
+            # worker itself, finalizers inherited from parent are dropped)
+            multiprocessing.util.Finalize(None, close_annotators, exitpriority=10)
+        _annotators[cmd] = snpeff_parser.SnpeffAnnotatorPool(cmd,1,logger=logger)
+    storage = UpsertStorage(None,storage_name,logger)
+    return annotate_batch(ids, _vcf_builders[genome], _annotators[cmd], storage, assembly, len(ids), logger)
 
 
 def annotate_start_end(hgvs_vcfs, assembly):
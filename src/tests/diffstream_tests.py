@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for streamable diff files (utils.diffstream).
+Need to run under src folder as:
+
+    nosetests tests.diffstream_tests -vv
+'''
+import os
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, assert_raises
+
+from biothings.utils.common import dump
+from utils.diffstream import DiffWriter, DiffSection, load_diff, convert_diff, is_diff_file, DIFF_EXT
+
+DIFF = {"source": "clinvar_hg19",
+        "timestamp": "2017-01-01",
+        "add": ["chr1:g.%dA>G" % i for i in range(25000)],
+        "delete": ["chr2:g.1A>G", "chr2:g.2A>G"],
+        "update": [{"_id": "chr3:g.1A>G",
+                    "patch": [{"op": "replace", "path": "/clinvar/rcv", "value": "RCV1"}]},
+                   {"_id": "chr3:g.2A>G",
+                    "patch": [{"op": "remove", "path": "/clinvar/hg19"}]}]}
+
+
+class DiffStreamTest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, name="1" + DIFF_EXT, sections=("add", "delete", "update")):
+        filename = os.path.join(self.folder, name)
+        writer = DiffWriter(filename, DIFF["source"], timestamp=DIFF["timestamp"])
+        for sec in sections:
+            # sections are consumed as iterables
+            eq_(writer.write_section(sec, iter(DIFF[sec])), len(DIFF[sec]))
+        writer.close()
+        return filename
+
+    def test_round_trip(self):
+        diff = load_diff(self.write())
+        eq_(diff["source"], DIFF["source"])
+        eq_(diff["timestamp"], DIFF["timestamp"])
+        for sec in ["add", "delete", "update"]:
+            ok_(isinstance(diff[sec], DiffSection))
+            eq_(len(diff[sec]), len(DIFF[sec]))
+            eq_(list(diff[sec]), DIFF[sec])
+
+    def test_reiterate(self):
+        diff = load_diff(self.write())
+        # each iteration reads the section again, even interleaved
+        it1 = iter(diff["add"])
+        it2 = iter(diff["add"])
+        eq_(next(it1), DIFF["add"][0])
+        eq_(list(it2), DIFF["add"])
+        eq_(list(it1), DIFF["add"][1:])
+
+    def test_missing_sections(self):
+        # sections not written are empty
+        diff = load_diff(self.write(sections=("update",)))
+        eq_(list(diff["add"]), [])
+        eq_(len(diff["delete"]), 0)
+        eq_(list(diff["update"]), DIFF["update"])
+
+    def test_section_written_twice(self):
+        writer = DiffWriter(os.path.join(self.folder, "twice" + DIFF_EXT), "src")
+        writer.write_section("add", [])
+        assert_raises(ValueError, writer.write_section, "add", [])
+        writer.close()
+
+    def test_abort(self):
+        filename = os.path.join(self.folder, "aborted" + DIFF_EXT)
+        writer = DiffWriter(filename, "src")
+        writer.write_section("add", ["a"])
+        writer.abort()
+        ok_(not os.path.exists(filename))
+
+    def test_truncated_index(self):
+        filename = self.write()
+        size = os.path.getsize(filename)
+        with open(filename, "r+b") as f:
+            f.truncate(size - 4)
+        assert_raises(ValueError, load_diff, filename)
+
+    def test_truncated_section(self):
+        filename = self.write()
+        diff = load_diff(filename)
+        add = diff["add"]
+        # cut the file in the middle of "add" section
+        with open(filename, "r+b") as f:
+            f.truncate(add.offset + add.length // 2)
+        assert_raises(IOError, list, add)
+
+    def test_pickled_diff(self):
+        filename = os.path.join(self.folder, "1.pyobj")
+        dump(DIFF, filename)
+        ok_(not is_diff_file(filename))
+        eq_(load_diff(filename), DIFF)
+        converted = convert_diff(filename)
+        eq_(converted, os.path.join(self.folder, "1" + DIFF_EXT))
+        ok_(is_diff_file(converted))
+        diff = load_diff(converted)
+        eq_(diff["timestamp"], DIFF["timestamp"])
+        for sec in ["add", "delete", "update"]:
+            eq_(list(diff[sec]), DIFF[sec])
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for scripted ES sync updates (dataindex.es_sync), run against a
+live ES 2.x server with inline groovy scripting enabled
+(script.inline: true). A temporary index is created and deleted.
+Need to run under src folder as:
+
+    ES_HOST="localhost:9200" nosetests tests.es_sync_tests -vv
+
+Tests are skipped if ES_HOST isn't set.
+'''
+import os
+from nose.tools import ok_, eq_
+from nose.plugins.skip import SkipTest
+
+from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch.helpers import bulk
+
+from dataindex.es_sync import ESSyncer, BASE_KEYS, UPDATE_SCRIPT, SCRIPT_LANG
+
+INDEX = "myvariant_test_es_sync"
+DOC_TYPE = "variant"
+
+
+class ESSyncScriptTest(object):
+
+    es_host = os.getenv("ES_HOST", "")
+
+    def setUp(self):
+        if not self.es_host:
+            raise SkipTest("ES_HOST not set")
+        self.es = Elasticsearch(self.es_host)
+        self.es.indices.delete(index=INDEX, ignore=404)
+        self.es.indices.create(index=INDEX)
+        docs = {"chr1:g.1A>G": {"clinvar": {"rcv": "RCV1"}, "vcf": {"ref": "A"}, "hg19": {"start": 1}},
+                "chr1:g.2A>G": {"clinvar": {"rcv": "RCV2"}, "dbsnp": {"rsid": "rs2"}, "vcf": {"ref": "A"}},
+                "chr1:g.3A>G": {"dbsnp": {"rsid": "rs3"}}}
+        for _id, doc in docs.items():
+            self.es.index(index=INDEX, doc_type=DOC_TYPE, id=_id, body=doc)
+        self.es.indices.refresh(index=INDEX)
+        # scripted actions only need index and doc_type, not mongo
+        self.syncer = ESSyncer.__new__(ESSyncer)
+        self.syncer._index = INDEX
+        self.syncer._doc_type = DOC_TYPE
+
+    def tearDown(self):
+        if self.es_host:
+            self.es.indices.delete(index=INDEX, ignore=404)
+
+    def get(self, _id):
+        try:
+            return self.es.get(index=INDEX, doc_type=DOC_TYPE, id=_id)["_source"]
+        except NotFoundError:
+            return None
+
+    def test_delete_scripted(self):
+        ids = ["chr1:g.1A>G", "chr1:g.2A>G", "chr1:g.3A>G"]
+        ok, errors = bulk(self.es, self.syncer.delete_scripted("clinvar", ids), raise_on_error=False)
+        eq_(errors, [])
+        # only base keys left: deleted
+        ok_(set(["vcf", "hg19"]).issubset(BASE_KEYS))
+        eq_(self.get("chr1:g.1A>G"), None)
+        # other source left: field removed only
+        eq_(self.get("chr1:g.2A>G"), {"dbsnp": {"rsid": "rs2"}, "vcf": {"ref": "A"}})
+        # no such field: untouched
+        eq_(self.get("chr1:g.3A>G"), {"dbsnp": {"rsid": "rs3"}})
+
+    def test_update_script(self):
+        # whole field is replaced, removed sub-fields don't stay
+        self.es.update(index=INDEX, doc_type=DOC_TYPE, id="chr1:g.2A>G",
+                       body={"script": {"inline": UPDATE_SCRIPT, "lang": SCRIPT_LANG,
+                                        "params": {"field": "clinvar", "value": {"allele_id": 2}}}})
+        eq_(self.get("chr1:g.2A>G")["clinvar"], {"allele_id": 2})
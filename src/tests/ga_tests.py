@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for queued Google Analytics tracking (utils.ga). Nothing is
+sent, HTTP client is replaced by a fake one.
+Need to run under src folder as:
+
+    nosetests tests.ga_tests -vv
+'''
+from urllib.parse import parse_qs
+from nose.tools import ok_, eq_
+
+import utils.ga as ga
+
+
+class FakeFuture(object):
+
+    def __init__(self):
+        self.callbacks = []
+        self.error = None
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def exception(self):
+        return self.error
+
+    def resolve(self, error=None):
+        self.error = error
+        for callback in self.callbacks:
+            callback(self)
+
+
+class FakeHTTPClient(object):
+    # sent requests and their futures, across instances
+    sent = []
+
+    def fetch(self, req):
+        f = FakeFuture()
+        FakeHTTPClient.sent.append((req, f))
+        return f
+
+
+class FakeRequest(object):
+
+    def __init__(self, headers, remote_ip="10.0.0.1", path="/v1/variant/chr1:g.1A>G"):
+        self.headers = headers
+        self.remote_ip = remote_ip
+        self.path = path
+
+
+class FakeHandler(ga.GAMixIn):
+
+    def __init__(self, headers, **kwargs):
+        self.request = FakeRequest(headers, **kwargs)
+
+    def get_argument(self, name, default=None):
+        return default
+
+
+EVENT = {"category": "variant_get", "action": "variant_get", "label": "qsize", "value": 1}
+
+
+def queue_events(queue, num, event=EVENT):
+    for i in range(num):
+        queue.events.append(("/v1/variant/%d" % i, "10.0.0.%d" % i, "agent", "en", event))
+
+
+class GAQueueTest(object):
+
+    def setUp(self):
+        self.client = ga.AsyncHTTPClient
+        ga.AsyncHTTPClient = FakeHTTPClient
+        FakeHTTPClient.sent = []
+        self.settings = dict([(k, getattr(ga.config, k)) for k in ("RUN_IN_PROD", "GA_ACCOUNT")
+                              if hasattr(ga.config, k)])
+        ga.config.RUN_IN_PROD = True
+        ga.config.GA_ACCOUNT = "UA-0"
+
+    def tearDown(self):
+        ga.AsyncHTTPClient = self.client
+        for k in ("RUN_IN_PROD", "GA_ACCOUNT"):
+            if k in self.settings:
+                setattr(ga.config, k, self.settings[k])
+            else:
+                delattr(ga.config, k)
+
+    def test_client_id(self):
+        cid = ga.client_id("10.0.0.1", "agent")
+        eq_(cid, ga.client_id("10.0.0.1", "agent"))
+        ok_(cid != ga.client_id("10.0.0.2", "agent"))
+        ok_(cid != ga.client_id("10.0.0.1", "other agent"))
+        eq_(ga.client_id("10.0.0.1", None), ga.client_id("10.0.0.1", ""))
+
+    def test_forwarded_for(self):
+        queue = ga._queue
+        ga._queue = ga.GAQueue()
+        # no periodic flush
+        ga._queue._flusher = object()
+        try:
+            FakeHandler({"X-Forwarded-For": "1.2.3.4, 10.0.0.2, 10.0.0.3",
+                         "User-Agent": "agent"}).ga_track()
+            FakeHandler({"User-Agent": "agent"}, remote_ip="5.6.7.8").ga_track()
+            eq_([e[1] for e in ga._queue.events], ["1.2.3.4", "5.6.7.8"])
+            hits = [parse_qs(h) for h in ga._queue.next_batch()]
+            eq_(hits[0]["uip"], ["1.2.3.4"])
+            eq_(hits[0]["cid"], [ga.client_id("1.2.3.4", "agent")])
+            eq_(hits[1]["cid"], [ga.client_id("5.6.7.8", "agent")])
+        finally:
+            ga._queue = queue
+
+    def test_overflow(self):
+        queue = ga.GAQueue(maxlen=3)
+        queue._flusher = object()
+        for i in range(5):
+            queue.add("/v1/query", "10.0.0.1", "agent", "en", None)
+        eq_(len(queue.events), 3)
+        eq_(queue.dropped, 2)
+
+    def test_batches(self):
+        queue = ga.GAQueue(max_in_flight=2)
+        # pageview + event hits per request
+        queue_events(queue, 25)
+        queue.flush()
+        eq_(len(FakeHTTPClient.sent), 2)
+        eq_(queue.in_flight, 2)
+        # next batches are sent as requests complete
+        FakeHTTPClient.sent[0][1].resolve()
+        eq_(len(FakeHTTPClient.sent), 3)
+        FakeHTTPClient.sent[1][1].resolve(Exception("GA is down"))
+        FakeHTTPClient.sent[2][1].resolve()
+        eq_(queue.failed, 1)
+        eq_(queue.in_flight, 0)
+        eq_(len(queue.events), 0)
+        eq_(len(FakeHTTPClient.sent), 3)
+        hits = []
+        for req, f in FakeHTTPClient.sent:
+            eq_(req.url, ga.GA_BATCH_URL)
+            batch = [parse_qs(h) for h in req.body.decode().split("\n")]
+            ok_(len(batch) <= ga.BATCH_SIZE)
+            # event hit follows its pageview, in the same batch
+            eq_([h["t"][0] for h in batch], ["pageview", "event"] * (len(batch) // 2))
+            hits.extend(batch)
+        eq_(len(hits), 50)
+        eq_(sorted(set([h["dp"][0] for h in hits])), sorted(["/v1/variant/%d" % i for i in range(25)]))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for snpEff post-processing (dataload.sources.snpeff.snpeff_parser):
+VCF construction from HGVS IDs, and parsing of snpEff output.
+tests/data/snpeff_output.json holds the documents the previous parser (full
+output read at once, then parsed) produced from tests/data/snpeff_output.vcf,
+so streamed parsing is checked against it.
+Need to run under src folder as:
+
+    nosetests tests.snpeff_tests -vv
+
+"cat" is used as a fake snpEff command.
+'''
+import os
+import gzip
+import json
+import shutil
+import tempfile
+from nose.tools import ok_, eq_
+
+from utils.genome import build_genome_store
+from dataload.sources.snpeff.snpeff_parser import VCFConstruct, SnpeffAnnotator, SnpeffAnnotatorPool
+
+DATA = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+FIXTURE = os.path.join(DATA, "snpeff_output.vcf")
+EXPECTED = os.path.join(DATA, "snpeff_output.json")
+
+# input is ignored by "cat <file>", but annotate() needs something to send
+VCFS = {"chr1:g.1A>G": {"vcf": {"chrom": "1", "position": 1, "ref": "A", "alt": "G"}}}
+
+
+def load_expected():
+    with open(EXPECTED) as f:
+        return [json.loads(line) for line in f]
+
+
+class SnpeffOutputTest(object):
+
+    def test_annotate(self):
+        docs = list(SnpeffAnnotator(["cat", FIXTURE]).annotate(VCFS))
+        eq_(len(docs), 200)
+        eq_(docs, load_expected())
+
+    def test_parse_line(self):
+        annotator = SnpeffAnnotator("cat")
+        with open(FIXTURE) as f:
+            docs = [annotator.parse_line(line.rstrip("\n")) for line in f]
+        eq_([d for d in docs if d], load_expected())
+
+    def test_pool(self):
+        # "cat" echoes VCF lines back (no annotations), end of batch markers
+        # included, so every ID comes back once, batch after batch
+        vcfs = dict([("chr1:g.%dA>G" % i, {"vcf": {"chrom": "1", "position": str(i), "ref": "A", "alt": "G"}})
+                     for i in range(1, 101)])
+        pool = SnpeffAnnotatorPool("cat", 3)
+        try:
+            for _ in range(2):
+                docs = list(pool.annotate(vcfs))
+                eq_(sorted([d["_id"] for d in docs]), sorted(vcfs))
+        finally:
+            pool.close()
+
+
+# 1-based: A1 C2 G3 T4 A5 C6 G7 T8 A9 A10 G11 G12 C13 C14 T15 T16 A17 G18 C19 T20
+CHR1 = "ACGTACGTAAGGCCTTAGCT"
+
+
+class VCFConstructTest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        with gzip.open(os.path.join(self.folder, "chr1.fa.gz"), "wt") as f:
+            f.write(">chr1\n%s\n" % CHR1)
+        self.genome = os.path.join(self.folder, "hg19_genome.mv2bit")
+        build_genome_store(self.folder, self.genome, chr_range=["1"])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_build_vcfs(self):
+        vcfs = VCFConstruct(self.genome).build_vcfs(
+                ["chr1:g.5A>G", "chrMT:g.3A>G", "chr1:g.6_7del", "chr1:g.9del",
+                 "chr1:g.10_11insTT", "chr1:g.12_13delinsC",
+                 # not supported, or no reference data
+                 "chr1:g.12_13dup", "rs123", "chr2:g.6_7del"])
+        eq_(vcfs, {
+            "chr1:g.5A>G": {"_id": "chr1:g.5A>G",
+                            "vcf": {"chrom": "1", "position": "5", "ref": "A", "alt": "G"}},
+            "chrMT:g.3A>G": {"_id": "chrMT:g.3A>G",
+                             "vcf": {"chrom": "M", "position": "3", "ref": "A", "alt": "G"}},
+            "chr1:g.6_7del": {"_id": "chr1:g.6_7del",
+                              "vcf": {"chrom": "1", "position": "5", "ref": "ACG", "alt": "A"}},
+            "chr1:g.9del": {"_id": "chr1:g.9del",
+                            "vcf": {"chrom": "1", "position": "8", "ref": "TA", "alt": "T"}},
+            "chr1:g.10_11insTT": {"_id": "chr1:g.10_11insTT",
+                                  "vcf": {"chrom": "1", "position": "10", "ref": "A", "alt": "ATT"}},
+            "chr1:g.12_13delinsC": {"_id": "chr1:g.12_13delinsC",
+                                    "vcf": {"chrom": "1", "position": "12", "ref": "GC", "alt": "C"}},
+            })
+
+    def test_out_of_range(self):
+        # can't be resolved, skipped
+        vcfs = VCFConstruct(self.genome).build_vcfs(["chr1:g.19_25del", "chr1:g.4del"])
+        eq_(list(vcfs), ["chr1:g.4del"])
+        ok_(vcfs["chr1:g.4del"]["vcf"]["ref"] == "GT")
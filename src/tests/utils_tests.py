@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for utils modules: HGVS IDs parsing (utils.hgvs), packed genome
+store (utils.genome), Bloom filter (utils.bloom) and secondary ID lookup
+files (utils.idlookup).
+Need to run under src folder as:
+
+    nosetests tests.utils_tests -vv
+'''
+import os
+import gzip
+import shutil
+import tempfile
+from nose.tools import ok_, eq_, assert_raises
+
+from utils.hgvs import parse_hgvs, parse_many, is_snp, reverse_complement_hgvs, \
+                       fix_hgvs_indel, get_pos_bins, get_pos_start_end, HgvsInfo
+from utils.genome import build_genome_store, is_genome_store, GenomeStore
+from utils.bloom import BloomFilter
+from utils.idlookup import build_id_lookup, IdLookup, get_id_lookup, get_values
+
+
+class HgvsTest(object):
+
+    def test_parse_hgvs(self):
+        eq_(parse_hgvs("chr1:g.35367G>A"), HgvsInfo("1", 35367, 35367, "snp", "G", "A"))
+        eq_(parse_hgvs("chrMT:g.8271A>T"), HgvsInfo("MT", 8271, 8271, "snp", "A", "T"))
+        eq_(parse_hgvs("chr1:g.1000del"), HgvsInfo("1", 1000, None, "del", "", None))
+        eq_(parse_hgvs("chr1:g.1000_1002del"), HgvsInfo("1", 1000, 1002, "del", "", None))
+        eq_(parse_hgvs("chr1:g.1000_1002delAGT"), HgvsInfo("1", 1000, 1002, "del", "AGT", None))
+        eq_(parse_hgvs("chr1:g.1000_1001insAT"), HgvsInfo("1", 1000, 1001, "ins", None, "AT"))
+        eq_(parse_hgvs("chrX:g.1000_1002delinsAT"), HgvsInfo("X", 1000, 1002, "delins", None, "AT"))
+        eq_(parse_hgvs("chr1:g.1000_1002dup"), HgvsInfo("1", 1000, 1002, "dup", "", None))
+        # legacy notation
+        eq_(parse_hgvs("chr19:g.58863869C>-"), HgvsInfo("19", 58863869, 58863869, "indel", "C", "-"))
+        eq_(parse_hgvs("rs58991260"), None)
+        eq_(parse_hgvs("chr1:35367G>A"), None)
+
+    def test_parse_many(self):
+        ids = ["chr1:g.35367G>A", "rs58991260", "chr1:g.1000_1001insAT"]
+        eq_(parse_many(ids), [parse_hgvs(_id) for _id in ids])
+
+    def test_is_snp(self):
+        ok_(is_snp("chr1:g.35367G>A"))
+        ok_(not is_snp("chr1:g.1000_1002del"))
+        ok_(not is_snp("chr19:g.58863869C>-"))
+        ok_(not is_snp("rs58991260"))
+
+    def test_reverse_complement_hgvs(self):
+        eq_(reverse_complement_hgvs("chr1:g.35367G>A"), "chr1:g.35367C>T")
+        eq_(reverse_complement_hgvs("chr1:g.1000_1001insAGG"), "chr1:g.1000_1001insCCT")
+        eq_(reverse_complement_hgvs("chr1:g.1000_1002delinsAC"), "chr1:g.1000_1002delinsGT")
+
+    def test_fix_hgvs_indel(self):
+        eq_(fix_hgvs_indel("chr19:g.58863869C>-"), "chr19:g.58863869_58863869del")
+        eq_(fix_hgvs_indel("chr10:g.52596077->T"), "chr10:g.52596077insT")
+        eq_(fix_hgvs_indel("chr1:g.35367G>A"), None)
+
+    def test_positions(self):
+        eq_(get_pos_start_end("1", 100, "A", "G"), (100, 100))
+        eq_(get_pos_start_end("1", "100", "ACG", "A"), (101, 102))
+        eq_(get_pos_start_end("1", 100, "AC", "A"), (101, 102))
+        eq_(get_pos_start_end("1", 100, "A", "ACG"), (100, 101))
+        assert_raises(ValueError, get_pos_start_end, "1", "x", "A", "G")
+        eq_(get_pos_bins(999, 999), [0])
+        eq_(get_pos_bins(999, 2000), [0, 1, 2])
+        eq_(get_pos_bins(2000, 999), [0, 1, 2])
+        eq_(get_pos_bins(999, 2000, coarse=True), [1000000])
+        eq_(get_pos_bins(63999, 1000000, coarse=True), list(range(1000000, 1000016)))
+
+
+# chromosome sequences, with lower case and non-ACGT bases, over several lines
+GENOME = {"1": "NNNNNNNNNNACGTacgtAAGGCCTTAGCTNNMRWACGTACGTAC",
+          "X": "GATTACAGATTACANNNNNNNNNNNNNNNNNNNNGATTACA"}
+
+
+class GenomeStoreTest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        for chrom, seq in GENOME.items():
+            with gzip.open(os.path.join(self.folder, "chr%s.fa.gz" % chrom), "wt") as f:
+                f.write(">chr%s\n" % chrom)
+                for i in range(0, len(seq), 7):
+                    f.write(seq[i:i+7] + "\n")
+        self.filename = os.path.join(self.folder, "genome.mv2bit")
+        build_genome_store(self.folder, self.filename, chr_range=sorted(GENOME))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_get_seq(self):
+        ok_(is_genome_store(self.filename))
+        store = GenomeStore(self.filename)
+        try:
+            eq_(sorted(store.chroms()), sorted(GENOME))
+            ok_("1" in store and not "2" in store)
+            for chrom, seq in GENOME.items():
+                seq = seq.upper()
+                eq_(store.get_length(chrom), len(seq))
+                # every range, so all offsets in packed bytes and
+                # overlaps with non-ACGT runs are checked
+                for start in range(1, len(seq) + 1):
+                    for end in range(start, len(seq) + 1):
+                        eq_(store.get_seq(chrom, start, end), seq[start-1:end])
+                eq_(store.get_base(chrom, 1), seq[0])
+            assert_raises(ValueError, store.get_seq, "1", 0, 3)
+            assert_raises(ValueError, store.get_seq, "1", 3, 2)
+            assert_raises(ValueError, store.get_seq, "X", 1, len(GENOME["X"]) + 1)
+            assert_raises(KeyError, store.get_seq, "2", 1, 1)
+        finally:
+            store.close()
+
+    def test_not_a_store(self):
+        fn = os.path.join(self.folder, "chr1.fa.gz")
+        ok_(not is_genome_store(fn))
+        ok_(not is_genome_store(os.path.join(self.folder, "nope")))
+        assert_raises(ValueError, GenomeStore, fn)
+
+
+class BloomFilterTest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "ids.bloom")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_no_false_negatives(self):
+        keys = ["chr%d:g.%dA>G" % (i % 22 + 1, i) for i in range(20000)]
+        bf = BloomFilter(self.filename, capacity=len(keys), error_rate=0.01)
+        bf.update(keys)
+        ok_(all([k in bf for k in keys]))
+        eq_(bf.count, len(keys))
+        others = ["chr%d:g.%dC>T" % (i % 22 + 1, i) for i in range(20000)]
+        fp = len([k for k in others if k in bf]) / len(others)
+        # blocked filter, a bit above the requested rate
+        ok_(fp < 0.02, fp)
+        bf.close()
+
+    def test_persistence(self):
+        bf = BloomFilter(self.filename, capacity=1000)
+        bf.update(["a", "b"])
+        ok_(not bf.complete)
+        bf.complete = True
+        bf.close()
+        bf = BloomFilter(self.filename)
+        ok_(bf.complete)
+        eq_(bf.count, 2)
+        eq_(bf.capacity, 1000)
+        ok_("a" in bf and "b" in bf)
+        # read-only filter doesn't write header back
+        ro = BloomFilter(self.filename, readonly=True)
+        bf.add("c")
+        bf.flush()
+        ok_("c" in ro)
+        ro.close()
+        eq_(BloomFilter(self.filename, readonly=True).count, 3)
+        bf.clear()
+        ok_(not bf.complete)
+        eq_(bf.count, 0)
+        ok_("a" not in bf)
+        bf.close()
+
+    def test_invalid_file(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"not a bloom filter, not at all" * 4)
+        assert_raises(ValueError, BloomFilter, self.filename)
+
+
+DOCS = [{"_id": "chr1:g.1A>G", "dbsnp": {"rsid": "rs1"}, "clinvar": [{"rcv": {"accession": "RCV01"}},
+                                                                      {"rcv": {"accession": "RCV02"}}]},
+        {"_id": "chr1:g.1A>T", "dbsnp": {"rsid": "rs1"}},
+        {"_id": "chr2:g.2A>G", "dbsnp": {"rsid": "RS2"}, "clinvar": {"rcv": [{"accession": "rcv03"}]}},
+        {"_id": "chr3:g.3A>G"}]
+
+
+class IdLookupTest(object):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.filename = os.path.join(self.folder, "target.idlookup")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_get_values(self):
+        eq_(get_values(DOCS[0], "clinvar.rcv.accession"), ["RCV01", "RCV02"])
+        eq_(get_values(DOCS[2], "clinvar.rcv.accession"), ["rcv03"])
+        eq_(get_values(DOCS[3], "dbsnp.rsid"), [])
+
+    def test_lookup(self):
+        # tiny chunks, so sorted chunks are merged
+        nkeys = build_id_lookup(iter(DOCS), ["dbsnp.rsid", "clinvar.rcv.accession"],
+                                self.filename, chunk_size=2)
+        eq_(nkeys, 5)
+        # only the lookup file is left
+        eq_(os.listdir(self.folder), ["target.idlookup"])
+        lookup = IdLookup(self.filename)
+        try:
+            eq_(len(lookup), 5)
+            eq_(lookup.get("rs1"), ["chr1:g.1A>G", "chr1:g.1A>T"])
+            eq_(lookup.get("rs2"), ["chr2:g.2A>G"])
+            eq_(lookup.get("RCV03"), ["chr2:g.2A>G"])
+            eq_(lookup.get("rcv02"), ["chr1:g.1A>G"])
+            eq_(lookup.get("rs0"), None)
+            eq_(lookup.get("rs3"), None)
+            eq_(lookup.get("zzz"), None)
+        finally:
+            lookup.close()
+
+    def test_get_id_lookup(self):
+        eq_(get_id_lookup(self.filename), None)
+        build_id_lookup(DOCS, ["dbsnp.rsid"], self.filename)
+        first = get_id_lookup(self.filename)
+        ok_(get_id_lookup(self.filename) is first)
+        # replaced file is reopened
+        build_id_lookup(DOCS[:1], ["dbsnp.rsid"], self.filename)
+        os.utime(self.filename, (0, 0))
+        second = get_id_lookup(self.filename)
+        ok_(second is not first)
+        eq_(second.get("rs2"), None)
+        # previous one is still usable
+        eq_(first.get("rs2"), ["chr2:g.2A>G"])
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests for web API helpers: interval queries parsing
+(www.api.query_builder), ES queries (www.api.query, with a fake ES client)
+/variant responses cache (www.api.cache) and POST responses transformation
+(www.api.transform).
+Need to run under src folder as:
+
+    nosetests tests.www_tests -vv
+'''
+import json
+import time
+from nose.tools import ok_, eq_, assert_raises
+
+from biothings.utils.common import dotdict
+from biothings.www.api.es.query import BiothingSearchError
+from www.api.query_builder import parse_interval_query, PATTERNS, ESQueryBuilder
+from www.api.query import ESQuery, PAGING_TIEBREAKER
+from www.api.cache import ResponseCache
+from www.api.transform import ESResultTransformer
+from biothings.www.api.es.transform import ESResultTransformer as BaseTransformer
+
+
+def search_interval_query(q):
+    ''' Previous implementation, searching each of PATTERNS in q '''
+    for pattern in PATTERNS:
+        m = pattern.search(q)
+        if m:
+            r = m.groupdict()
+            if r['pre_query']:
+                r['query'] = r['pre_query'].rstrip(r['pre_and']).rstrip()
+                if r['post_query']:
+                    r['query'] += ' ' + r['post_query']
+            elif r['post_query']:
+                r['query'] = r['post_query'].lstrip(r['post_and']).lstrip()
+            else:
+                r['query'] = None
+            return r
+    return False
+
+
+QUERIES = [
+    "chr1:69000-70000", "chr1:69,000-70,000", "chrX:1000", "chrMT:8271",
+    " chr2:100-200 ", "chr23:1-2", "chrZ:1-2", "chr1:", "chr1:-10",
+    "chr1:100-200 AND dbnsfp.polyphen2.hdiv.score:>0.99",
+    "dbnsfp.genename:CDK2 AND chr1:100-200",
+    "dbnsfp.genename:CDK2 and chr1:100-200 and cadd.phred:>10",
+    "cadd.phred:>10 AND dbsnp.vartype:snp AND chr1:100",
+    "chr1:100 AND", "AND chr1:100", "andchr1:100-200", "chr1:100-200and",
+    "band chr1:100-200 ANDx", "chr1:100-200 AND chr2:300-400",
+    "chr1:100 AND chr2:300-400", "candidate chr1:100-200",
+    "chr1:100 AND chr2:300 and more",
+    "rs58991260", "CDK2", "chr1:g.35367G>A", "chr1:35367G>A",
+    "chr1:100-200\nAND cadd.phred:>10", "cadd.phred:>10 AND\nchr1:100",
+    "", "and", "chr", ":",
+]
+
+
+class IntervalQueryTest(object):
+
+    def test_same_as_search(self):
+        for q in QUERIES:
+            eq_(parse_interval_query(q), search_interval_query(q), q)
+
+    def test_cached(self):
+        q = "dbnsfp.genename:CDK2 AND chr1:100-200"
+        r = parse_interval_query(q)
+        ok_(parse_interval_query(q) is r)
+        eq_(r["chr"], "1")
+        eq_(r["query"], "dbnsfp.genename:CDK2")
+        # builder gets its own copy, cached result isn't altered
+        r2 = ESQueryBuilder._parse_interval_query(None, q)
+        ok_(r2 is not r)
+        r2["query"] = None
+        eq_(parse_interval_query(q)["query"], "dbnsfp.genename:CDK2")
+        eq_(ESQueryBuilder._parse_interval_query(None, "CDK2"), False)
+
+    def test_bins(self):
+        def bins(q, interval_bins=True):
+            builder = ESQueryBuilder(index="myvariant_current_hg19", doc_type="variant", es_options={},
+                                     options=dotdict({"assembly": "hg19", "interval_bins": interval_bins}))
+            return builder._interval_bins(parse_interval_query(q))
+        eq_(bins("chr1:1000-2999"), [1, 2])
+        eq_(bins("chr1:1000-2999", interval_bins=False), None)
+        eq_(len(bins("chr1:1,000,000-1,127,999")), 128)
+        # 64kb bins for wider regions
+        eq_(bins("chr1:1000000-2000000"), list(range(1000015, 1000032)))
+        eq_(bins("chr1:1000000-20000000"), None)
+
+
+class ResponseCacheTest(object):
+
+    def test_lru(self):
+        cache = ResponseCache(2, ttl=60)
+        cache.set("a", b"1")
+        cache.set("b", b"2")
+        eq_(cache.get("a"), b"1")
+        # "b" is least recently used
+        cache.set("c", b"3")
+        eq_(len(cache), 2)
+        eq_(cache.get("b"), None)
+        eq_(cache.get("a"), b"1")
+        eq_(cache.get("c"), b"3")
+        eq_((cache.hits, cache.misses), (3, 1))
+
+    def test_ttl(self):
+        cache = ResponseCache(10, ttl=0.05)
+        cache.set("a", b"1")
+        eq_(cache.get("a"), b"1")
+        time.sleep(0.1)
+        eq_(cache.get("a"), None)
+        eq_(len(cache), 0)
+        eq_(cache.nbytes, 0)
+
+    def test_max_bytes(self):
+        cache = ResponseCache(10, ttl=60, max_bytes=10)
+        cache.set("a", b"x" * 4)
+        cache.set("b", b"x" * 4)
+        eq_(cache.nbytes, 8)
+        cache.set("c", b"x" * 4)
+        eq_(cache.get("a"), None)
+        eq_(cache.nbytes, 8)
+        # larger than the whole cache, not cached
+        cache.set("d", b"x" * 11)
+        eq_(cache.get("d"), None)
+        eq_(len(cache), 2)
+        # replaced entry is accounted once
+        cache.set("b", b"x" * 2)
+        eq_(cache.nbytes, 6)
+        # size given for non-serialized values
+        cache.set("e", (b"x" * 3, "etag"), nbytes=3)
+        eq_(cache.get("e"), (b"x" * 3, "etag"))
+        eq_(cache.nbytes, 9)
+        cache.clear()
+        eq_((len(cache), cache.nbytes), (0, 0))
+
+
+class FakeES(object):
+    ''' Fake ES client, docs by _id, search returns all of them.
+    msearch: {"query": {"term": {"total": n}}} searches match n docs '''
+
+    def __init__(self, docs=None):
+        self.docs = docs or {}
+        self.calls = []
+
+    def mget(self, body, index, doc_type, **kwargs):
+        self.calls.append(("mget", body["ids"]))
+        return {"docs": [dict(self.docs[_id], _index=index, _type=doc_type, _version=1, found=True)
+                         if _id in self.docs else
+                         {"_index": index, "_type": doc_type, "_id": _id, "found": False}
+                         for _id in body["ids"]]}
+
+    def search(self, **kwargs):
+        self.calls.append(("search", kwargs["body"]))
+        hits = [dict(doc, _score=1.0) for doc in self.docs.values()]
+        return {"hits": {"total": len(hits), "hits": hits}}
+
+    def msearch(self, body, **kwargs):
+        bodies = [json.loads(line) for line in body.split("\n")[1::2]]
+        self.calls.append(("msearch", bodies))
+        responses = []
+        for search in bodies:
+            total = search["query"]["term"]["total"]
+            start = search.get("from", 0)
+            hits = [{"_id": str(i)} for i in range(start, min(start + search.get("size", 10), total))]
+            responses.append({"hits": {"total": total, "hits": hits}})
+        return {"responses": responses}
+
+
+RSID_DOCS = {"chr1:g.1A>G": {"_id": "chr1:g.1A>G", "_source": {"dbsnp": {"rsid": "rs1"}}},
+             "chr1:g.1A>T": {"_id": "chr1:g.1A>T", "_source": {"dbsnp": {"rsid": "rs1"}}}}
+SEARCH = {"index": "myvariant_current_hg19", "doc_type": "variant",
+          "body": {"query": {"match": {"dbsnp.rsid": "rs1"}}}}
+
+
+def lookup_query(ids):
+    return {"index": "myvariant_current_hg19", "doc_type": "variant",
+            "body": {"ids": ids}, "fallback": dict(SEARCH)}
+
+
+class AnnotationGETTest(object):
+
+    def test_mget(self):
+        client = FakeES(RSID_DOCS)
+        res = ESQuery(client)._annotation_GET_query(lookup_query(sorted(RSID_DOCS)))
+        eq_(client.calls, [("mget", sorted(RSID_DOCS))])
+        eq_(res["hits"]["total"], 2)
+        eq_([hit["_id"] for hit in res["hits"]["hits"]], sorted(RSID_DOCS))
+        # same fields as search hits (but _score)
+        for hit in res["hits"]["hits"]:
+            ok_("_version" not in hit and "found" not in hit)
+            eq_(hit["_source"], RSID_DOCS[hit["_id"]]["_source"])
+
+    def test_stale_lookup(self):
+        # one doc is gone, search is run instead
+        client = FakeES(RSID_DOCS)
+        res = ESQuery(client)._annotation_GET_query(lookup_query(["chr1:g.1A>C", "chr1:g.1A>G"]))
+        eq_([c[0] for c in client.calls], ["mget", "search"])
+        eq_(res["hits"]["total"], 2)
+
+    def test_no_lookup(self):
+        client = FakeES(RSID_DOCS)
+        ESQuery(client)._annotation_GET_query(dict(SEARCH))
+        eq_([c[0] for c in client.calls], ["search"])
+
+
+def search_lines(*searches):
+    lines = []
+    for (total, kwargs) in searches:
+        lines.extend(["{}", json.dumps(dict({"query": {"term": {"total": total}}}, **kwargs))])
+    return {"index": "myvariant_current_hg19", "doc_type": "variant", "body": "\n".join(lines)}
+
+
+PAGED = {"size": 10, "sort": [{"hg19.start": "asc"}, PAGING_TIEBREAKER]}
+
+
+class QueryPOSTTest(object):
+
+    def setUp(self):
+        self.max_paged_hits = ESQuery.MAX_PAGED_HITS
+        self.max_post_hits = ESQuery.MAX_POST_HITS
+
+    def tearDown(self):
+        ESQuery.MAX_PAGED_HITS = self.max_paged_hits
+        ESQuery.MAX_POST_HITS = self.max_post_hits
+
+    def builder(self, fetch_all, **es_options):
+        return ESQueryBuilder(index="myvariant_current_hg19", doc_type="variant", es_options=es_options,
+                              options=dotdict({"assembly": "hg19", "fetch_all": fetch_all}))
+
+    def test_build(self):
+        terms = ["chr1:100-200", "rs58991260"]
+        # size/from per term by default, interval terms aren't paged
+        bodies = self.builder(False, size=5, **{"from": 2})._query_POST_query(terms, None)["body"].split("\n")
+        interval, rsid = [json.loads(b) for b in bodies[1::2]]
+        ok_("sort" not in interval)
+        eq_((interval["size"], interval["from"]), (5, 2))
+        ok_("range" in json.dumps(interval))
+        eq_((rsid["size"], rsid["from"]), (5, 2))
+        # paged on request, from first page of given size
+        bodies = self.builder(True, size=5)._query_POST_query(terms, None)["body"].split("\n")
+        interval, rsid = [json.loads(b) for b in bodies[1::2]]
+        eq_(interval["sort"][-1], PAGING_TIEBREAKER)
+        eq_(interval["size"], 5)
+        ok_("sort" not in rsid)
+        bodies = self.builder(True)._query_POST_query(terms, None)["body"].split("\n")
+        eq_(json.loads(bodies[1])["size"], ESQueryBuilder.INTERVAL_PAGE_SIZE)
+
+    def test_not_paged(self):
+        client = FakeES()
+        res = ESQuery(client)._query_POST_query(search_lines((25, {}), (25, {"size": 5, "from": 3})))
+        eq_(len(client.calls), 1)
+        eq_([len(r["hits"]["hits"]) for r in res["responses"]], [10, 5])
+        eq_(res["responses"][1]["hits"]["hits"][0]["_id"], "3")
+
+    def test_paged(self):
+        ESQuery.MAX_PAGED_HITS = 30
+        client = FakeES()
+        res = ESQuery(client)._query_POST_query(search_lines(
+                (25, PAGED), (5, PAGED), (45, PAGED), (25, dict(PAGED, **{"from": 12})), (25, {})))
+        responses = res["responses"]
+        eq_([r["hits"]["hits"] for r in responses[:2]],
+            [[{"_id": str(i)} for i in range(25)], [{"_id": str(i)} for i in range(5)]])
+        # MAX_PAGED_HITS reached
+        eq_(len(responses[2]["hits"]["hits"]), 30)
+        ok_(responses[2]["truncated"])
+        eq_(responses[3]["hits"]["hits"], [{"_id": str(i)} for i in range(12, 25)])
+        eq_(len(responses[4]["hits"]["hits"]), 10)
+        eq_([r.get("truncated", False) for r in responses], [False, False, True, False, False])
+        # next pages of all paged searches in each round
+        eq_(len(client.calls), 3)
+
+    def test_max_hits(self):
+        ESQuery.MAX_POST_HITS = 50
+        client = FakeES()
+        # sizes only, rejected before searching
+        assert_raises(BiothingSearchError, ESQuery(client)._query_POST_query,
+                      search_lines(*[(25, {"size": 20})] * 3))
+        eq_(client.calls, [])
+        # rejected from paged totals, before fetching next pages
+        assert_raises(BiothingSearchError, ESQuery(client)._query_POST_query,
+                      search_lines((45, PAGED), (25, PAGED)))
+        eq_(len(client.calls), 1)
+        res = ESQuery(client)._query_POST_query(search_lines((45, PAGED), (25, {"size": 5})))
+        eq_(len(res["responses"][0]["hits"]["hits"]), 45)
+
+
+class DefaultTransformer(ESResultTransformer):
+    # hit after hit, as biothings does
+    _sort_and_annotate_doc = BaseTransformer._sort_and_annotate_doc
+    _clean_common_POST_response = BaseTransformer._clean_common_POST_response
+
+
+METADATA = {"hg19": {"dbsnp": {"license_url_short": "http://bit.ly/dbsnp"},
+                     "cadd": {"license_url": "http://cadd"}}}
+
+
+def post_response():
+    hits = [{"_id": "chr1:g.1A>G", "_score": 2.0,
+             "_source": {"dbsnp": {"rsid": "rs1", "alleles": [{"freq": 0.9, "allele": "A"}]},
+                         "cadd": [{"phred": 10}, {"phred": 12}], "chrom": "1"}},
+            {"_id": "chr1:g.2A>G", "_score": 1.0, "_source": {"dbsnp": {"rsid": "rs2"}}}]
+    return {"responses": [{"hits": {"total": 1, "hits": hits[:1]}},
+                          {"hits": {"total": 0, "hits": []}},
+                          {"hits": {"total": 2, "hits": hits}}]}
+
+
+class TransformTest(object):
+
+    def transform(self, cls, options, single_hit=True, aliases={}):
+        options = dotdict(dict({"assembly": "hg19", "_sorted": True}, **options))
+        transformer = cls(options, "localhost", source_metadata=METADATA, output_aliases=aliases)
+        return json.dumps([transformer.clean_annotation_POST_response(["a", "b", "c"], post_response(), single_hit),
+                           transformer.clean_query_POST_response(["a", "b", "c"], post_response(), single_hit)])
+
+    def test_same_as_default(self):
+        for (options, aliases) in [({}, {}), ({"dotfield": True}, {}), ({"_sorted": False}, {}),
+                                   ({}, {"dbsnp": "snp"})]:
+            for single_hit in (True, False):
+                eq_(self.transform(ESResultTransformer, options, single_hit, aliases),
+                    self.transform(DefaultTransformer, options, single_hit, aliases))
+        res = json.loads(self.transform(ESResultTransformer, {}))[0]
+        eq_(res[0]["dbsnp"]["_license"], "http://bit.ly/dbsnp")
+        eq_([d["_license"] for d in res[0]["cadd"]], ["http://cadd"] * 2)
+        eq_(list(res[0]), ["query", "_id", "cadd", "chrom", "dbsnp"])
+
+    def test_error_truncated(self):
+        res = post_response()
+        res["responses"][1] = {"error": "failed"}
+        res["responses"][2]["truncated"] = True
+        out = ESResultTransformer(dotdict({"assembly": "hg19", "_sorted": True}), "localhost",
+                                  source_metadata=METADATA).clean_query_POST_response(["a", "b", "c"], res)
+        eq_(out[1], {"query": "b", "error": True})
+        eq_([r["_id"] for r in out[2:4]], ["chr1:g.1A>G", "chr1:g.2A>G"])
+        eq_(out[4], {"query": "c", "truncated": True, "total": 2})
@@ -0,0 +1,6 @@
+'''
+MongoDB aggregation expressions shared by hub modules (build, sync, ...)
+'''
+
+# aggregation expression returning the list of root key names of a document
+ROOT_KEYS = {"$map" : {"input" : {"$objectToArray" : "$$ROOT"}, "as" : "kv", "in" : "$$kv.k"}}
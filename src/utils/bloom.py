@@ -0,0 +1,128 @@
+'''
+Persistent Bloom filter, backed by a mmap'ed file.
+
+Used to quickly tell whether a key was *never* added (no false negatives),
+positive answers may be wrong (false positive rate given at creation) and
+should be confirmed against the actual data when it matters.
+
+File layout (little-endian):
+    magic (4 bytes) | version (uint32) | number of bits (uint64) |
+    number of hashes (uint32) | number of added keys (uint64) |
+    complete flag (uint8) | capacity (uint64) | bits...
+
+Bits are grouped in 64-byte blocks, all bits of a key being in one block.
+'''
+import os
+import math
+import mmap
+import struct
+import hashlib
+
+MAGIC = b"MVBF"
+VERSION = 2
+
+_HEADER = struct.Struct("<4sIQIQBQ")
+# bits of a key are all in one block (one cache line), so adding or looking
+# up a key touches one page of the file, not nhashes random ones
+BLOCK_BYTES = 64
+BLOCK_BITS = BLOCK_BYTES * 8
+_BIT_MASK = BLOCK_BITS - 1
+_DIGEST = struct.Struct("<QQ")
+
+
+class BloomFilter(object):
+    '''Blocked Bloom filter: a key selects one block and sets nhashes bits
+       in it, positions derived from one sha1 digest with double hashing'''
+
+    def __init__(self, filename, capacity=10**7, error_rate=0.01, readonly=False):
+        '''open Bloom filter from filename, or create it sized to hold
+           capacity keys with error_rate false positive rate. readonly
+           filters can be used while another process adds keys'''
+        self.filename = filename
+        self.readonly = readonly
+        if not readonly and not os.path.exists(filename):
+            nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+            nbits += -nbits % BLOCK_BITS
+            nhashes = max(1, int(round(nbits / capacity * math.log(2))))
+            with open(filename, "wb") as f:
+                f.write(_HEADER.pack(MAGIC, VERSION, nbits, nhashes, 0, 0, capacity))
+                # sparse file, bits are all 0
+                f.truncate(_HEADER.size + nbits // 8)
+        self._file = open(filename, readonly and "rb" or "r+b")
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=readonly and mmap.ACCESS_READ or mmap.ACCESS_WRITE)
+            if len(self._mm) < _HEADER.size:
+                raise ValueError("'%s' is not a Bloom filter file" % filename)
+            magic, version, self.nbits, self.nhashes, self.count, complete, self.capacity = \
+                    _HEADER.unpack_from(self._mm, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("'%s' is not a Bloom filter file (or unsupported version)" % filename)
+        except:
+            self._file.close()
+            raise
+        self.nblocks = self.nbits // BLOCK_BITS
+        self._complete = bool(complete)
+
+    def _locate(self, key):
+        '''return offset of key's block, first bit position and step:
+           key's bits are found with double hashing in its block'''
+        h1, h2 = _DIGEST.unpack_from(hashlib.sha1(key.encode()).digest())
+        # step is odd, so positions in block are all different
+        return _HEADER.size + (h1 % self.nblocks) * BLOCK_BYTES, h2, (h2 >> 9) | 1
+
+    def add(self, key):
+        mm = self._mm
+        offset, pos, step = self._locate(key)
+        for _ in range(self.nhashes):
+            bit = pos & _BIT_MASK
+            mm[offset + (bit >> 3)] |= 1 << (bit & 7)
+            pos += step
+        self.count += 1
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def __contains__(self, key):
+        mm = self._mm
+        offset, pos, step = self._locate(key)
+        for _ in range(self.nhashes):
+            bit = pos & _BIT_MASK
+            if not mm[offset + (bit >> 3)] & (1 << (bit & 7)):
+                return False
+            pos += step
+        return True
+
+    @property
+    def complete(self):
+        '''True when the filter was flagged as holding all keys from its
+           reference data (so negative answers can be trusted without
+           checking that data)'''
+        return self._complete
+
+    @complete.setter
+    def complete(self, value):
+        self._complete = bool(value)
+        self.flush()
+
+    def clear(self):
+        '''reset all bits, filter is flagged as not complete'''
+        self._mm.close()
+        self._file.truncate(_HEADER.size)
+        self._file.truncate(_HEADER.size + self.nbits // 8)
+        self._mm = mmap.mmap(self._file.fileno(), 0)
+        self.count = 0
+        self.complete = False
+
+    def flush(self):
+        if self.readonly:
+            return
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, self.nbits, self.nhashes,
+                          self.count, int(self._complete), self.capacity)
+        self._mm.flush()
+
+    def close(self):
+        self.flush()
+        self._mm.close()
+        self._file.close()
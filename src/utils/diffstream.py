@@ -0,0 +1,202 @@
+'''
+Streamable diff file format, used instead of pickled diff dicts (.pyobj, see
+biothings.utils.common.loadobj()) so sync processes can start right away and
+only keep a few lines in memory, whatever the size of the diff. Diff files
+are written from collections with diff_collections_file(), or converted
+from pickled diffs with convert_diff().
+
+File layout:
+    magic line ("MVDIFF1\n")
+    sections: one gzip member per section ("add", "delete", "update"),
+              one JSON value per line: _ids for "add" and "delete",
+              {"_id": ..., "patch": ...} docs for "update"
+    index:    JSON object, {"source": ..., "sections": {name: {"offset": ...,
+              "length": ..., "count": ...}}, ...other diff metadata}
+    trailer:  index offset (uint64, little-endian) | magic ("MVDIFFIX")
+
+Each section can be read on its own (seek to its offset, decompress its
+length), and several times (even concurrently).
+'''
+import os
+import json
+import zlib
+import struct
+
+from biothings.utils.common import loadobj, get_timestamp
+
+MAGIC = b"MVDIFF1\n"
+INDEX_MAGIC = b"MVDIFFIX"
+DIFF_EXT = ".mvdiff"
+SECTIONS = ["add", "delete", "update"]
+
+_TRAILER = struct.Struct("<Q8s")
+_READ_SIZE = 1024 * 1024
+
+
+class DiffWriter(object):
+    '''Write a diff file, section by section: sections are iterables,
+       written as they're consumed'''
+
+    def __init__(self, filename, source, **meta):
+        self.filename = filename
+        self.index = dict(meta)
+        self.index["source"] = source
+        self.index["sections"] = {}
+        self._file = open(filename, "wb")
+        self._file.write(MAGIC)
+
+    def write_section(self, name, items):
+        if name in self.index["sections"]:
+            raise ValueError("Section '%s' already written" % name)
+        offset = self._file.tell()
+        # wbits=31: gzip member
+        comp = zlib.compressobj(6, zlib.DEFLATED, 31)
+        count = 0
+        buf = []
+        for item in items:
+            buf.append(json.dumps(item))
+            count += 1
+            if len(buf) >= 10000:
+                self._file.write(comp.compress(("\n".join(buf) + "\n").encode()))
+                buf = []
+        if buf:
+            self._file.write(comp.compress(("\n".join(buf) + "\n").encode()))
+        self._file.write(comp.flush())
+        self.index["sections"][name] = {"offset": offset,
+                                        "length": self._file.tell() - offset,
+                                        "count": count}
+        return count
+
+    def close(self):
+        for name in SECTIONS:
+            if name not in self.index["sections"]:
+                self.write_section(name, [])
+        offset = self._file.tell()
+        self._file.write(json.dumps(self.index, default=str).encode() + b"\n")
+        self._file.write(_TRAILER.pack(offset, INDEX_MAGIC))
+        self._file.close()
+
+    def abort(self):
+        '''close and remove incomplete file'''
+        self._file.close()
+        os.remove(self.filename)
+
+
+class DiffSection(object):
+    '''Items of a diff file section, streamed from the file each time it's
+       iterated over. len() comes from the index'''
+
+    def __init__(self, filename, name, offset, length, count):
+        self.filename = filename
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        decomp = zlib.decompressobj(31)
+        left = self.length
+        tail = b""
+        with open(self.filename, "rb") as f:
+            f.seek(self.offset)
+            while left > 0:
+                data = f.read(min(_READ_SIZE, left))
+                if not data:
+                    raise IOError("Truncated section '%s' in '%s'" % (self.name, self.filename))
+                left -= len(data)
+                lines = (tail + decomp.decompress(data)).split(b"\n")
+                tail = lines.pop()
+                for line in lines:
+                    yield json.loads(line.decode())
+        tail += decomp.flush()
+        if tail:
+            yield json.loads(tail.decode())
+
+
+def is_diff_file(filename):
+    with open(filename, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def load_diff(filename):
+    ''' Return diff from filename as a dict ("source", "add", "delete",
+    "update" keys, plus other metadata). From a diff file, sections are
+    DiffSection objects (streamed). Otherwise, file is a pickled diff, loaded
+    in memory as before '''
+    if not is_diff_file(filename):
+        return loadobj(filename)
+    with open(filename, "rb") as f:
+        f.seek(-_TRAILER.size, os.SEEK_END)
+        offset, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            raise ValueError("'%s' has no diff index (truncated file?)" % filename)
+        f.seek(offset)
+        index = json.loads(f.readline().decode())
+    diff = dict([(k, v) for (k, v) in index.items() if k != "sections"])
+    for name, sec in index["sections"].items():
+        diff[name] = DiffSection(filename, name, sec["offset"], sec["length"], sec["count"])
+    return diff
+
+
+def _split_ids(col, other, batch_size):
+    '''yield (_ids, _ids also in other) for each batch of _ids in col'''
+    from biothings.utils.mongo import id_feeder
+    for ids in id_feeder(col, batch_size=batch_size):
+        found = set([d['_id'] for d in other.target_collection.find({'_id': {'$in': ids}}, projection=[])])
+        yield ids, found
+
+
+def diff_collections_file(old_db_col_names, new_db_col_names, filename, batch_size=10000, exclude=[]):
+    '''Compare new with old collections (backends, or anything
+       biothings.databuild.backend.create_backend() accepts) and write the
+       result to diff file filename, batch by batch: memory usage doesn't
+       depend on the size of the diff. Returns number of items per section'''
+    from biothings.databuild.backend import create_backend
+    from biothings.utils.diff import diff_docs_jsonpatch
+    old = create_backend(old_db_col_names)
+    new = create_backend(new_db_col_names)
+
+    def added():
+        for ids, found in _split_ids(new, old, batch_size):
+            for _id in ids:
+                if _id not in found:
+                    yield _id
+
+    def deleted():
+        for ids, found in _split_ids(old, new, batch_size):
+            for _id in ids:
+                if _id not in found:
+                    yield _id
+
+    def updated():
+        for ids, found in _split_ids(new, old, batch_size):
+            common = [_id for _id in ids if _id in found]
+            if common:
+                for patch in diff_docs_jsonpatch(old, new, common, exclude_attrs=exclude):
+                    yield patch
+
+    writer = DiffWriter(filename, new.target_name, timestamp=get_timestamp())
+    try:
+        for name, items in [("add", added()), ("delete", deleted()), ("update", updated())]:
+            writer.write_section(name, items)
+    except:
+        writer.abort()
+        raise
+    writer.close()
+    return dict([(name, sec["count"]) for (name, sec) in writer.index["sections"].items()])
+
+
+def convert_diff(pyobj_file, outfile=None):
+    '''convert pickled diff pyobj_file to a diff file (same name, DIFF_EXT
+       extension by default). Returns the diff file name'''
+    outfile = outfile or os.path.splitext(pyobj_file)[0] + DIFF_EXT
+    diff = loadobj(pyobj_file)
+    meta = dict([(k, v) for (k, v) in diff.items() if k not in SECTIONS + ["source"]])
+    writer = DiffWriter(outfile, diff["source"], **meta)
+    for name in SECTIONS:
+        writer.write_section(name, diff.get(name, []))
+    writer.close()
+    return outfile
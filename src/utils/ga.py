@@ -1,12 +1,107 @@
+'''
+Google Analytics tracking. ga_track() only queues a few details about the
+request (no I/O, no tracker objects). Queued hits are built and sent every
+FLUSH_INTERVAL seconds, in batches (Measurement Protocol "batch" endpoint,
+up to BATCH_SIZE hits per request), with at most MAX_IN_FLIGHT batch requests
+running at once: the queue keeps being drained as requests complete. The
+queue is bounded: when it's full, new events are dropped (and counted in
+GAQueue.dropped).
+'''
+import uuid
+from collections import deque
+from urllib.parse import urlencode
+
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
-from pyga.requests import (Tracker, Page, Session, Visitor,
-                           Event, PageViewRequest, EventRequest)
+from tornado.ioloop import PeriodicCallback
 import config
 
+GA_BATCH_URL = 'https://www.google-analytics.com/batch'
+# max number of hits in one batch request (Measurement Protocol limit)
+BATCH_SIZE = 20
+# seconds between two flushes
+FLUSH_INTERVAL = 10
+# max number of queued events
+MAX_QUEUED = 10000
+# max number of batch requests sent and not completed yet
+MAX_IN_FLIGHT = 4
+
+
+def client_id(remote_ip, user_agent):
+    ''' Return a stable client ID for remote_ip and user_agent (as pyga's
+    visitors were identified), so hits from a same client are counted as
+    one user and its hits grouped in sessions '''
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, '%s|%s' % (remote_ip, user_agent or '')))
+
+
+def build_hits(path, remote_ip, user_agent, language, event):
+    ''' Return Measurement Protocol payloads (pageview, plus event if any)
+    for a tracked request '''
+    common = [('v', 1), ('tid', config.GA_ACCOUNT), ('cid', client_id(remote_ip, user_agent)),
+              ('uip', remote_ip), ('ua', user_agent or ''), ('ul', language or ''),
+              ('dh', getattr(config, 'GA_TRACKER_URL', 'MyVariant.info')), ('dp', path)]
+    hits = [urlencode(common + [('t', 'pageview')])]
+    if event:
+        params = common + [('t', 'event'), ('ec', event['category']), ('ea', event['action'])]
+        for k, p in (('label', 'el'), ('value', 'ev')):
+            if event.get(k) is not None:
+                params.append((p, event[k]))
+        hits.append(urlencode(params))
+    return hits
+
+
+class GAQueue(object):
+    ''' Bounded queue of tracked requests, flushed periodically on the IOLoop '''
+
+    def __init__(self, maxlen=MAX_QUEUED, flush_interval=FLUSH_INTERVAL, max_in_flight=MAX_IN_FLIGHT):
+        self.events = deque()
+        self.maxlen = maxlen
+        self.flush_interval = flush_interval
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.dropped = 0
+        self.failed = 0
+        self._flusher = None
+
+    def add(self, *args):
+        if len(self.events) >= self.maxlen:
+            self.dropped += 1
+            return
+        self.events.append(args)
+        if self._flusher is None:
+            # started lazily, so it runs on the server's IOLoop
+            self._flusher = PeriodicCallback(self.flush, self.flush_interval * 1000)
+            self._flusher.start()
+
+    def next_batch(self):
+        ''' Pop queued events and return their hits, up to BATCH_SIZE '''
+        hits = []
+        # an event is at most 2 hits, and 2 hits of the same event
+        # are sent together
+        while self.events and len(hits) < BATCH_SIZE - 1:
+            hits.extend(build_hits(*self.events.popleft()))
+        return hits
+
+    def _fetched(self, f):
+        self.in_flight -= 1
+        # GA errors don't matter much, just don't leave them unretrieved
+        if f.exception():
+            self.failed += 1
+        # keep draining the queue, a slot is free
+        self.flush()
+
+    def flush(self):
+        http_client = AsyncHTTPClient()
+        while self.events and self.in_flight < self.max_in_flight:
+            req = HTTPRequest(GA_BATCH_URL, method="POST", body="\n".join(self.next_batch()))
+            self.in_flight += 1
+            http_client.fetch(req).add_done_callback(self._fetched)
+
+
+_queue = GAQueue()
+
 
 class GAMixIn:
     def ga_track(self, event={}):
-        _req_list = []
         no_tracking = self.get_argument('no_tracking', None)
         is_prod = getattr(config, 'RUN_IN_PROD', False)
         if not no_tracking and is_prod and hasattr(config, "GA_ACCOUNT"):
@@ -14,43 +109,9 @@ class GAMixIn:
             remote_ip = _req.headers.get("X-Real-Ip",
                         _req.headers.get("X-Forwarded-For",
                         _req.remote_ip))
-            user_agent = _req.headers.get("User-Agent", None)
-            visitor = Visitor()
-            visitor.ip_address = remote_ip
-            visitor.user_agent = user_agent
-            #get visitor.locale
-            visitor.extract_from_server_meta(
-                {"HTTP_ACCEPT_LANGUAGE": _req.headers.get("Accept-Language", None)}
-            )
-            session = Session()
-            page = Page(_req.path)
-            tracker = Tracker(config.GA_ACCOUNT, 'MyVariant.info')
-            # tracker.track_pageview(page, session, visitor)  #this is non-async request
-            pvr = PageViewRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  page=page)
-            r = pvr.build_http_request()
-            _req_list.append(HTTPRequest(r.get_full_url(),
-                                         "POST" if (r.data) else "GET",
-                                         headers=r.headers,
-                                         body=r.data))
-            if event:
-                evt = Event(**event)
-                #tracker.track_event(evt, session, visitor)  #this is non-async request
-                er = EventRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  event=evt)
-                r = er.build_http_request()
-                _req_list.append(HTTPRequest(r.get_full_url(),
-                                             "POST" if (r.data) else "GET",
-                                             headers=r.headers,
-                                             body=r.data))
-
-            #now send actual async requests
-            http_client = AsyncHTTPClient()
-            for _req in _req_list:
-                http_client.fetch(_req)
+            # X-Forwarded-For is "client, proxy1, proxy2..."
+            remote_ip = remote_ip.split(",")[0].strip()
+            # first (preferred) language only
+            language = _req.headers.get("Accept-Language", "").split(",")[0].split(";")[0].strip()
+            _queue.add(_req.path, remote_ip, _req.headers.get("User-Agent", None),
+                       language, event and dict(event))
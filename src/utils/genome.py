@@ -0,0 +1,209 @@
+'''
+Packed, memory-mapped reference genome store.
+
+Sequences are stored 2 bits per base (A=00, C=01, G=10, T=11, 4 bases per
+byte, first base in the high bits). Any other base (N, M, R, W, K, Y, ...)
+is stored as a run of (start, length, code) on the side, the 2-bit data under
+those runs is meaningless. The whole file is mmap'ed, so every process reading
+it shares the same page-cached copy and any slice can be fetched directly
+without loading the genome first.
+
+File layout (all integers little-endian):
+    header:  magic (4 bytes) | version (uint32) | index offset (uint64)
+    data:    2-bit packed sequence for each chromosome, one after the other
+    runs:    for each chromosome, starts (uint64 array), lengths (uint32 array)
+             and codes (1 byte each) of non-ACGT runs
+    index:   number of chromosomes (uint32), then for each chromosome:
+             name length (uint8) | name | sequence length (uint64) |
+             data offset (uint64) | number of runs (uint32) | runs offset (uint64)
+
+Use build_genome_store() to create it from chr*.fa.gz files (same input as
+utils.validate.get_genome_in_bit()), with "genome_store" hub command or, from
+src folder:
+
+    python -m utils.genome <chr_fa_folder> <outfile>
+
+snpEff post-processing uses <snpeff data_folder>/../data/<assembly>_genome.mv2bit
+if present.
+'''
+from __future__ import print_function
+import os.path
+import sys
+import re
+import mmap
+import time
+import struct
+from array import array
+from bisect import bisect_right
+
+from bitarray import bitarray
+
+from biothings.utils.common import open_anyfile, timesofar
+
+MAGIC = b"MV2B"
+VERSION = 1
+GENOME_STORE_EXT = ".mv2bit"
+
+_HEADER = struct.Struct("<4sIQ")
+_CHROM_ENTRY = struct.Struct("<QQIQ")
+
+_TWOBIT_CODE = {'A': bitarray('00'),
+                'C': bitarray('01'),
+                'G': bitarray('10'),
+                'T': bitarray('11')}
+# any non-ACGT base is packed as 'A' and recorded as a run
+_TO_ACGT = str.maketrans({c: 'A' for c in 'NMRWKYSBDHV'})
+_NON_ACGT_RUN = re.compile(r'([^ACGT])\1*')
+# decode a whole packed byte (4 bases) at once
+_BYTE_TO_NUC = ["".join("ACGT"[(b >> s) & 3] for s in (6, 4, 2, 0)) for b in range(256)]
+
+
+def is_genome_store(filename):
+    '''return True if filename is a packed genome store'''
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def build_genome_store(chr_fa_folder, outfile, chr_range=None):
+    ''' pack each chromosome fasta sequence from chr_fa_folder into
+        a single genome store file, see module doc for format.
+        chr_fa_folder contains gzipped fasta files named chr<i>.fa.gz
+        (e.g. chr1.fa.gz), see utils.validate.get_genome_in_bit()
+    '''
+    chr_range = chr_range or [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+    entries = []
+    t0 = time.time()
+    with open(outfile, "wb") as out:
+        # index offset is only known at the end
+        out.write(_HEADER.pack(MAGIC, VERSION, 0))
+        for i in chr_range:
+            t1 = time.time()
+            file_name = 'chr{}.fa.gz'.format(i)
+            print("Packing {}...".format(file_name), end='')
+            file_name = os.path.join(chr_fa_folder, file_name)
+            seq_bit = bitarray()
+            starts, lengths, codes = [], [], []
+            length = 0
+            with open_anyfile(file_name) as seq_f:
+                seq_f.readline()   # skip header
+                for line in seq_f:
+                    line = line.rstrip('\n').upper()
+                    for m in _NON_ACGT_RUN.finditer(line):
+                        start = length + m.start()
+                        code = m.group(1)
+                        # extend a run spanning over multiple lines
+                        if starts and codes[-1] == code and starts[-1] + lengths[-1] == start:
+                            lengths[-1] += len(m.group(0))
+                        else:
+                            starts.append(start)
+                            lengths.append(len(m.group(0)))
+                            codes.append(code)
+                    seq_bit.encode(_TWOBIT_CODE, line.translate(_TO_ACGT))
+                    length += len(line)
+            data_offset = out.tell()
+            out.write(seq_bit.tobytes())
+            runs_offset = out.tell()
+            out.write(array("Q", starts).tobytes())
+            out.write(array("I", lengths).tobytes())
+            out.write("".join(codes).encode())
+            entries.append((i, length, data_offset, len(starts), runs_offset))
+            print("done.[{}]".format(timesofar(t1)))
+        index_offset = out.tell()
+        out.write(struct.pack("<I", len(entries)))
+        for name, length, data_offset, nruns, runs_offset in entries:
+            name = name.encode()
+            out.write(struct.pack("<B", len(name)) + name)
+            out.write(_CHROM_ENTRY.pack(length, data_offset, nruns, runs_offset))
+        out.seek(0)
+        out.write(_HEADER.pack(MAGIC, VERSION, index_offset))
+    print('='*20)
+    print("Finished. [{}]".format(timesofar(t0)))
+
+
+class GenomeStore(object):
+    '''Read-only access to a packed genome store. Positions are 1-based
+       and inclusive, as in HGVS IDs.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a genome store file" % filename)
+        if version != VERSION:
+            raise ValueError("Unsupported genome store version %s" % version)
+        self._chroms = {}
+        pos = index_offset
+        nchrom, = struct.unpack_from("<I", self._mm, pos)
+        pos += 4
+        for _ in range(nchrom):
+            name_len, = struct.unpack_from("<B", self._mm, pos)
+            pos += 1
+            name = self._mm[pos:pos+name_len].decode()
+            pos += name_len
+            length, data_offset, nruns, runs_offset = _CHROM_ENTRY.unpack_from(self._mm, pos)
+            pos += _CHROM_ENTRY.size
+            # runs are few (mostly N blocks), keep them in memory
+            starts = array("Q")
+            starts.frombytes(self._mm[runs_offset:runs_offset + nruns * 8])
+            runs_offset += nruns * 8
+            lengths = array("I")
+            lengths.frombytes(self._mm[runs_offset:runs_offset + nruns * 4])
+            runs_offset += nruns * 4
+            codes = self._mm[runs_offset:runs_offset + nruns].decode()
+            self._chroms[name] = (length, data_offset, starts, lengths, codes)
+
+    def __contains__(self, chrom):
+        return chrom in self._chroms
+
+    def chroms(self):
+        return list(self._chroms)
+
+    def get_length(self, chrom):
+        return self._chroms[chrom][0]
+
+    def get_seq(self, chrom, start, end):
+        '''return reference sequence from start to end (1-based, inclusive)'''
+        length, data_offset, starts, lengths, codes = self._chroms[chrom]
+        if start < 1 or end > length or start > end:
+            raise ValueError("Invalid range %s:%s-%s (chromosome length: %s)" % (chrom, start, end, length))
+        # 0-based from now
+        start -= 1
+        first_byte = start >> 2
+        last_byte = (end - 1) >> 2
+        packed = self._mm[data_offset + first_byte:data_offset + last_byte + 1]
+        seq = "".join([_BYTE_TO_NUC[b] for b in packed])
+        offset = first_byte << 2
+        seq = seq[start - offset:end - offset]
+        # overlay non-ACGT runs overlapping the range
+        idx = bisect_right(starts, start) - 1
+        if idx < 0:
+            idx = 0
+        if idx < len(starts) and starts[idx] < end:
+            seq = list(seq)
+            while idx < len(starts) and starts[idx] < end:
+                run_start = max(starts[idx], start)
+                run_end = min(starts[idx] + lengths[idx], end)
+                if run_end > run_start:
+                    seq[run_start - start:run_end - start] = codes[idx] * (run_end - run_start)
+                idx += 1
+            seq = "".join(seq)
+        return seq
+
+    def get_base(self, chrom, pos):
+        return self.get_seq(chrom, pos, pos)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m utils.genome <chr_fa_folder> <outfile>")
+        sys.exit(255)
+    build_genome_store(sys.argv[1], sys.argv[2])
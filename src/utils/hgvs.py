@@ -1,13 +1,60 @@
 import re
 import copy
 import requests
+from collections import namedtuple
+
+
+# one pass tokenizer for genomic HGVS IDs, like:
+#   chr1:g.35367G>A, chr1:g.1000del, chr1:g.1000_1002del,
+#   chr1:g.1000_1001insAT, chr1:g.1000_1002delinsAT, chr1:g.1000_1002dup
+# and legacy ones with "-" as ref or alt (see fix_hgvs_indel())
+HGVS_PATTERN = re.compile(r'chr(\w+):g\.(\d+)(?:_(\d+))?(?:([\w-])>([\w-])|(delins|del|ins|dup)(\w*))')
+
+# chrom: chromosome, as in the ID ("1", "X", "MT", ...)
+# start, end: int positions, end is None when not in the ID (except for SNPs, end=start)
+# kind: "snp", "del", "ins", "delins", "dup", or "indel" (legacy "C>-" notation)
+# ref, alt: ref/alt bases for SNPs, deleted sequence (if any) in ref for
+#           del/dup, inserted sequence in alt for ins/delins
+HgvsInfo = namedtuple("HgvsInfo", ["chrom", "start", "end", "kind", "ref", "alt"])
+
+
+def _to_hgvs_info(mat):
+    chrom, start, end, ref, alt, kind, seq = mat.groups()
+    start = int(start)
+    if kind is None:
+        if ref == '-' or alt == '-':
+            kind = "indel"
+        else:
+            kind = "snp"
+        end = start
+    else:
+        end = end and int(end)
+        if kind in ("ins", "delins"):
+            ref, alt = None, seq
+        else:
+            ref, alt = seq, None
+    return HgvsInfo(chrom, start, end, kind, ref, alt)
+
+
+def parse_hgvs(hgvs_id):
+    '''return a HgvsInfo record from a genomic hgvs id, None if it
+    can't be parsed.'''
+    mat = HGVS_PATTERN.match(hgvs_id)
+    if mat:
+        return _to_hgvs_info(mat)
+
+
+def parse_many(hgvs_ids):
+    '''same as parse_hgvs() for a list of hgvs ids, returns a list
+    of HgvsInfo (or None) in the same order.'''
+    match = HGVS_PATTERN.match
+    return [(mat and _to_hgvs_info(mat)) for mat in map(match, hgvs_ids)]
 
 
 def is_snp(hgvs_id):
     '''return True/False if a hgvs id a SNP or not.'''
-    pat = 'chr(\w+):g\.(\d+)(\w)\>(\w)'
-    mat = re.match(pat, hgvs_id)
-    return mat is not None
+    info = parse_hgvs(hgvs_id)
+    return info is not None and info.kind == "snp"
 
 
 def reverse_complement_seq(seq):
@@ -17,7 +64,7 @@ def reverse_complement_seq(seq):
         "C": "G",
         "G": "C"
     }
-    for k in seq_d.keys():
+    for k in list(seq_d.keys()):
         seq_d[k.lower()] = seq_d[k].lower()
     return ''.join(seq_d[base] for base in reversed(seq))
 
@@ -25,25 +72,16 @@ def reverse_complement_seq(seq):
 def reverse_complement_hgvs(hgvs_id):
     '''return a complementary version of hgvs_id.
     works only for SNP, ins, delins variant for now.'''
-    pat_snp = '(chr\w+:g\.\d+)(\w)\>(\w)'
-    pat_ins = '(chr\w+:g\.\d+_\d+)ins(\w+)'
-    pat_del_ins = '(chr\w+:g\.\d+_\d+)delins(\w+)'
+    info = parse_hgvs(hgvs_id)
     # complement SNP ID
-    if re.match(pat_snp, hgvs_id):
-        g = re.match(pat_snp, hgvs_id).groups()
-        return '{}{}>{}'.format(g[0],
-                                reverse_complement_seq(g[1]),
-                                reverse_complement_seq(g[2]))
-    # reverse complement ins ID
-    elif re.match(pat_ins, hgvs_id):
-        g = re.match(pat_ins, hgvs_id).groups()
-        return '{}ins{}'.format(g[0],
-                                reverse_complement_seq(g[1]))
-    # reverse complement del_ins ID
-    elif re.match(pat_del_ins, hgvs_id):
-        g = re.match(pat_del_ins, hgvs_id).groups()
-        return '{}delins{}'.format(g[0],
-                                   reverse_complement_seq(g[1]))
+    if info and info.kind == "snp":
+        return 'chr{}:g.{}{}>{}'.format(info.chrom, info.start,
+                                        reverse_complement_seq(info.ref),
+                                        reverse_complement_seq(info.alt))
+    # reverse complement ins/del_ins ID
+    elif info and info.kind in ("ins", "delins") and info.end and info.alt:
+        return 'chr{}:g.{}_{}{}{}'.format(info.chrom, info.start, info.end, info.kind,
+                                          reverse_complement_seq(info.alt))
     else:
         raise ValueError("Not a Valid HGVS ID")
 
@@ -161,6 +199,27 @@ def get_pos_start_end(chr, pos, ref, alt):
     return start, end
 
 
+
+# variants are also indexed by position bins ("<assembly>.bin" field), so
+# region queries can use term filters instead of ranges over whole chromosomes.
+# Two levels of bins in the same field: 1kb bins for small regions, and 64kb
+# bins (IDs from COARSE_BIN_OFFSET) so regions of a few Mb get few terms too
+POSITION_BIN_SIZE = 1000
+COARSE_BIN_SIZE = 64000
+# above any 1kb bin ID (chr1 is ~249Mb long)
+COARSE_BIN_OFFSET = 1000000
+
+def get_pos_bins(start, end, coarse=False):
+    '''return the list of position bin IDs covered by start..end (inclusive),
+    1kb bins or, if coarse is True, 64kb bins.'''
+    if start > end:
+        start, end = end, start
+    if coarse:
+        return list(range(COARSE_BIN_OFFSET + start // COARSE_BIN_SIZE,
+                          COARSE_BIN_OFFSET + end // COARSE_BIN_SIZE + 1))
+    return list(range(start // POSITION_BIN_SIZE, end // POSITION_BIN_SIZE + 1))
+
+
 def fix_hgvs_indel(hgvs_id):
     """Fix hgvs id like these:
          'chr19:g.58863869C>-',
@@ -170,17 +229,16 @@ def fix_hgvs_indel(hgvs_id):
          'chr12:g.9004916C>-',
     """
     _hgvs_id = None
-    pat_snp = '(chr\w+:g\.(\d+))([\w-])\>([\w-])'
-    if re.match(pat_snp, hgvs_id):
-        g = re.match(pat_snp, hgvs_id).groups()
-        pos, ref, alt = g[1:]
-        if ref == '-':
+    info = parse_hgvs(hgvs_id)
+    if info and info.kind in ("snp", "indel"):
+        prefix = 'chr{}:g.{}'.format(info.chrom, info.start)
+        if info.ref == '-':
             # should be insertion
-            _hgvs_id = '{}ins{}'.format(g[0], alt)
-        elif alt == '-':
+            _hgvs_id = '{}ins{}'.format(prefix, info.alt)
+        elif info.alt == '-':
             # should be deletion
-            end = int(pos) + len(ref) - 1
-            _hgvs_id = '{0}_{1}del'.format(g[0], end)
+            end = info.start + len(info.ref) - 1
+            _hgvs_id = '{0}_{1}del'.format(prefix, end)
         else:
             print("Error: either cannot fix or no need to fix: ", hgvs_id)
     else:
@@ -209,18 +267,18 @@ def get_hgvs_from_rsid(doc_li, rsid_fn, dbsnp_col, skip_unmatched=False):
         elif skip_unmatched:
             yield doc
 
+_RE_TRIM_DELINS = re.compile("(.*del)[A-Z]+(ins.*)")
+_RE_TRIM_INS = re.compile("(.*ins)[A-Z]+$")
+_RE_TRIM_DEL = re.compile("(.*del)[A-Z]+$")
+_RE_TRIM_DUP = re.compile("(.*dup)[A-Z]+$")
+
 def trim_delseq_from_hgvs(hgvs):
-    re_delins = re.compile("(.*del)[A-Z]+(ins.*)")
-    re_ins = re.compile("(.*ins)[A-Z]+$")
-    re_del = re.compile("(.*del)[A-Z]+$")
-    re_dup = re.compile("(.*dup)[A-Z]+$")
-    if re_delins.match(hgvs):
-        hgvs = "".join(re_delins.match(hgvs).groups())
-    elif re_ins.match(hgvs):
-        hgvs = "".join(re_ins.match(hgvs).groups())
-    elif re_del.match(hgvs):
-        hgvs = "".join(re_del.match(hgvs).groups())
-    elif re_dup.match(hgvs):
-        hgvs = "".join(re_dup.match(hgvs).groups())
-    
+    # called for every snpEff annotation, skip regexes when there's nothing to trim
+    if not ("del" in hgvs or "ins" in hgvs or "dup" in hgvs):
+        return hgvs
+    for pat in (_RE_TRIM_DELINS, _RE_TRIM_INS, _RE_TRIM_DEL, _RE_TRIM_DUP):
+        mat = pat.match(hgvs)
+        if mat:
+            return "".join(mat.groups())
+
     return hgvs
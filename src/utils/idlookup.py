@@ -0,0 +1,176 @@
+'''
+Secondary ID (rsid, RCV accession, ...) => variant _id lookup table, stored
+in a memory-mapped file, so web processes can resolve such IDs to variant
+_ids (and fetch documents by _id) without searching the index.
+
+Keys are lower-cased. File layout (integers little-endian):
+    header:  magic (4 bytes) | version (uint32) | number of keys (uint64) |
+             offsets offset (uint64)
+    data:    one "key<tab>id1,id2,...<newline>" line per key, sorted by key
+    offsets: offset of each line in data (uint64 array)
+
+Use build_id_lookup() to create it from a target collection.
+'''
+import os
+import heapq
+import mmap
+import struct
+import shutil
+import tempfile
+from itertools import groupby
+
+MAGIC = b"MVID"
+VERSION = 1
+ID_LOOKUP_EXT = ".idlookup"
+
+_HEADER = struct.Struct("<4sIQQ")
+_OFFSET = struct.Struct("<Q")
+
+
+def get_values(doc, field):
+    '''return all values found at dotfield "field" in doc, traversing lists'''
+    values = [doc]
+    for key in field.split("."):
+        nexts = []
+        for val in values:
+            if isinstance(val, list):
+                nexts.extend([v.get(key) for v in val if isinstance(v, dict)])
+            elif isinstance(val, dict):
+                nexts.append(val.get(key))
+        values = [v for v in nexts if v is not None]
+    res = []
+    for val in values:
+        if isinstance(val, list):
+            res.extend([v for v in val if isinstance(v, (str, int))])
+        elif isinstance(val, (str, int)):
+            res.append(val)
+    return res
+
+
+def _write_sorted_chunk(lines, folder):
+    lines.sort()
+    fd, fn = tempfile.mkstemp(dir=folder, suffix=".chunk")
+    with os.fdopen(fd, "w") as f:
+        f.writelines(lines)
+    return fn
+
+
+def build_id_lookup(docs, fields, outfile, chunk_size=5000000):
+    ''' Build lookup file outfile, for values of dotfields "fields" found in
+        docs (an iterable of documents, typically from doc_feeder()). Pairs
+        are sorted in chunks of chunk_size in memory, then merged from disk.
+        Returns the number of keys '''
+    folder = os.path.dirname(os.path.abspath(outfile))
+    chunks = []
+    try:
+        lines = []
+        for doc in docs:
+            for field in fields:
+                for val in get_values(doc, field):
+                    key = str(val).lower()
+                    # tab and new line are separators (and control chars
+                    # would sort differently as lines and as keys)
+                    if key.isprintable():
+                        lines.append("%s\t%s\n" % (key, doc["_id"]))
+            if len(lines) >= chunk_size:
+                chunks.append(_write_sorted_chunk(lines, folder))
+                lines = []
+        chunks.append(_write_sorted_chunk(lines, folder))
+        del lines
+
+        nkeys = 0
+        files = [open(fn) for fn in chunks]
+        offsets_fn = outfile + ".offsets"
+        # written aside then renamed, as web processes may have outfile mmap'ed
+        tmp_fn = outfile + ".tmp"
+        try:
+            with open(tmp_fn, "wb") as out, open(offsets_fn, "wb") as offsets:
+                # offsets offset is only known at the end
+                out.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+                pairs = (line.rstrip("\n").split("\t", 1) for line in heapq.merge(*files))
+                for key, group in groupby(pairs, key=lambda p: p[0]):
+                    ids = sorted(set([p[1] for p in group]))
+                    offsets.write(_OFFSET.pack(out.tell()))
+                    out.write(("%s\t%s\n" % (key, ",".join(ids))).encode())
+                    nkeys += 1
+                offsets_offset = out.tell()
+                offsets.close()
+                with open(offsets_fn, "rb") as offsets:
+                    shutil.copyfileobj(offsets, out)
+                out.seek(0)
+                out.write(_HEADER.pack(MAGIC, VERSION, nkeys, offsets_offset))
+            os.replace(tmp_fn, outfile)
+        finally:
+            for f in files:
+                f.close()
+            for fn in (offsets_fn, tmp_fn):
+                if os.path.exists(fn):
+                    os.remove(fn)
+    finally:
+        for fn in chunks:
+            os.remove(fn)
+    return nkeys
+
+
+class IdLookup(object):
+    '''Read-only access to a lookup file'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.nkeys, self._offsets = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not an ID lookup file" % filename)
+        if version != VERSION:
+            raise ValueError("Unsupported ID lookup file version %s" % version)
+
+    def __len__(self):
+        return self.nkeys
+
+    def _line_at(self, idx):
+        start, = _OFFSET.unpack_from(self._mm, self._offsets + idx * _OFFSET.size)
+        return start, self._mm.find(b"\t", start)
+
+    def get(self, key):
+        '''return the list of _ids for key (case-insensitive), or None'''
+        key = str(key).lower().encode()
+        mm = self._mm
+        lo, hi = 0, self.nkeys
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, tab = self._line_at(mid)
+            if mm[start:tab] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.nkeys:
+            start, tab = self._line_at(lo)
+            if mm[start:tab] == key:
+                return mm[tab + 1:mm.find(b"\n", tab)].decode().split(",")
+        return None
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+# filename => (mtime, IdLookup, previous IdLookup)
+_lookups = {}
+
+def get_id_lookup(filename):
+    ''' Return IdLookup for filename, opened once per process and reopened
+    if file was replaced. None if file doesn't exist '''
+    try:
+        mtime = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        return None
+    cached = _lookups.get(filename)
+    if cached is None or cached[0] != mtime:
+        # previous one is kept open as it could still be used by a request,
+        # until next replacement (files are rebuilt at most once per build)
+        if cached is not None and cached[2] is not None:
+            cached[2].close()
+        cached = (mtime, IdLookup(filename), cached and cached[1])
+        _lookups[filename] = cached
+    return cached[1]
@@ -1,5 +1,4 @@
 from __future__ import print_function
-import re
 import os.path
 import time
 
@@ -7,6 +6,11 @@ from bitarray import bitarray
 
 from biothings.utils.common import loadobj, is_str, open_anyfile, timesofar
 from biothings.utils.mongo import get_src_db, doc_feeder
+from utils.genome import GenomeStore, is_genome_store
+from utils.hgvs import parse_hgvs
+
+# nucleotides bit_to_nuc() can decode
+VALID_REF_NUCS = set("ACGTMNRW")
 
 
 def nuc_to_bit(sequence):
@@ -60,6 +64,30 @@ def bit_to_nuc(sequence):
     return nuc
 
 
+# decode a whole byte (2 nucleotides, 4 bits each, see nuc_to_bit()) at once,
+# '?' marks codes bit_to_nuc() can't decode
+_NIBBLE_TO_NUC = {1: 'A', 2: 'C', 3: 'G', 4: 'T', 5: 'N', 6: 'M', 7: 'R', 8: 'W'}
+_BYTE_TO_NUCS = [_NIBBLE_TO_NUC.get(b >> 4, '?') + _NIBBLE_TO_NUC.get(b & 15, '?') for b in range(256)]
+
+
+def bits_to_seq(chr_bit, start, end):
+    '''decode nucleotides from start to end (1-based, inclusive) from
+       chr_bit, a whole chromosome encoded with nuc_to_bit(). Same as
+       calling bit_to_nuc() on each position, but decoding whole bytes
+       at once.
+    '''
+    if start < 1 or start > end:
+        raise ValueError("Invalid range {}-{}".format(start, end))
+    seq = "".join([_BYTE_TO_NUCS[b] for b in chr_bit[start*4-4:end*4].tobytes()])
+    # last byte may be padded
+    seq = seq[:end - start + 1]
+    if len(seq) != end - start + 1:
+        raise ValueError("Range {}-{} is out of chromosome".format(start, end))
+    if '?' in seq:
+        raise ValueError("Cannot decode input bits in range {}-{}: {}".format(start, end, seq))
+    return seq
+
+
 def bit_to_nuc2(bits):
     '''a util function to convert a encoded bitarray back to
        nt sequence.
@@ -79,11 +107,9 @@ def parse(str):
        return chromosome number, nucleotide position
        and nucleotide name
     '''
-    pat = 'chr(\w+):g\.(\d+)(\w)\>(\w)'
-    mat = re.match(pat, str)
-    if mat:
-        r = mat.groups()
-        return (r[0], r[1], r[2])
+    info = parse_hgvs(str)
+    if info and info.kind == "snp":
+        return (info.chrom, info.start, info.ref)
 
 
 def get_genome_in_bit(chr_fa_folder):
@@ -122,12 +148,18 @@ def get_genome_in_bit(chr_fa_folder):
 
 
 class VariantValidator:
-    def __init__(self):
+    def __init__(self, genome_file=None):
         self._chr_data = None
+        self.genome_file = genome_file
 
-    def load_chr_data(self,genome_file):
+    def load_chr_data(self,genome_file=None):
+        genome_file = genome_file or self.genome_file
         print("\tLoading chromosome data...", end='')
-        self._chr_data = loadobj(genome_file)
+        if is_genome_store(genome_file):
+            # packed genome store is mmap'ed, shared with other processes
+            self._chr_data = GenomeStore(genome_file)
+        else:
+            self._chr_data = loadobj(genome_file)
         print("Done.")
 
     def validate_hgvs(self, hgvs_id, verbose=False):
@@ -152,13 +184,16 @@ class VariantValidator:
             pos = int(r[1])
             nuc_hgvs = r[2]
 
-            chr_bit = bitarray()
-            chr_bit = self._chr_data[str(chr)]
+            if isinstance(self._chr_data, GenomeStore):
+                nuc_chr = self._chr_data.get_base(str(chr), pos)
+            else:
+                chr_bit = bitarray()
+                chr_bit = self._chr_data[str(chr)]
 
-            # get the nucleotide in chromsome sequence in bit form
-            nuc_chr_bit = bitarray()
-            nuc_chr_bit = chr_bit[pos*3-3:pos*3]
-            nuc_chr = bit_to_nuc(nuc_chr_bit)
+                # get the nucleotide in chromsome sequence in bit form
+                nuc_chr_bit = bitarray()
+                nuc_chr_bit = chr_bit[pos*3-3:pos*3]
+                nuc_chr = bit_to_nuc(nuc_chr_bit)
 
             # compare HGVS id with genome
             matched = nuc_hgvs == nuc_chr
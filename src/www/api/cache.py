@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    ''' LRU cache of serialized responses, entries expire after ttl seconds.
+    Bounded by number of entries (size) and, if max_bytes is set, by the
+    total length of cached responses (len(value), or nbytes given to set()).
+    Meant to be used from the IOLoop thread only (not thread-safe) '''
+
+    def __init__(self, size, ttl, max_bytes=None):
+        self.size = size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._remove(key)
+        self.misses += 1
+        return None
+
+    def set(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = len(value)
+        if self.max_bytes and nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.time(), value, nbytes)
+        self.nbytes += nbytes
+        while len(self._entries) > self.size or \
+                (self.max_bytes and self.nbytes > self.max_bytes):
+            self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
@@ -5,8 +5,22 @@ from biothings.www.api.es.handlers import BiothingHandler
 from biothings.www.api.es.handlers import MetadataHandler
 from biothings.www.api.es.handlers import QueryHandler
 from biothings.www.api.es.handlers import StatusHandler
+from biothings.www.api.helper import DateTimeJSONEncoder
 from tornado.web import RequestHandler
+from www.static_cache import StaticFileMixin
+from www.api.cache import ResponseCache
+from utils.idlookup import get_id_lookup
+from tornado.ioloop import IOLoop, PeriodicCallback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from re import search
+import logging
+import json
+
+# index aliases are checked in this thread (see VariantHandler), for at most
+# ALIAS_CHECK_TIMEOUT seconds
+_alias_executor = ThreadPoolExecutor(1)
+ALIAS_CHECK_TIMEOUT = 10
 
 
 class CommonHandlerMixin(object):
@@ -21,9 +35,126 @@ class CommonHandlerMixin(object):
     def _get_es_index(self, options):
         return '_'.join([self.web_settings.ES_INDEX_BASE, options.esqb_kwargs.assembly])
 
+    # interval queries can filter on position bins only if index has them
+    # (not a query parameter, set from settings)
+    def _pre_query_builder_GET_hook(self, options):
+        options = super(CommonHandlerMixin, self)._pre_query_builder_GET_hook(options)
+        options.esqb_kwargs.interval_bins = getattr(self.web_settings, 'INTERVAL_BINS', False)
+        return options
+
+    def _pre_query_builder_POST_hook(self, options):
+        options = super(CommonHandlerMixin, self)._pre_query_builder_POST_hook(options)
+        options.esqb_kwargs.interval_bins = getattr(self.web_settings, 'INTERVAL_BINS', False)
+        return options
+
 
 class VariantHandler(CommonHandlerMixin, BiothingHandler):
     ''' This class is for the /variant endpoint. '''
+    # Optional cache of GET responses (VARIANT_CACHE_SIZE > 0 in settings),
+    # keyed on variant ID and query args (but JSONP callback), holding
+    # serialized responses and their Etag.
+    # It's cleared when index aliases point to other indices, checked every
+    # VARIANT_CACHE_ALIAS_CHECK seconds, off the IOLoop
+    _response_cache = None
+    _cache_indices = None
+    _cache_checking = False
+
+    def _get_response_cache(self):
+        size = getattr(self.web_settings, 'VARIANT_CACHE_SIZE', 0)
+        if not size:
+            return None
+        cls = VariantHandler
+        if cls._response_cache is None:
+            cls._response_cache = ResponseCache(size, getattr(self.web_settings, 'VARIANT_CACHE_TTL', 300),
+                                                max_bytes=getattr(self.web_settings, 'VARIANT_CACHE_MAX_BYTES', None))
+            # started lazily, so it runs on the server's IOLoop
+            check = partial(cls._check_aliases, self.web_settings)
+            PeriodicCallback(check, getattr(self.web_settings, 'VARIANT_CACHE_ALIAS_CHECK', 60) * 1000).start()
+            check()
+        return cls._response_cache
+
+    @classmethod
+    def _check_aliases(cls, web_settings):
+        if cls._cache_checking:
+            # ES is slow, previous check isn't over
+            return
+        cls._cache_checking = True
+        indices = ','.join([web_settings.ES_INDEX_BASE + '_' + assembly
+                            for assembly in web_settings.SUPPORTED_ASSEMBLIES])
+
+        def get_indices():
+            return sorted(web_settings.es_client.indices.get_alias(index=indices,
+                                                                   request_timeout=ALIAS_CHECK_TIMEOUT))
+
+        def checked(f):
+            cls._cache_checking = False
+            try:
+                indices = f.result()
+            except Exception:
+                logging.exception("Error checking index aliases")
+                indices = None
+            if indices is None or indices != cls._cache_indices:
+                cls._response_cache.clear()
+            cls._cache_indices = indices
+
+        # ES client is blocking
+        IOLoop.current().add_future(_alias_executor.submit(get_indices), checked)
+
+    def get(self, bid=None):
+        self._bid = bid
+        self._cache_key = None
+        cache = None
+        if bid and not self.get_argument('msgpack', None):
+            cache = self._get_response_cache()
+        if cache is not None:
+            # redirect this id first, as usual
+            self._regex_redirect(bid)
+            self._redirect_checked = True
+            if self._finished:
+                return
+            # cached response is the same whatever the callback, it's
+            # wrapped by return_json()
+            self._cache_key = (bid, tuple(sorted([(k, tuple(v)) for (k, v) in self.request.arguments.items()
+                                                  if k != self.web_settings.JSONP_PARAMETER])))
+            cached = cache.get(self._cache_key)
+            if cached is not None:
+                data, etag = cached
+                # skip ES query and result transformation, parameters are
+                # still parsed (sets jsonp)
+                self.get_query_params()
+                self.return_json(data, encode=False)
+                # as return_json() sets it for non-serialized data
+                if etag and not self.web_settings.DISABLE_CACHING:
+                    self.set_header('Etag', etag)
+                self.ga_track(event=self.ga_event_object({}))
+                self.self_track(data=self.ga_event_object_ret)
+                return
+        super(VariantHandler, self).get(bid)
+
+    def _pre_query_GET_hook(self, options, query):
+        query = super(VariantHandler, self)._pre_query_GET_hook(options, query)
+        # secondary ID (rsid, ...) search: get docs by _id instead (mget), if
+        # lookup file knows the ID. Search is still run if the ID isn't in the
+        # lookup file, or if any of its docs is missing (stale lookup file)
+        lookup_file = getattr(self.web_settings, 'ID_LOOKUP_FILES', {}).get(options.esqb_kwargs.assembly)
+        if 'body' in query and lookup_file:
+            lookup = get_id_lookup(lookup_file)
+            ids = lookup and lookup.get(self._bid)
+            if ids:
+                _query = dict(options.es_kwargs)
+                _query.update({'index': query['index'], 'doc_type': query['doc_type'],
+                               'body': {'ids': ids}, 'fallback': query})
+                return _query
+        return query
+
+    def _pre_finish_GET_hook(self, options, res):
+        res = super(VariantHandler, self)._pre_finish_GET_hook(options, res)
+        if self._cache_key:
+            data = json.dumps(res, cls=DateTimeJSONEncoder, indent=2)
+            etag = res.get('etag', None) if isinstance(res, dict) else None
+            self._response_cache.set(self._cache_key, (data, etag), nbytes=len(data))
+        return res
+
     # overridden to sanitize assembly param
     def _sanitize_params(self, kwargs):
         kwargs = super(VariantHandler, self)._sanitize_params(kwargs)
@@ -32,6 +163,9 @@ class VariantHandler(CommonHandlerMixin, BiothingHandler):
 
     # redirect improperly formatted hgvs ids
     def _regex_redirect(self, bid):
+        if getattr(self, '_redirect_checked', False):
+            # already done before looking up response cache
+            return
         m = search('chr.{1,2}(?P<delim>:[g\.]{0,2})\d+', self.request.uri)
         if m:
             de = m.group('delim')
@@ -62,21 +196,19 @@ class MetadataHandler(CommonHandlerMixin, MetadataHandler):
         return kwargs
 
 
-class DemoHandler(RequestHandler):
+class DemoHandler(StaticFileMixin, RequestHandler):
     ''' For the /demo page. '''
     def initialize(self, web_settings):
         self.web_settings = web_settings
 
     def get(self):
-        with open('../docs/demo/index.html', 'r') as demo_file:
-            self.write(demo_file.read())
+        self.write_static_file('../docs/demo/index.html')
 
 
-class StandaloneFrontpageHandler(RequestHandler):
+class StandaloneFrontpageHandler(StaticFileMixin, RequestHandler):
     ''' For the standalone frontpage. '''
     def initialize(self, web_settings):
         self.web_settings = web_settings
 
     def get(self):
-        with open('../docs/standalone/index.html', 'r') as standalone_file:
-            self.finish(standalone_file.read())
+        self.write_static_file('../docs/standalone/index.html')
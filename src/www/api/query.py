@@ -1,6 +1,102 @@
 # -*- coding: utf-8 -*-
-from biothings.www.api.es.query import ESQuery
+from biothings.www.api.es.query import ESQuery, BiothingSearchError
+import json
+
+# searches sorted with this last (unique) key are paged in POST queries
+# (fetch_all), until all their hits are fetched. Paging uses from/size,
+# search_after isn't available before ES 5 (sorting on _uid is)
+PAGING_TIEBREAKER = {"_uid": "asc"}
 
 class ESQuery(ESQuery):
     # Add app specific queries here
-    pass
+
+    # max number of searches sent in one msearch request
+    MSEARCH_BATCH_SIZE = 1000
+    # max number of hits fetched for one paged search (from + size can't
+    # go over index.max_result_window, 10000 by default)
+    MAX_PAGED_HITS = 10000
+    # max number of hits for a whole POST query, requests which would
+    # return more are rejected
+    MAX_POST_HITS = 100000
+
+    def _annotation_GET_query(self, query_kwargs):
+        # get docs by _id (mget), with a search to run if any of them is
+        # missing (see VariantHandler._pre_query_GET_hook())
+        fallback = query_kwargs.pop('fallback', None)
+        if not fallback:
+            return super(ESQuery, self)._annotation_GET_query(query_kwargs)
+        docs = self.client.mget(**query_kwargs).get('docs', [])
+        if not docs or not all([doc.get('found') for doc in docs]):
+            return super(ESQuery, self)._annotation_GET_query(fallback)
+        for doc in docs:
+            # same hits as the search would give
+            doc.pop('_version', None)
+            doc.pop('found', None)
+        return {'hits': {'total': len(docs), 'hits': docs}}
+
+    def _msearch(self, query_kwargs, lines):
+        ''' Run msearch for lines (header, body, header, body...) in batches, return responses in order '''
+        responses = []
+        step = self.MSEARCH_BATCH_SIZE * 2
+        for i in range(0, len(lines), step):
+            _kwargs = dict(query_kwargs, body='\n'.join(lines[i:i + step]))
+            responses.extend(super(ESQuery, self)._query_POST_query(_kwargs)['responses'])
+        return responses
+
+    def _query_POST_query(self, query_kwargs):
+        lines = query_kwargs['body'].split('\n')
+        bodies = [json.loads(body) for body in lines[1::2]]
+        # what the first msearch round can return, before any paging
+        if sum([body.get('size', 10) for body in bodies]) > self.MAX_POST_HITS:
+            raise BiothingSearchError('Too many hits requested (more than {}), '
+                                      'lower "size" or split the query'.format(self.MAX_POST_HITS))
+        responses = self._msearch(query_kwargs, lines)
+        # from/size paging for searches with a tie-breaker sort (paged
+        # interval queries, fetch_all), next pages of all of them are
+        # fetched at once in each round.
+        # Responses with hits missing (MAX_PAGED_HITS reached, failed page)
+        # are flagged with "truncated", total is left as is
+        paged = {}
+        for (num, (body, res)) in enumerate(zip(bodies, responses)):
+            if 'error' not in res and body.get('sort', [None])[-1] == PAGING_TIEBREAKER:
+                paged[num] = body
+        if not paged:
+            return {'responses': responses}
+        # all hits to be fetched, checked before fetching next pages
+        total = 0
+        for (num, res) in enumerate(responses):
+            if num in paged:
+                start = paged[num].get('from', 0)
+                total += max(min(res['hits']['total'], self.MAX_PAGED_HITS) - start, 0)
+            elif 'error' not in res:
+                total += len(res['hits']['hits'])
+        if total > self.MAX_POST_HITS:
+            raise BiothingSearchError('Too many hits to fetch ({}, max is {}), '
+                                      'split the query'.format(total, self.MAX_POST_HITS))
+        while paged:
+            todo = []
+            for (num, body) in list(paged.items()):
+                hits = responses[num]['hits']
+                start = body.get('from', 0) + len(hits['hits'])
+                if start >= hits['total']:
+                    paged.pop(num)
+                    continue
+                if start >= self.MAX_PAGED_HITS:
+                    responses[num]['truncated'] = True
+                    paged.pop(num)
+                    continue
+                todo.append((num, dict(body, **{'from': start,
+                                                'size': min(body['size'], self.MAX_PAGED_HITS - start)})))
+            if not todo:
+                break
+            lines = []
+            for (num, body) in todo:
+                lines.extend(['{}', json.dumps(body)])
+            for ((num, _), res) in zip(todo, self._msearch(query_kwargs, lines)):
+                # an empty page means docs were removed meanwhile
+                if 'error' in res or not res['hits']['hits']:
+                    responses[num]['truncated'] = True
+                    paged.pop(num)
+                    continue
+                responses[num]['hits']['hits'].extend(res['hits']['hits'])
+        return {'responses': responses}
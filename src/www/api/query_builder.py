@@ -1,28 +1,106 @@
 # -*- coding: utf-8 -*-
 from biothings.www.api.es.query_builder import ESQueryBuilder
+from www.api.query import PAGING_TIEBREAKER
+from utils.hgvs import get_pos_bins
 import re
+import json
+from functools import lru_cache
 
 INTERVAL_PATTERN = re.compile(r'(?P<pre_query>.+(?P<pre_and>[Aa][Nn][Dd]))*(?P<interval>\s*chr(?P<chr>[1-9xXyYmM][0-9tT]?):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)\s*)(?P<post_query>(?P<post_and>[Aa][Nn][Dd]).+)*')
 SNP_PATTERN = re.compile(r'(?P<pre_query>.+(?P<pre_and>[Aa][Nn][Dd]))*(?P<interval>\s*chr(?P<chr>[1-9xXyYmM][0-9tT]?):(?P<gend>(?P<gstart>[0-9,]+))\s*)(?P<post_query>(?P<post_and>[Aa][Nn][Dd]).+)*')
 PATTERNS = [INTERVAL_PATTERN, SNP_PATTERN]
+# "interval" part only of the patterns above, without the backtracking
+# pre/post query parts (see parse_interval_query())
+INTERVAL_CORE = re.compile(r'\s*chr(?P<chr>[1-9xXyYmM][0-9tT]?):(?P<gstart>[0-9,]+)-(?P<gend>[0-9,]+)\s*')
+SNP_CORE = re.compile(r'\s*chr(?P<chr>[1-9xXyYmM][0-9tT]?):(?P<gend>(?P<gstart>[0-9,]+))\s*')
+CORES = [INTERVAL_CORE, SNP_CORE]
 
-class ESQueryBuilder(ESQueryBuilder):
-    # Implement app specific queries here
-    def _parse_interval_query(self, q):
+def _match_interval(q):
+    ''' Same as re.search(pattern, q) for pattern in PATTERNS, but linear: the
+    pre query is the longest prefix ending with "and" followed by the interval,
+    otherwise interval is searched alone, and post query is anything after
+    the interval starting with "and" '''
+    if '\n' in q:
+        # "." in patterns doesn't match new lines, keep it simple
         for pattern in PATTERNS:
-            m = re.search(pattern, q)
+            m = pattern.search(q)
             if m:
-                r = m.groupdict()
-                if r['pre_query']:
-                    r['query'] = r['pre_query'].rstrip(r['pre_and']).rstrip()
-                    if r['post_query']:
-                        r['query'] += ' ' + r['post_query']
-                elif r['post_query']:
-                    r['query'] = r['post_query'].lstrip(r['post_and']).lstrip()
-                else:
-                    r['query'] = None
-                return r
+                return m.groupdict()
+        return None
+    low = q.lower()
+    for core in CORES:
+        pre_end = None
+        i = low.rfind('and')
+        # at least one char before "and"
+        while i >= 1:
+            m = core.match(q, i + 3)
+            if m:
+                pre_end = i + 3
+                break
+            i = low.rfind('and', 0, i)
+        else:
+            m = core.search(q)
+        if m:
+            r = m.groupdict()
+            r['interval'] = m.group(0)
+            r['pre_query'] = pre_end and q[:pre_end] or None
+            r['pre_and'] = pre_end and q[pre_end - 3:pre_end] or None
+            end = m.end()
+            if low.startswith('and', end) and len(q) > end + 3:
+                r['post_query'] = q[end:]
+                r['post_and'] = q[end:end + 3]
+            else:
+                r['post_query'] = r['post_and'] = None
+            return r
+    return None
+
+@lru_cache(maxsize=10000)
+def parse_interval_query(q):
+    ''' Return interval query components of q as a dict, or False if q isn't an
+    interval query. Results are cached, POST queries send thousands of them '''
+    # cheap pre-check, most queries (rsid, gene symbols, ...) aren't intervals
+    if 'chr' not in q or ':' not in q:
+        return False
+    r = _match_interval(q)
+    if not r:
         return False
+    if r['pre_query']:
+        r['query'] = r['pre_query'].rstrip(r['pre_and']).rstrip()
+        if r['post_query']:
+            r['query'] += ' ' + r['post_query']
+    elif r['post_query']:
+        r['query'] = r['post_query'].lstrip(r['post_and']).lstrip()
+    else:
+        r['query'] = None
+    return r
+
+class ESQueryBuilder(ESQueryBuilder):
+    # Implement app specific queries here
+    def _parse_interval_query(self, q):
+        r = parse_interval_query(q)
+        # cached, don't share it
+        return r and dict(r)
+
+    # max number of bins in the terms filter: 1kb bins up to ~128kb regions,
+    # 64kb bins up to ~8Mb, wider regions only use range filters (see
+    # benchmarks/interval_bins_bench.py)
+    MAX_INTERVAL_BINS = 128
+
+    def _interval_bins(self, query_match):
+        # only if the index has bins on all documents (INTERVAL_BINS in
+        # settings, see CommonHandlerMixin), or docs without bins would be missed
+        if not self.options.interval_bins:
+            return None
+        try:
+            start = int(query_match['gstart'].replace(',', ''))
+            end = int(query_match['gend'].replace(',', ''))
+        except ValueError:
+            return None
+        for coarse in (False, True):
+            bins = get_pos_bins(start, end, coarse=coarse)
+            if len(bins) <= self.MAX_INTERVAL_BINS:
+                return bins
+        return None
 
     def _interval_query(self, query_match):
         # already guaranteed to be an interval query - query_match is re match-like object
@@ -47,10 +125,51 @@ class ESQueryBuilder(ESQueryBuilder):
                 }
             }
         }
+        bins = self._interval_bins(query_match)
+        if bins:
+            # cheap term filter first, narrows down docs to check with ranges
+            _query["query"]["bool"]["filter"]["bool"]["must"].insert(1,
+                    {"terms": {self.options.assembly + ".bin": bins}})
         if query_match['query']:
             _query["query"]["bool"]["must"] = {"query_string": {"query": query_match['query']}}
         return self.queries.raw_query(_query)
 
+    # page size for paged interval queries, if not given ("size")
+    INTERVAL_PAGE_SIZE = 1000
+
+    def _paged_interval_query(self, query_match):
+        # sorted by position, with a unique tie-breaker, so ESQuery can fetch
+        # all hits in the interval, page after page, from "from" if given
+        _query = self._interval_query(query_match)
+        _query.setdefault('size', self.INTERVAL_PAGE_SIZE)
+        _query['sort'] = [{self.options.assembly + ".start": "asc"}, PAGING_TIEBREAKER]
+        return _query
+
+    def _build_multiple_query(self, terms, scopes=None, intervals=False):
+        # same as default but, if intervals is True and no scopes are given,
+        # interval terms (eg. regions from a BED file) are position queries,
+        # fetched in full if requested (fetch_all), otherwise limited by
+        # size/from as any other term
+        _q = []
+        _infer_scope = True if not scopes else False
+        paged = intervals and self.options.fetch_all
+        for term in terms:
+            interval_match = intervals and _infer_scope and self._parse_interval_query(term)
+            if interval_match:
+                if paged:
+                    _query = self._paged_interval_query(interval_match)
+                else:
+                    _query = self._interval_query(interval_match)
+            else:
+                if _infer_scope:
+                    scopes = self._get_term_scope(term)
+                _query = self._build_single_query(term, scopes=scopes)
+            _q.extend(['{}', json.dumps(_query)])
+        return self._return_query_kwargs({'body': '\n'.join(_q)})
+
+    def _query_POST_query(self, qs, scopes):
+        return self._build_multiple_query(terms=qs, scopes=scopes, intervals=True)
+
     def _extra_query_types(self, q):
         interval_match = self._parse_interval_query(q) 
         if interval_match:
@@ -1,22 +1,114 @@
 # -*- coding: utf-8 -*-
 from biothings.www.api.es.transform import ESResultTransformer
+from collections import OrderedDict
+from operator import itemgetter
+
+# assembly => (source metadata it was computed from, {source: license url})
+_license_maps = {}
+
+def get_license_map(assembly, metadata):
+    ''' Return {source: license url} for assembly, computed once as long as
+    source metadata for that assembly stays the same object '''
+    cached = _license_maps.get(assembly)
+    if cached is None or cached[0] is not metadata:
+        licenses = {}
+        for source, val in metadata.items():
+            if isinstance(val, dict):
+                licenses[source] = val.get('license_url_short', val.get('license_url'))
+        cached = (metadata, licenses)
+        _license_maps[assembly] = cached
+    return cached[1]
+
+def sort_doc(doc):
+    ''' Same as ESResultTransformer._sort_and_annotate_doc(doc) with sorting,
+    when there are no output aliases and no data sources to annotate with, so
+    without building each field path '''
+    if isinstance(doc, dict):
+        # leaves are the most, not worth a call each
+        return OrderedDict([(k, sort_doc(v) if isinstance(v, (dict, list, tuple)) else v)
+                            for (k, v) in sorted(doc.items(), key=itemgetter(0))])
+    elif isinstance(doc, (list, tuple)):
+        return [sort_doc(d) if isinstance(d, (dict, list, tuple)) else d for d in doc]
+    return doc
 
 class ESResultTransformer(ESResultTransformer):
+    # license map for this request's assembly, looked up once per transformer
+    # (ie. once per request, whatever the number of hits in a POST batch)
+    _licenses = None
+
+    @property
+    def licenses(self):
+        if self._licenses is None:
+            self._licenses = get_license_map(self.options.assembly,
+                                             self.source_metadata[self.options.assembly])
+        return self._licenses
+
+    def _sort_and_annotate_doc(self, doc, sort=True, data_src=False, field_sep='.'):
+        if sort and not self.output_aliases and not (data_src and self.data_sources):
+            return sort_doc(doc)
+        return super(ESResultTransformer, self)._sort_and_annotate_doc(doc, sort=sort, data_src=data_src,
+                                                                       field_sep=field_sep)
+
+    def _clean_common_POST_response(self, _list, res, single_hit=True, score=True):
+        # batch version of the default, for annotation and query POST: hits
+        # of all terms go through the same formatting, decided once for the
+        # batch. Plus, an error response gives an {"query": ..., "error": true}
+        # entry only, and one {"query": ..., "truncated": true, "total": ...}
+        # entry follows hits of each query which couldn't be fetched in full
+        # (see ESQuery._query_POST_query())
+        responses = res['responses']
+        assert len(responses) == len(_list)
+        form_doc = self._batch_doc_former(score)
+        _res = []
+        for (qterm, result) in zip(_list, responses):
+            if 'error' in result:
+                _res.append({u'query': qterm, u'error': True})
+                continue
+            hits = result['hits']
+            if hits['total'] == 0:
+                _res.append({u'query': qterm, u'notfound': True})
+                continue
+            for hit in hits['hits']:
+                _ret = OrderedDict({u'query': qterm})
+                _ret.update(form_doc(hit))
+                _res.append(_ret)
+            if result.get('truncated'):
+                _res.append({u'query': qterm, u'truncated': True, u'total': hits['total']})
+        return _res
+
+    def _batch_doc_former(self, score):
+        ''' Return a function forming a doc from a hit, same as _form_doc(), for all hits of a batch '''
+        if self.options.jsonld or self.options.dotfield or not self.options._sorted or \
+           self.output_aliases or (self.options.datasource and self.data_sources):
+            return lambda hit: self._form_doc(doc=hit, score=score)
+        licenses = self.licenses
+        def form_doc(hit):
+            _doc = hit.get('_source', hit.get('fields', {}))
+            for attr in ('_id', '_score', '_version'):
+                if attr in hit:
+                    _doc.setdefault(attr, hit[attr])
+            if not score:
+                _doc.pop('_score', None)
+            if hit.get('found', None) is False:
+                _doc['found'] = hit['found']
+            self._add_licenses(_doc, licenses)
+            return sort_doc(_doc)
+        return form_doc
+
+    def _add_licenses(self, doc, licenses):
+        # only visit sources actually in the doc
+        for source in [k for k in doc if k in licenses]:
+            license = licenses[source]
+            if isinstance(doc[source], dict):
+                doc[source]['_license'] = license
+            elif isinstance(doc[source], list):
+                for d in doc[source]:
+                    if isinstance(d, dict):
+                        d['_license'] = license
+
     # Add app specific result transformations
     def _modify_doc(self, doc):
-        for source, val in self.source_metadata[self.options.assembly].items():
-            if source in doc:
-                if isinstance(doc[source], dict):
-                    try:
-                        doc[source]['_license'] = val.get('license_url_short', val.get('license_url'))
-                    except:
-                        pass
-                elif isinstance(doc[source], list):
-                    for d in doc[source]:
-                        try:
-                            d['_license'] = val.get('license_url_short', val.get('license_url'))
-                        except:
-                            pass                            
+        self._add_licenses(doc, self.licenses)
         #if 'cadd' in doc:
         #    doc['cadd']['_license'] = 'http://goo.gl/bkpNhq'
         #if 'dbnsfp' in doc:
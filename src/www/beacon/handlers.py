@@ -1,25 +1,36 @@
 import sys
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tornado import gen
 from biothings.www.api.helper import BaseHandler
 from biothings.utils.common import dotdict
 from www.api.transform import ESResultTransformer
 #import logging
 
+# ES client is blocking, queries are run in these threads so the IOLoop
+# keeps serving other requests meanwhile
+_es_executor = ThreadPoolExecutor(10)
+
 class BeaconHandler(BaseHandler):
     # Initialize Assembly and Datasets
     assembly_keys = {'NCBI36':'hg18', 'GRCh37':'hg19', 'GRCh38':'hg38'}
     pos_dbs = ['exac', 'cadd'] # These are hg19 ONLY
     assembly_dbs = ['dbnsfp','dbsnp','clinvar','evs','mutdb','cosmic','docm','wellderly']
 
+    @gen.coroutine
     def post(self, src=None):
-        self.receive_data()
+        yield self.receive_data()
         self.ga_event_object_ret['action'] = 'beacon_post'
         self.ga_track(self.ga_event_object_ret)
 
+    @gen.coroutine
     def get(self, src=None):
-        self.receive_data()
+        yield self.receive_data()
         self.ga_event_object_ret['action'] = 'beacon_get'
         self.ga_track(self.ga_event_object_ret)
 
+    @gen.coroutine
     def receive_data(self):
         chrom = self.get_argument('referenceName', None)
         start = self.get_argument('start', None)
@@ -37,9 +48,7 @@ class BeaconHandler(BaseHandler):
         if len(datasets) < 1:
             datasets = self.pos_dbs+self.assembly_dbs
         try:
-            dataset_responses = []
-            for dataset in datasets:
-                dataset_responses.append(self.query_dataset(chrom, start, ref, alt, assembly, dataset))
+            dataset_responses = yield self.query_datasets(chrom, start, ref, alt, assembly, datasets)
             exists = any([response['exists'] for response in dataset_responses])
             out = {'exists':exists, 'alleleRequest': allele_request}
             if include_datasets:
@@ -57,9 +66,39 @@ class BeaconHandler(BaseHandler):
         #Return the JSON response
         self.return_json(out)
 
-    def query_dataset(self, chrom, start, ref, alt, assembly, dataset):
-        # Initialzie output
-        out = {'datasetId': dataset, 'exists':False}
+    @gen.coroutine
+    def query_datasets(self, chrom, start, ref, alt, assembly, datasets):
+        # Initialize outputs, and build one query per valid dataset
+        outs = []
+        queries = []
+        for dataset in datasets:
+            out = {'datasetId': dataset, 'exists':False}
+            outs.append(out)
+            query = self.dataset_query(chrom, start, ref, alt, assembly, dataset)
+            if query:
+                queries.append((out, ) + query)
+        if not queries:
+            return outs
+
+        # perform all queries at once and format results
+        # for now always search against hg19 index...
+        body = []
+        for (out, q_type, q, dataset) in queries:
+            body.extend(['{}', json.dumps({"query":{"query_string":{"query":q}}, "_source":[dataset]})])
+        res = yield _es_executor.submit(self.web_settings.es_client.msearch,
+            index='_'.join([self.web_settings.ES_INDEX_BASE, 'hg19']),
+            doc_type=self.web_settings.ES_DOC_TYPE, body='\n'.join(body))
+        _transformer = ESResultTransformer(options=dotdict({'dotfield': True}), host=self.request.host)
+        for ((out, q_type, q, dataset), res) in zip(queries, res['responses']):
+            if 'error' in res:
+                raise Exception(res['error'])
+            res = _transformer.clean_query_GET_response(res)
+            if res and res.get('total') > 0:
+                self.format_output(res, out, q_type)
+        return outs
+
+    def dataset_query(self, chrom, start, ref, alt, assembly, dataset):
+        # Return (query type, query string, dataset) or None if there's nothing to query
         q_type = 'snp'
 
         # verify information and build query string
@@ -77,17 +116,8 @@ class BeaconHandler(BaseHandler):
                     ref = ''
 
                 q = self.format_query_string(q_type, chrom, start, ref, alt, assembly, dataset)
-                # perform query and format result
-                # for now always search against hg19 index...
-                res = self.web_settings.es_client.search(index='_'.join([self.web_settings.ES_INDEX_BASE, 'hg19']),
-                    doc_type=self.web_settings.ES_DOC_TYPE, body={"query":{"query_string":{"query":q}}}, 
-                    _source=[dataset])
-                _transformer = ESResultTransformer(options=dotdict({'dotfield': True}), host=self.request.host)
-                res = _transformer.clean_query_GET_response(res)
-                
-                if res and res.get('total') > 0:
-                    out = self.format_output(res, out, q_type)
-        return out
+                return (q_type, q, dataset)
+        return None
 
 
     def format_query_string(self, q_type, chrom, start, ref, alt, assembly, dataset):
@@ -133,30 +163,56 @@ class BeaconHandler(BaseHandler):
 
 
 class BeaconInfoHandler(BaseHandler):
-    # Use esq to grab metadata on myvariant.info
-    def initialize(self, web_settings):
-        super(BeaconInfoHandler, self).initialize(web_settings)
-        _meta = self.web_settings.es_client.indices.get_mapping(index='_'.join([self.web_settings.ES_INDEX_BASE, 'hg19']),
-                                                        doc_type=self.web_settings.ES_DOC_TYPE)
-        self.m = _meta[list(_meta.keys())[0]]['mappings'][self.web_settings.ES_DOC_TYPE]['properties']
-        _transformer = ESResultTransformer(options=dotdict(), host=self.request.host)
-        self.meta = _transformer.clean_metadata_response(_meta)
+    # Beacon info is built from the (huge) hg19 index mapping, so it's built
+    # once per process and served pre-serialized, until it's older than
+    # INFO_MAX_AGE seconds or the hg19 index alias points to other indices
+    # (checked at most every ALIAS_CHECK_INTERVAL seconds)
+    INFO_MAX_AGE = 3600
+    ALIAS_CHECK_INTERVAL = 60
+    _info_cache = {}
 
     # Current list of datasets in myvariant.info
     dataset_names = ['dbnsfp', 'dbsnp', 'clinvar', 'evs', 'cadd', 'mutdb', 'cosmic', 'docm', 'wellderly', 'exac']
 
 
+    @gen.coroutine
     def get(self):
-        self.get_beacon_info()
+        yield self.get_beacon_info()
         self.ga_event_object_ret['action'] = 'beacon_info_post'
         self.ga_track(self.ga_event_object_ret)
 
+    @gen.coroutine
     def post(self):
-        self.get_beacon_info()
+        yield self.get_beacon_info()
         self.ga_event_object_ret['action'] = 'beacon_info_post'
         self.ga_track(self.ga_event_object_ret)
 
+    @gen.coroutine
     def get_beacon_info(self):
+        cache = BeaconInfoHandler._info_cache
+        index = '_'.join([self.web_settings.ES_INDEX_BASE, 'hg19'])
+        now = time.time()
+        if cache and now - cache['built'] < self.INFO_MAX_AGE:
+            if now - cache['checked'] >= self.ALIAS_CHECK_INTERVAL:
+                cache['checked'] = now
+                aliases = yield _es_executor.submit(self.web_settings.es_client.indices.get_alias, index=index)
+                if sorted(aliases) != cache.get('indices'):
+                    cache.clear()
+        if not cache:
+            _meta = yield _es_executor.submit(self.web_settings.es_client.indices.get_mapping,
+                                              index=index, doc_type=self.web_settings.ES_DOC_TYPE)
+            out = self.build_beacon_info(_meta)
+            cache.update({'json': json.dumps(out, indent=2), 'indices': sorted(_meta),
+                          'built': now, 'checked': now})
+
+        # Return info
+        self.return_json(cache['json'], encode=False)
+
+    def build_beacon_info(self, _meta):
+        self.m = _meta[list(_meta.keys())[0]]['mappings'][self.web_settings.ES_DOC_TYPE]['properties']
+        _transformer = ESResultTransformer(options=dotdict(), host=self.request.host)
+        self.meta = _transformer.clean_metadata_response(_meta)
+
         # Boilerplate Beacon Info
         out = {'id': 'myvariant.info', 'apiVersion': 'v1', 'BeaconOrganization': 'TSRI',
                'welcomeUrl': 'http://www.myvariant.info'}
@@ -167,8 +223,7 @@ class BeaconInfoHandler(BaseHandler):
             datasets.append(self.get_dataset_info(dataset))
         out['datasets'] = datasets
 
-        # Return info
-        self.return_json(out)
+        return out
 
 
     def get_dataset_info(self, dataset):
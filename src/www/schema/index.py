@@ -4,6 +4,7 @@ import tornado.options
 import tornado.web
 import os.path
 from tornado.options import define, options
+from www.static_cache import StaticFileMixin
 
 define("port", default=8888, help="run on the given port", type=int)
 
@@ -11,7 +12,7 @@ define("port", default=8888, help="run on the given port", type=int)
 SCHEMA_PATH = os.path.split(os.path.abspath(__file__))[0]
 
 
-class SchemaHandler(tornado.web.RequestHandler):
+class SchemaHandler(StaticFileMixin, tornado.web.RequestHandler):
     cache_max_age = 604800  # 7days
 
     def get(self, ns, file_name):
@@ -20,11 +21,7 @@ class SchemaHandler(tornado.web.RequestHandler):
         file_path += '.json'
         self.set_header("Content-Type", "application/json; charset=UTF-8")
         self.set_header("Cache-Control", "max-age={}, public".format(self.cache_max_age))
-        if os.path.exists(file_path):
-            with open(file_path, 'r') as json_context:
-                self.write(json_context.read())
-        else:
-            raise tornado.web.HTTPError(404)
+        self.write_static_file(file_path)
 
 
 APP_LIST = [
@@ -0,0 +1,102 @@
+'''
+In-memory cache for static files served by handlers (demo page, standalone
+frontpage, JSON-LD schemas). Files are read once and kept with their gzipped
+version and an ETag, then reloaded when their mtime changes (checked at most
+every CHECK_INTERVAL seconds).
+'''
+import os
+import time
+import gzip
+import hashlib
+
+from tornado.web import HTTPError
+
+# seconds between two mtime checks of a cached file
+CHECK_INTERVAL = 1
+
+# path => StaticFile
+_cache = {}
+
+
+class StaticFile(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as f:
+            self.body = f.read()
+        self.gzipped = gzip.compress(self.body)
+        # each encoding is a different representation, with its own ETag
+        digest = hashlib.sha1(self.body).hexdigest()
+        self.etag = '"%s"' % digest
+        self.gzipped_etag = '"%s-gzip"' % digest
+        self.checked = time.time()
+
+
+def get_static_file(path):
+    ''' Return cached StaticFile for path, (re)loaded if needed. Raise
+    FileNotFoundError if there's no such file '''
+    sfile = _cache.get(path)
+    now = time.time()
+    if sfile is None:
+        sfile = _cache[path] = StaticFile(path)
+    elif now - sfile.checked >= CHECK_INTERVAL:
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            _cache.pop(path)
+            raise
+        if mtime != sfile.mtime:
+            sfile = _cache[path] = StaticFile(path)
+        else:
+            sfile.checked = now
+    return sfile
+
+
+def accepts_gzip(accept_encoding):
+    ''' Return True if gzip is acceptable according to Accept-Encoding
+    header value, taking q-values into account ("gzip;q=0" refuses it) '''
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name] = q
+    if 'gzip' in qvalues:
+        return qvalues['gzip'] > 0
+    if 'x-gzip' in qvalues:
+        return qvalues['x-gzip'] > 0
+    return qvalues.get('*', 0) > 0
+
+
+class StaticFileMixin(object):
+    ''' RequestHandler mixin, serving cached static files '''
+
+    def write_static_file(self, path):
+        ''' Finish request with path's content, gzipped if client accepts
+        it, or with a 304 if client's copy is current. 404 if no such file '''
+        try:
+            sfile = get_static_file(path)
+        except FileNotFoundError:
+            raise HTTPError(404)
+        gzipped = accepts_gzip(self.request.headers.get('Accept-Encoding', ''))
+        self.set_header('Etag', gzipped and sfile.gzipped_etag or sfile.etag)
+        # sent with 304s too, response depends on Accept-Encoding either way
+        self.add_header('Vary', 'Accept-Encoding')
+        if self.check_etag_header():
+            self.set_status(304)
+            self.finish()
+        elif gzipped:
+            self.set_header('Content-Encoding', 'gzip')
+            self.finish(sfile.gzipped)
+        else:
+            self.finish(sfile.body)